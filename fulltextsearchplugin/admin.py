@@ -15,12 +15,13 @@ class FullTextSearchAdmin(Component):
     # IAdminCommandProvider methods
 
     def get_admin_commands(self):
-        yield ('fulltext index', '[realm]',
+        yield ('fulltext index', '[--jobs N] [realm]',
                """Index Trac resources that are out of date
                
                When [realm] is specified, only that realm is updated.
                Synchronises the search index with Trac by indexing resources
-               that have been added or updated.
+               that have been added or updated. With --jobs, N processes
+               index each realm in parallel.
                """,
                self._complete_admin_command, self._do_index)
         yield ('fulltext list', '[realm]',
@@ -39,13 +40,14 @@ class FullTextSearchAdmin(Component):
                an index this will operation will affect all of them.
                """,
                None, self._do_optimize)
-        yield ('fulltext reindex', '[realm]',
+        yield ('fulltext reindex', '[--jobs N] [realm]',
                """Re-index all Trac resources.
                
                When [realm] is specified, only that realm is re-indexed.
                Discards the search index and recreates it. Note that this
                operation can take a long time to complete. If indexing gets
                interrupted, it can be resumed later using the `index` command.
+               With --jobs, N processes index each realm in parallel.
                """,
                self._complete_admin_command, self._do_reindex)
         yield ('fulltext slowreindex', 'seconds [realm]',
@@ -57,6 +59,13 @@ class FullTextSearchAdmin(Component):
                interrupted, it can be resumed later using the `index` command.
                """,
                self._complete_admin_command, self._do_reindex_slowly)
+        yield ('fulltext retry-failed', '[realm]',
+               """Index again the resources Solr failed to index
+               
+               When [realm] is specified, only resources in that realm are
+               retried. Resources that fail again remain recorded.
+               """,
+               self._complete_admin_command, self._do_retry_failed)
         yield ('fulltext remove', '[realm]',
                """Remove the search index, or part of it
                
@@ -67,6 +76,8 @@ class FullTextSearchAdmin(Component):
 
     def _complete_admin_command(self, args):
         fts = FullTextSearch(self.env)
+        if args[:1] == ['--jobs']:
+            args = args[2:]
         if len(args) == 1:
             return PrefixList(fts.index_realms)
 
@@ -75,7 +86,27 @@ class FullTextSearchAdmin(Component):
         if len(args) == 1:
             return PrefixList(fts.search_realms)
 
-    def _index(self, realm, clean, delay=None):
+    def _parse_jobs(self, args):
+        """Return the number of processes given with `--jobs N` in `args`,
+        and the remaining arguments.
+        """
+        args = list(args)
+        jobs = 1
+        if '--jobs' in args:
+            i = args.index('--jobs')
+            try:
+                jobs = int(args[i + 1])
+            except (IndexError, ValueError):
+                jobs = 0
+            if jobs < 1:
+                raise AdminCommandError(_("--jobs requires a number of "
+                                          "processes"))
+            del args[i:i + 2]
+        if len(args) > 1:
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        return jobs, args
+
+    def _index(self, realm, clean, delay=None, jobs=1):
         fts = FullTextSearch(self.env)
         fts.indexing_delay = delay
         realms = realm and [realm] or fts.index_realms
@@ -85,7 +116,8 @@ class FullTextSearchAdmin(Component):
         else:
             printout(_("Indexing new and changed items in realms: %(realms)s",
                        realms=fts._fmt_realms(realms)))
-        fts.index(realms, clean, self._index_feedback, self._clean_feedback)
+        fts.index(realms, clean, self._index_feedback, self._clean_feedback,
+                  jobs=jobs)
         printout(_("Indexing finished"))
 
     def _index_feedback(self, realm, resource):
@@ -96,8 +128,9 @@ class FullTextSearchAdmin(Component):
         #sys.stdout.write('\r\x1b[K')
         sys.stdout.flush()
 
-    def _do_index(self, realm=None):
-        self._index(realm, clean=False)
+    def _do_index(self, *args):
+        jobs, args = self._parse_jobs(args)
+        self._index(args and args[0] or None, clean=False, jobs=jobs)
 
     def _do_list(self, realm=None):
         fts = FullTextSearch(self.env)
@@ -112,14 +145,23 @@ class FullTextSearchAdmin(Component):
         fts = FullTextSearch(self.env)
         fts.optimize()
 
-    def _do_reindex(self, realm=None):
-        self._index(realm, clean=True)
+    def _do_reindex(self, *args):
+        jobs, args = self._parse_jobs(args)
+        self._index(args and args[0] or None, clean=True, jobs=jobs)
         self._do_optimize()
 
     def _do_reindex_slowly(self, seconds, realm=None):
         self._index(realm, clean=True, delay=float(seconds))
         self._do_optimize()        
         
+    def _do_retry_failed(self, realm=None):
+        fts = FullTextSearch(self.env)
+        realms = realm and [realm] or None
+        retried = fts.retry_failed(realms, self._index_feedback)
+        remaining = len(list(fts.get_failed(realms)))
+        printout(_("Retried %(retried)d items, %(remaining)d failed again",
+                   retried=retried, remaining=remaining))
+
     def _do_remove(self, realm=None):
         fts = FullTextSearch(self.env)
         realms = realm and [realm] or fts.index_realms
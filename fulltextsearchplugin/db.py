@@ -0,0 +1,56 @@
+"""Database tables of the full text search plugin."""
+from trac.db import Column, DatabaseManager, Index, Table
+
+__all__ = ['DB_NAME', 'DB_VERSION', 'FAILED_TABLE', 'MARK_TABLE',
+           'STATUS_TABLE', 'create_tables']
+
+# Name of the row in the system table holding the version of our tables
+DB_NAME = 'fulltextsearch_version'
+DB_VERSION = 3
+
+# Documents Solr rejected, until they are successfully indexed
+FAILED_TABLE = Table('fulltextsearch_failed', key='doc_id')[
+    Column('doc_id'),
+    Column('realm'),
+    Column('id'),
+    Column('parent_realm'),
+    Column('parent_id'),
+    Column('action'),
+    Column('error'),
+    Column('attempts', type='int'),
+    Column('time', type='int64'),
+    Index(['realm']),
+    ]
+
+# Index status of each resource, as last committed to Solr. `changed` is
+# when the resource was last changed, `indexed` when it was committed, both
+# in microseconds. `state` is 'indexed', or 'failed' once Solr rejected a
+# later version of the document.
+STATUS_TABLE = Table('fulltextsearch_status', key='doc_id')[
+    Column('doc_id'),
+    Column('realm'),
+    Column('id'),
+    Column('parent_realm'),
+    Column('parent_id'),
+    Column('changed', type='int64'),
+    Column('fingerprint'),
+    Column('state'),
+    Column('indexed', type='int64'),
+    Index(['realm', 'changed']),
+    ]
+
+# High water mark of the realms indexed oldest change first: the time of the
+# latest change seen by the last complete run of `fulltext index`, in
+# microseconds. Only written by that, unlike `changed` in the status table,
+# which the change listeners set as well.
+MARK_TABLE = Table('fulltextsearch_mark', key='realm')[
+    Column('realm'),
+    Column('changed', type='int64'),
+    ]
+
+def create_tables(env, db, tables):
+    connector = DatabaseManager(env).get_connector()[0]
+    cursor = db.cursor()
+    for table in tables:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
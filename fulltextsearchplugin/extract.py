@@ -0,0 +1,464 @@
+"""Extraction of plain text from attachments and repository files.
+
+Solr can extract the text of files itself (`extract=True`), but then Tika
+runs in the Solr JVM, competing with searches. With `[search]
+extract_processes` set, files of types there is an extractor for are
+converted to plain text by separate Python processes instead, and sent to
+Solr as ordinary documents. Other files are still sent to Solr for
+extraction.
+
+Extractors are provided by `ITextExtractor` components.
+
+With `[search] extraction_cache` set, extracted text is also kept on disk,
+keyed by a hash of the file, so unchanged files aren't extracted again when
+they are reindexed.
+"""
+import atexit
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import Queue
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from distutils.spawn import find_executable
+from HTMLParser import HTMLParser, HTMLParseError
+from xml.etree import cElementTree as ElementTree
+
+from trac.core import Component, implements, Interface
+from trac.util.text import to_unicode
+
+from fulltextsearchplugin.streams import hash_stream
+
+__all__ = ['ITextExtractor', 'LocalExtractor', 'BuiltinTextExtractors',
+           'ExtractionCache']
+
+
+class ITextExtractor(Interface):
+    """Extension point interface for extracting the plain text of files."""
+
+    def get_text_extractors():
+        """Return an iterable of `(mimetype, extractor)` tuples.
+
+        `extractor` is called with the path of a file, and returns its
+        plain text as unicode. It's called in another process, which
+        imports it by name, so it must be a function defined at the module
+        level.
+        """
+
+
+_MIMETYPES = {
+    '.docx': 'application/vnd.openxmlformats-officedocument'
+             '.wordprocessingml.document',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument'
+             '.spreadsheetml.sheet',
+    '.pptx': 'application/vnd.openxmlformats-officedocument'
+             '.presentationml.presentation',
+    '.odt': 'application/vnd.oasis.opendocument.text',
+    '.ods': 'application/vnd.oasis.opendocument.spreadsheet',
+    '.odp': 'application/vnd.oasis.opendocument.presentation',
+    }
+
+def guess_mimetype(filename):
+    '''Return the mimetype of `filename`, based on its extension.'''
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in _MIMETYPES:
+        return _MIMETYPES[ext]
+    return mimetypes.guess_type(filename, strict=False)[0]
+
+
+# Extractors
+
+def extract_plain_text(path):
+    f = open(path, 'rb')
+    try:
+        return to_unicode(f.read())
+    finally:
+        f.close()
+
+
+class _HTMLTextParser(HTMLParser):
+    _skip_tags = ('script', 'style')
+    # Tags which don't separate words
+    _inline_tags = frozenset(['a', 'abbr', 'b', 'big', 'code', 'em', 'font',
+                              'i', 'kbd', 'small', 'span', 'strong', 'sub',
+                              'sup', 'tt', 'u', 'var'])
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.text = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._skip_tags:
+            self._skip += 1
+        elif tag not in self._inline_tags:
+            self.text.append(u' ')
+
+    def handle_endtag(self, tag):
+        if tag in self._skip_tags and self._skip:
+            self._skip -= 1
+        elif tag not in self._inline_tags:
+            self.text.append(u' ')
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.text.append(data)
+
+    def handle_charref(self, name):
+        self.handle_entityref('#' + name)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % name))
+
+def extract_html(path):
+    parser = _HTMLTextParser()
+    try:
+        parser.feed(extract_plain_text(path))
+        parser.close()
+    except HTMLParseError:
+        pass
+    return u' '.join(u''.join(parser.text).split())
+
+
+# Members of office documents holding their text, by extension
+_OFFICE_MEMBERS = {
+    '.docx': re.compile(r'word/(document|header\d*|footer\d*|footnotes)\.xml$'),
+    '.xlsx': re.compile(r'xl/sharedStrings\.xml$'),
+    '.pptx': re.compile(r'ppt/(slides|notesSlides)/\w+\.xml$'),
+    }
+_OPENDOCUMENT_MEMBERS = re.compile(r'content\.xml$')
+# Elements of office documents which separate words, words themselves are
+# often split across several elements
+_OFFICE_BREAKS = frozenset(['br', 'cr', 'h', 'line-break', 'p', 's', 'si',
+                            'tab', 'table-cell', 'tc'])
+
+def _office_text(element, text):
+    if element.tag.rsplit('}', 1)[-1] in _OFFICE_BREAKS:
+        text.append(u' ')
+    if element.text:
+        text.append(element.text)
+    for child in element:
+        _office_text(child, text)
+    if element.tail:
+        text.append(element.tail)
+
+def extract_office_xml(path):
+    ext = os.path.splitext(path)[1].lower()
+    members = _OFFICE_MEMBERS.get(ext, _OPENDOCUMENT_MEMBERS)
+    archive = zipfile.ZipFile(path)
+    try:
+        text = []
+        for name in sorted(archive.namelist()):
+            if members.match(name):
+                _office_text(ElementTree.fromstring(archive.read(name)), text)
+                text.append(u' ')
+        return u' '.join(u''.join(text).split())
+    finally:
+        archive.close()
+
+def extract_pdf(path):
+    process = subprocess.Popen(['pdftotext', '-q', '-enc', 'UTF-8', path,
+                                '-'], stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise IOError("pdftotext exited with status %d"
+                      % process.returncode)
+    return output.decode('utf-8', 'replace')
+
+
+class BuiltinTextExtractors(Component):
+    """Extract the text of plain text, HTML, office XML and, if `pdftotext`
+    is installed, PDF files.
+    """
+    implements(ITextExtractor)
+
+    def get_text_extractors(self):
+        yield 'text/plain', extract_plain_text
+        yield 'text/html', extract_html
+        yield 'application/xhtml+xml', extract_html
+        for mimetype in _MIMETYPES.itervalues():
+            yield mimetype, extract_office_xml
+        if find_executable('pdftotext'):
+            yield 'application/pdf', extract_pdf
+
+
+# Extraction processes
+
+def _serve():
+    '''Main loop of an extraction process. Reads requests from stdin, one
+    JSON object per line naming an extractor and a file, and writes the text
+    it extracts, or the error, to stdout in the same way.
+    '''
+    # Keep whatever extractors print away from the responses
+    responses = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    for line in iter(sys.stdin.readline, ''):
+        request = json.loads(line)
+        try:
+            module = __import__(request['module'], fromlist=['__name__'])
+            extractor = getattr(module, request['name'])
+            response = {'text': extractor(request['path'])}
+        except Exception, e:
+            response = {'error': u'%s: %s' % (e.__class__.__name__,
+                                               to_unicode(e))}
+        responses.write(json.dumps(response) + '\n')
+        responses.flush()
+
+
+class _ExtractionError(Exception):
+    '''An extractor failed in an extraction process.'''
+
+
+class _ExtractionProcess(object):
+    """A Python process started to run extractors, see `_serve()`.
+
+    It's a new interpreter rather than a fork, as forking a multithreaded
+    web server process would copy locks held by its other threads.
+    """
+
+    def __init__(self):
+        env = dict(os.environ)
+        # As plugins may have been loaded from eggs, e.g. in the
+        # environment's plugins directory
+        env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path
+                                            if path)
+        self.process = subprocess.Popen(
+                [sys.executable, '-c', 'from fulltextsearchplugin.extract '
+                                       'import _serve; _serve()'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                close_fds=True, env=env)
+
+    def extract(self, extractor, path):
+        '''Return the text `extractor` extracts from the file `path`.'''
+        request = {'module': extractor.__module__,
+                   'name': extractor.__name__, 'path': path}
+        self.process.stdin.write(json.dumps(request) + '\n')
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise IOError("Extraction process %d exited" % self.process.pid)
+        response = json.loads(line)
+        if 'error' in response:
+            raise _ExtractionError(response['error'])
+        return response['text']
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+class LocalExtractor(object):
+    """Extracts the text of documents in up to `processes` processes.
+
+    The processes are started when needed, and kept for later batches. The
+    text of a batch of documents is extracted within `timeout` seconds,
+    the processes still busy after that are killed, and the documents they
+    were extracting left to Solr.
+    """
+
+    def __init__(self, extractors, processes=2, timeout=60, log=None):
+        """
+        extractors -- dict of functions extracting text, keyed by mimetype
+        processes -- Number of processes extracting text
+        timeout -- Seconds to wait for the text of a batch of documents
+        """
+        self.extractors = extractors
+        self.processes = processes
+        self.timeout = timeout
+        self.log = log
+        # Idle processes
+        self._processes = []
+        self._lock = threading.Lock()
+        self._registered = False
+
+    def extractor(self, doc):
+        '''Return the function extracting the text of `doc`, or None.'''
+        mimetype = guess_mimetype(doc.id or '')
+        return self.extractors.get(mimetype)
+
+    def extract(self, docs):
+        """Return a list of (doc, text) pairs for `docs`, those with an
+        extract=True body. text is None if no text could be extracted.
+        """
+        docs = list(docs)
+        texts = [None] * len(docs)
+        tasks = Queue.Queue()
+        tmp_paths = []
+        try:
+            for i, doc in enumerate(docs):
+                extractor = self.extractor(doc)
+                if extractor is None:
+                    continue
+                path = getattr(doc.body, 'path', None)
+                if path is None:
+                    path = self._write_body(doc)
+                    tmp_paths.append(path)
+                tasks.put((i, extractor, path))
+            self._run(docs, tasks, texts)
+        finally:
+            for path in tmp_paths:
+                os.remove(path)
+        return zip(docs, texts)
+
+    def _write_body(self, doc):
+        body = doc.body
+        if hasattr(body, 'read'):
+            body.seek(0)
+            body = body.read()
+        elif isinstance(body, unicode):
+            body = body.encode('utf-8')
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(doc.id)[1])
+        try:
+            os.write(fd, body or '')
+        finally:
+            os.close(fd)
+        return path
+
+    def _run(self, docs, tasks, texts):
+        """Extract the text of the (index, extractor, path) `tasks` into
+        `texts`, in as many threads as processes, until the timeout.
+        """
+        deadline = time.time() + self.timeout
+        busy = {}
+        lock = threading.Lock()
+        expired = threading.Event()
+        def work():
+            process = None
+            try:
+                while not expired.is_set():
+                    try:
+                        i, extractor, path = tasks.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if process is None:
+                        process = self._acquire()
+                    with lock:
+                        if expired.is_set():
+                            break
+                        busy[threading.current_thread()] = process
+                    try:
+                        texts[i] = process.extract(extractor, path)
+                    except Exception, e:
+                        if self.log and not expired.is_set():
+                            self.log.warning("Couldn't extract the text of "
+                                             "%s, leaving it to Solr: %s",
+                                             docs[i], e)
+                        if not isinstance(e, _ExtractionError):
+                            # The process died, or was killed
+                            process.kill()
+                            process = None
+                    finally:
+                        with lock:
+                            busy.pop(threading.current_thread(), None)
+            finally:
+                if process is not None:
+                    self._release(process)
+        threads = [threading.Thread(target=work,
+                                    name='FullTextSearch extract %d' % n)
+                   for n in xrange(min(self.processes, tasks.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        if any(thread.is_alive() for thread in threads):
+            with lock:
+                expired.set()
+                processes = busy.values()
+            if self.log:
+                self.log.warning("Extracting the text of %d documents took "
+                                 "longer than %s seconds, leaving the rest "
+                                 "to Solr", len(docs), self.timeout)
+            for process in processes:
+                process.kill()
+            for thread in threads:
+                thread.join()
+
+    def _acquire(self):
+        with self._lock:
+            if self._processes:
+                return self._processes.pop()
+            if not self._registered:
+                atexit.register(self.close)
+                self._registered = True
+        return _ExtractionProcess()
+
+    def _release(self, process):
+        with self._lock:
+            self._processes.append(process)
+
+    def close(self):
+        with self._lock:
+            processes, self._processes = self._processes, []
+        for process in processes:
+            process.kill()
+
+
+# Cache
+
+class ExtractionCache(object):
+    """Text and metadata extracted from files, stored in the directory
+    `path` and keyed by the SHA-1 of the files' types and contents.
+
+    Entries are never expired, remove the directory to empty the cache.
+    """
+
+    def __init__(self, path, log=None):
+        self.path = path
+        self.log = log
+
+    def digest(self, body, filename):
+        """Return the key of a document body, a string or stream, of the
+        file `filename`.
+
+        The type of the file is part of the key, as the same bytes can be
+        extracted differently, e.g. as plain text or as HTML.
+        """
+        filetype = (guess_mimetype(filename)
+                    or os.path.splitext(filename)[1].lower())
+        h = hashlib.sha1(filetype.encode('utf-8') + '\0')
+        return hash_stream(h, body).hexdigest()
+
+    def get(self, digest):
+        """Return the (text, metadata) stored for `digest`, or None."""
+        try:
+            f = gzip.open(self._entry_path(digest), 'rb')
+            try:
+                entry = json.loads(f.read())
+            finally:
+                f.close()
+            return entry['text'], entry['metadata']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def put(self, digest, text, metadata):
+        """Store the text and metadata extracted from a file."""
+        path = self._entry_path(digest)
+        try:
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            f = gzip.open(tmp_path, 'wb')
+            try:
+                f.write(json.dumps({'text': text, 'metadata': metadata}))
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError), e:
+            if self.log:
+                self.log.warning("Couldn't cache extracted text in %s: %s",
+                                 path, e)
+
+    def _entry_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest + '.json.gz')
@@ -1,16 +1,24 @@
-import Queue
+import atexit
+from contextlib import contextmanager
+import hashlib
+from itertools import islice
+import multiprocessing
 import os
 from datetime import datetime
 import operator
 import re
+import threading
 import time
 import sunburnt
-import httplib2
 from sunburnt.sunburnt import grouper
 import types
+from collections import namedtuple, OrderedDict
+from Queue import Empty, Queue
 
-from trac.env import IEnvironmentSetupParticipant
-from trac.core import Component, implements, Interface, TracError
+from trac.env import IEnvironmentSetupParticipant, open_environment
+from trac.db.api import DatabaseManager
+from trac.core import (Component, ExtensionPoint, implements, Interface,
+                       TracError)
 from trac.ticket.api import (ITicketChangeListener, IMilestoneChangeListener,
                              TicketSystem)
 from trac.ticket.model import Ticket, Milestone
@@ -19,36 +27,73 @@ from trac.ticket.roadmap import MilestoneModule
 from trac.wiki.api import IWikiChangeListener, WikiSystem
 from trac.wiki.model import WikiPage
 from trac.wiki.web_ui import WikiModule
-from trac.util.text import shorten_line
+from trac.util.text import empty, shorten_line, to_unicode
 from trac.attachment import IAttachmentChangeListener, Attachment
 from trac.attachment import AttachmentModule
-from trac.versioncontrol.api import IRepositoryChangeListener, Changeset
+from trac.versioncontrol.api import (IRepositoryChangeListener, Changeset,
+                                    RepositoryManager)
+from trac.versioncontrol.cache import CachedRepository, _actionmap, _kindmap
 from trac.versioncontrol.web_ui import ChangesetModule
 from trac.resource import (get_resource_shortname, get_resource_url,
                            Resource, ResourceNotFound)
 from trac.search import ISearchSource, shorten_result
 from trac.util.translation import _
 from trac.config import BoolOption
+from trac.config import ChoiceOption
+from trac.config import FloatOption
 from trac.config import IntOption
 from trac.config import ListOption
 from trac.config import Option
-from trac.util.compat import partial
-from trac.util.datefmt import to_datetime, to_utimestamp, utc
+from trac.util.datefmt import from_utimestamp, to_utimestamp, utc
 from trac.web.chrome import add_warning
 
 from componentdependencies import IRequireComponents
 from tractags.model import TagModelProvider
 
 from fulltextsearchplugin.dates import normalise_datetime
+from fulltextsearchplugin.extract import (ExtractionCache, ITextExtractor,
+                                          LocalExtractor)
+from fulltextsearchplugin.db import (DB_NAME, DB_VERSION, FAILED_TABLE,
+                                     MARK_TABLE, STATUS_TABLE,
+                                     create_tables)
+from fulltextsearchplugin.solr import (CircuitBreaker, JsonSolrInterface,
+                                       SolrInterface, SolrInterfacePool,
+                                       SolrUnavailable, UploadPool,
+                                       is_connection_error, is_schema_error)
+from fulltextsearchplugin.spool import MemorySpool, SqliteSpool
+from fulltextsearchplugin.throttle import LatencyWindow, Throttle
+from fulltextsearchplugin.streams import (LazyFile, SpooledStream, hash_stream,
+                                          stream_size)
 from trac.perm import PermissionError
 
 __all__ = ['IFullTextSearchSource',
-           'FullTextSearchObject', 'Backend', 'FullTextSearch',
+           'FullTextSearchObject', 'CommitPolicy', 'Backend',
+           'FullTextSearch',
            ]
 
 def _do_nothing(*args, **kwargs):
     pass
 
+def _partition(iterable, part):
+    '''Return the items of `iterable` in `part`, a (number, parts) tuple:
+    every parts-th item, starting with the number-th. All of them if `part`
+    is None.
+    '''
+    if part is None:
+        return iterable
+    number, parts = part
+    return islice(iterable, number, None, parts)
+
+def _walk_nodes(node):
+    '''Iterate the files and directories below the directory `node`,
+    parents first.
+    '''
+    for child in node.get_entries():
+        yield child
+        if child.isdir:
+            for descendant in _walk_nodes(child):
+                yield descendant
+
 def _sql_in(seq):
     '''Return '(%s,%s,...%s)' suitable to use in a SQL in clause.
     '''
@@ -61,6 +106,148 @@ def _res_id(resource):
     else:
         return u"%s:%s"% (resource.realm, resource.id)
 
+def _body_size(doc):
+    return stream_size(getattr(doc, 'body', None))
+
+def _doc_size(doc):
+    '''Return the approximate size in bytes of a document sent to Solr,
+    with its text encoded as UTF-8.
+    '''
+    size = _body_size(doc)
+    for name in ('title', 'author', 'oneline', 'tags', 'involved',
+                 'comments'):
+        value = getattr(doc, name, None)
+        if isinstance(value, basestring):
+            size += stream_size(value)
+        elif value:
+            size += sum(stream_size(v) for v in value
+                        if isinstance(v, basestring))
+    return size
+
+def _batches(docs, max_bytes, size):
+    '''Split `docs` into lists totalling at most `max_bytes` each, as
+    measured by `size`. A document larger than `max_bytes` gets a list of
+    it's own.
+    '''
+    batch, batch_bytes = [], 0
+    for doc in docs:
+        nbytes = size(doc)
+        if batch and batch_bytes + nbytes > max_bytes:
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(doc)
+        batch_bytes += nbytes
+    if batch:
+        yield batch
+
+def _set_text(doc, text, metadata):
+    '''Replace the body of `doc` by the text extracted from it, and set the
+    fields from the metadata of the file.
+    '''
+    doc.body = text
+    doc.extract = False
+    for name, values in metadata.iteritems():
+        setattr(doc, str(name), values)
+
+def _solr_error(e):
+    '''Return the message of a SolrError, without Solr's HTML wrapping, or
+    of another exception.
+    '''
+    if isinstance(e, sunburnt.SolrError) and len(e.args) == 2:
+        response, content = e.args
+        status = getattr(response, 'status', None) or response.get('status')
+        text = re.sub(r'<[^>]+>', ' ', to_unicode(content))
+        return u'%s %s' % (status, u' '.join(text.split()))
+    return to_unicode(e)
+
+def _resource_to_tuple(resource):
+    if resource is None:
+        return None
+    return (resource.realm, resource.id, resource.version,
+            _resource_to_tuple(resource.parent))
+
+def _resource_from_tuple(value):
+    if value is None:
+        return None
+    realm, id, version, parent = value
+    return Resource(realm, id, version, _resource_from_tuple(parent))
+
+# Index status of a resource: when it last changed, and the fingerprint of
+# the document last committed for it. Either may be None.
+IndexStatus = namedtuple('IndexStatus', 'changed fingerprint')
+
+def _parse_status(value):
+    '''Parse the status of a resource, as stored in the system table before
+    version 2 of our tables.
+    '''
+    parts = value.split(None, 1)
+    changed = int(parts[0]) and from_utimestamp(int(parts[0])) or None
+    return IndexStatus(changed, parts[1] if len(parts) > 1 else None)
+
+def _parse_res_id(value):
+    '''Return the (realm, id, parent_realm, parent_id) of a resource id
+    returned by `_res_id()`.
+    '''
+    parts = value.split(':', 3)
+    if len(parts) == 4 and (parts[0] == 'attachment'
+                            or parts[1] == 'repository'):
+        return parts[0], parts[3], parts[1], parts[2]
+    realm, id = value.split(':', 1)
+    return realm, id, None, None
+
+def _changelog_comments(changelog):
+    '''Return the comments of a ticket document, the new values of its
+    `changelog` of (time, permanent, author, field, oldvalue, newvalue)
+    tuples, with times in microseconds.
+
+    The changes are sorted on all of their columns and without duplicates,
+    so the comments, and the fingerprint of the document, are the same
+    whichever query they were read with.
+    '''
+    return [newvalue or '' for t, permanent, author, field, oldvalue, newvalue
+                           in sorted(set(changelog))]
+
+def _fingerprint_value(value):
+    if isinstance(value, datetime):
+        return str(to_utimestamp(value))
+    return repr(value)
+
+class _CachedChangeset(Changeset):
+    '''A changeset read from the repository cache along with its changes,
+    see `FullTextSearch._select_changesets()`.
+    '''
+    def __init__(self, repos, rev, message, author, date, changes):
+        Changeset.__init__(self, repos, rev, message, author, date)
+        self.changes = changes
+
+    def get_changes(self):
+        return iter(self.changes)
+
+# State of the worker processes of FullTextSearch._index_parallel()
+_index_worker = {}
+
+def _init_index_worker(env_path, feedback_queue):
+    _index_worker['env'] = open_environment(env_path, use_cache=False)
+    _index_worker['feedback'] = feedback_queue
+
+def _index_part(task):
+    '''Index a part of a realm in a worker process, return (realm, count).
+    '''
+    realm, part = task
+    fts = FullTextSearch(_index_worker['env'])
+    # A worker is busy indexing anyway, a background thread would only
+    # contend with it for the database
+    fts.backend.background = False
+    feedback_queue = _index_worker['feedback']
+    def feedback(realm, resource):
+        resource = getattr(resource, 'resource', resource)
+        feedback_queue.put((realm, _resource_to_tuple(resource)))
+    try:
+        return realm, fts._index_realm(realm, feedback, _do_nothing, part)
+    finally:
+        # Worker processes exit without running atexit handlers
+        fts.backend.stop()
+
 class IFullTextSearchSource(Interface):
     pass
 
@@ -129,6 +316,20 @@ class FullTextSearchObject(object):
     def doc_id(self):
         return u"%s:%s" % (self.project, _res_id(self.resource))
 
+    _fingerprint_fields = ('title', 'author', 'changed', 'created', 'oneline',
+                           'tags', 'involved', 'popularity', 'comments',
+                           'extract')
+
+    def fingerprint(self):
+        '''Return a hash of the fields and body sent to Solr for this
+        document, which only changes if the document does.
+        '''
+        h = hashlib.sha1(self.doc_id.encode('utf-8'))
+        for name in self._fingerprint_fields:
+            h.update('\0' + _fingerprint_value(getattr(self, name)))
+        h.update('\0')
+        return hash_stream(h, self.body).hexdigest()
+
     def __repr__(self):
         from pprint import pformat
         subset = dict(project = self.project,
@@ -141,7 +342,7 @@ class FullTextSearchObject(object):
                       tags = self.tags,
                       involved = self.involved,
                       popularity = self.popularity,
-                      body = "%d bytes" % len(self.body) if self.body else None,
+                      body = "%d bytes" % stream_size(self.body) if self.body else None,
                       comments = self.comments,
                       action = self.action,
                       extract = self.extract)
@@ -149,31 +350,126 @@ class FullTextSearchObject(object):
         r = '<FullTextSearchObject %s>' % pformat(subset)
         return r
 
+    def __getstate__(self):
+        # Resources and timezone aware datetimes are stored as plain values,
+        # so spooled items can be unpickled by any process
+        state = self.__dict__.copy()
+        state['resource'] = _resource_to_tuple(self.resource)
+        for name in ('changed', 'created'):
+            if state[name] is not None:
+                state[name] = to_utimestamp(state[name])
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        state['resource'] = _resource_from_tuple(state['resource'])
+        for name in ('changed', 'created'):
+            if state[name] is not None:
+                state[name] = from_utimestamp(state[name])
+        self.__dict__.update(state)
+
+
+class CommitPolicy(object):
+    """Decides when, and how, the Backend commits documents to Solr.
+
+    mode -- One of
+        'immediate': hard commit whenever a commit is requested
+        'grouped': hard commit once `interval` seconds have passed since the
+            first uncommitted change, or `batch` changes are waiting
+        'within': no explicit commits, documents are sent with commitWithin
+            so Solr commits them within `within` milliseconds
+        'soft': grouped soft commits so changes are searchable quickly, with
+            a hard commit at most every `hard_interval` seconds
+
+    Grouping needs the Backend's background thread, without it 'grouped'
+    and 'soft' commit as soon as a commit is requested.
+    """
+    modes = ('immediate', 'grouped', 'within', 'soft')
+
+    def __init__(self, mode='immediate', interval=5, batch=100, within=5000,
+                 hard_interval=600):
+        if mode not in self.modes:
+            raise ValueError("Unknown commit policy %r" % mode)
+        self.mode = mode
+        self.interval = interval
+        self.batch = batch
+        self.within = within
+        self.hard_interval = hard_interval
+        self.last_hard_commit = time.time()
+
+    def delay(self, pending, since, now):
+        """Return the seconds until a commit of `pending` items, queued
+        since `since`, is due. 0 if it is due now.
+        """
+        if self.mode not in ('grouped', 'soft') or pending >= self.batch:
+            return 0
+        return max(0, since + self.interval - now)
+
+    def hard_commit_delay(self, now):
+        return max(0, self.last_hard_commit + self.hard_interval - now)
+
+    def update_args(self):
+        """Return keyword arguments for sending adds and deletes."""
+        if self.mode == 'within':
+            return {'commitWithin': self.within}
+        return {}
+
+    def commit_args(self, now, hard=False):
+        """Return keyword arguments for an explicit commit, or None if the
+        commit is left to Solr.
+        """
+        if hard:
+            return {}
+        if self.mode == 'within':
+            return None
+        if self.mode == 'soft' and self.hard_commit_delay(now):
+            return {'softCommit': True}
+        return {}
 
-class Backend(Queue.Queue):
-    """In process queue for submitting documents to Apache Solr.
 
-    In the future, this queue might be external so that:
+class Backend(object):
+    """Spooling queue for submitting documents to Apache Solr.
 
-    * We can queue items even if solr is down 
+    Queued items are kept in a spool (see `fulltextsearchplugin.spool`)
+    until Solr has accepted them. If Solr is down the items stay in the
+    spool, and are sent by the next flush. With a `SqliteSpool` they also
+    survive a restart of the process.
 
-    * We can queue items quickly, and then transfer them to solr
-    out-of-process so the user isn't waiting
+    With `background` set, a daemon thread flushes and commits the queued
+    items, so whoever queues them isn't waiting for Solr.
 
-    Note, currently this queue expects FullTextSearchObject items. It
-    probably should instead be a queue of (action, Resources) tuples,
-    so the actual work of reading the database/subversion can be done
-    by the queue-consumer, not the queue-feeder.
+    The queue holds (action, item) tuples, where item is either a
+    FullTextSearchObject or a Resource. Resources are turned into documents
+    by `loader` when they are flushed, so the actual work of reading the
+    database/subversion is done by the queue-consumer, not the queue-feeder.
 
     """
 
     def __init__(self,
                  solr_endpoint,
                  log,
-                 si_class=sunburnt.SolrInterface,
+                 si_class=SolrInterface,
                  queue_size=1,
                  solr_retry_timeout=None,
-                 solr_http_timeout=None):
+                 solr_http_timeout=None,
+                 spool=None,
+                 background=False,
+                 poll_interval=30,
+                 on_commit=None,
+                 loader=None,
+                 commit_policy=None,
+                 schema_cache=None,
+                 schema_ttl=3600,
+                 extract_workers=1,
+                 extract_max_bytes=64*2**20,
+                 queue_bytes=20*2**20,
+                 batch_size=100,
+                 max_request_bytes=5*2**20,
+                 breaker=None,
+                 on_error=None,
+                 extractor=None,
+                 fingerprints=None,
+                 extract_cache=None):
 
         """Initialize an empty queue.
 
@@ -183,41 +479,213 @@ class Backend(Queue.Queue):
             Must match the signature of sunburnt.SolrInterface.
         solr_retry_timeout -- Seconds to wait before retrying http request to solr (-1 to disable retry)
         solr_http_timeout -- Seconds to wait for http requests to solr (None for Python default)
+        spool -- Spool holding queued items (None for a MemorySpool)
+        background -- Flush and commit queued items in a background thread
+        poll_interval -- Seconds between checks of the spool by the
+            background thread, for items queued by other processes or left
+            after a failed commit
+        on_commit -- Callable that accepts a list of (action, resource,
+            changed, fingerprint) tuples, called after they have been
+            committed. fingerprint is None for deletes, and if
+            `fingerprints` isn't set.
+        loader -- Callable that accepts an action & a queued Resource,
+            returns the FullTextSearchObjects to send to Solr for it
+        commit_policy -- CommitPolicy deciding when and how to commit
+            (None for immediate hard commits)
+        schema_cache -- File in which the Solr schema is cached between
+            processes (None to only cache it in memory)
+        schema_ttl -- Seconds before the cached Solr schema is fetched again
+        extract_workers -- Number of threads sending documents with
+            extract=True to Solr
+        extract_max_bytes -- Maximum total size of the documents with
+            extract=True being sent at once
+        queue_bytes -- Flush once the queued documents total this many bytes,
+            even if there are fewer than `queue_size`
+        batch_size -- Maximum number of queued items loaded and sent to Solr
+            at once. Fewer are loaded from a spool file when their bodies
+            add up to more than max_request_bytes
+        max_request_bytes -- Target size of each request adding documents
+            to Solr, larger batches are split into several requests
+        breaker -- CircuitBreaker tracking whether Solr is reachable. Whilst
+            it's open queued items are left in the spool, to be sent once
+            Solr is back (None for a default CircuitBreaker)
+        on_error -- Callable that accepts a list of (action, resource,
+            error) tuples, called with documents Solr rejected, and queued
+            resources `loader` failed on. They are removed from the
+            spool.
+        extractor -- LocalExtractor extracting the text of documents with
+            extract=True, so they're sent to Solr as plain text (None to
+            leave all of them to Solr)
+        fingerprints -- Callable that accepts a list of resources, returns a
+            dict of the fingerprints of the documents last committed for
+            them, keyed by resource id. Documents with the same fingerprint
+            are unchanged, and aren't sent again (None to always send them).
+        extract_cache -- ExtractionCache holding the text of documents with
+            extract=True. Cached text is sent instead of having it extracted
+            again, and Solr is only asked to extract the text of the others,
+            which is then cached (None to disable).
         """
-        Queue.Queue.__init__(self)
         self.log = log
         self.solr_endpoint = solr_endpoint
         self.si_class = si_class
         self.queue_size = queue_size
+        self.queue_bytes = queue_bytes
+        self.batch_size = batch_size
+        self.max_request_bytes = max_request_bytes
         self.retry_timeout = solr_retry_timeout
-        self.http_connection = httplib2.Http(timeout=solr_http_timeout)
+        self.pool = SolrInterfacePool(solr_endpoint, si_class,
+                                      http_timeout=solr_http_timeout,
+                                      retry_timeout=solr_retry_timeout,
+                                      cache_path=schema_cache,
+                                      ttl=schema_ttl, log=log)
+        self.uploads = UploadPool(extract_workers, extract_max_bytes)
+        self.spool = spool if spool is not None else MemorySpool()
+        self.background = background
+        self.poll_interval = poll_interval
+        self.on_commit = on_commit
+        self.on_error = on_error
+        self.extractor = extractor
+        self.fingerprints = fingerprints
+        self.extract_cache = extract_cache
+        self.loader = loader
+        self.policy = commit_policy or CommitPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        # Of plain adds, see Throttle. Extracting and committing take
+        # longer however busy Solr is, depending on the files and on how
+        # much was sent.
+        self.latencies = LatencyWindow()
+        self._lock = threading.RLock()
+        self._uncommitted = []
+        self._pending_since = None
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        # Of the documents queued since the last flush, updated by the
+        # threads queueing them and by the one flushing
+        self._queued_bytes = 0
+        self._bytes_lock = threading.Lock()
+
+    def qsize(self):
+        return len(self.spool)
+
+    def put(self, entry):
+        self.spool.put(entry)
 
     def create(self, item, quiet=False):
-        item.action = 'CREATE'
-        self.put(item)
-        if self.qsize() >= self.queue_size:
-            self.flush()
+        self._enqueue('CREATE', item)
         
     def modify(self, item, quiet=False):
-        item.action = 'MODIFY'
-        self.put(item)
-        if self.qsize() >= self.queue_size:
-            self.flush()
+        self._enqueue('MODIFY', item)
     
     def delete(self, item, quiet=False):
-        item.action = 'DELETE'
-        self.put(item)
-        if self.qsize() >= self.queue_size:
+        self._enqueue('DELETE', item)
+
+    def _enqueue(self, action, item):
+        if isinstance(item, FullTextSearchObject):
+            item.action = action
+        self.put((action, item))
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        if isinstance(item, FullTextSearchObject):
+            nbytes = _doc_size(item)
+            with self._bytes_lock:
+                self._queued_bytes += nbytes
+        if self.breaker.is_open:
+            # Sent once Solr is back
+            return
+        if self.qsize() >= self.queue_size or \
+                self._queued_bytes >= self.queue_bytes:
+            # Sent here even with a background thread, so whoever queues
+            # documents can't run ahead of Solr, e.g. a reindex holding
+            # ever more of them in the spool. The background thread only
+            # commits.
             self.flush()
 
+    def request_commit(self, quiet=True):
+        """Commit the queued items, in the background if `background` is set.
+
+        Return True if the items were committed or handed to the background
+        thread, see `commit()`.
+        """
+        if not self.background:
+            return self.commit(quiet)
+        self.start()
+        self._wakeup.set()
+        return True
+
+    def _worker_alive(self):
+        return self._worker is not None and self._worker.is_alive()
+
+    def start(self):
+        """Start the background thread, if it isn't already running."""
+        with self._worker_lock:
+            if self._worker_alive():
+                return
+            if self._worker is None:
+                atexit.register(self.stop)
+            self._stopping = False
+            self._worker = threading.Thread(target=self._run,
+                                            name='FullTextSearch indexer')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread, committing any queued items."""
+        with self._worker_lock:
+            worker = self._worker
+            self._stopping = True
+            self._wakeup.set()
+        if worker is not None:
+            worker.join(timeout)
+        if self.qsize() or self._uncommitted:
+            self.commit(quiet=True, hard=True)
+        self.uploads.close()
+
+    def _run(self):
+        timeout = self.poll_interval
+        while not self._stopping:
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            timeout = self.poll_interval
+            pending = self.qsize()
+            now = time.time()
+            if pending:
+                if self._pending_since is None:
+                    # Queued by another process
+                    self._pending_since = now
+                delay = self.policy.delay(pending, self._pending_since, now)
+            elif self._uncommitted:
+                # Soft committed, waiting for a hard commit
+                delay = self.policy.hard_commit_delay(now)
+            else:
+                continue
+            if delay:
+                timeout = min(delay, self.poll_interval)
+                continue
+            try:
+                self.commit(quiet=True)
+            except Exception:
+                # Keep the thread alive, the items are still spooled
+                self.log.exception("Background commit to Solr failed")
+            if self.breaker.is_open:
+                # Wake up in time to probe Solr
+                timeout = min(self.breaker.retry_delay(), self.poll_interval) \
+                          or self.poll_interval
+            elif self._uncommitted and not self.qsize():
+                # Wake up in time for the hard commit
+                hard_delay = self.policy.hard_commit_delay(time.time())
+                timeout = min(hard_delay, self.poll_interval) \
+                          or self.poll_interval
+
     def remove(self, project_id, realms=None):
         '''Delete docs from index where project=project_id AND realm in realms
 
         If realms is not specified then delete all documents in project_id.
         '''
-        s = self.si_class(self.solr_endpoint,
-                          http_connection=self.http_connection,
-                          retry_timeout=self.retry_timeout)
+        s = self.pool.get()
         Q = s.query().Q
         q = s.query(u'project:%s' % project_id)
         if realms:
@@ -229,49 +697,76 @@ class Backend(Queue.Queue):
         s.commit()
 
     def flush(self, quiet=False, solrinterface=None):
-        """Send items in the queue to Solr, but does not commit."""
-        self.log.debug("Flushing from Python queue (%d items) to solr", self.qsize())
+        """Send items in the queue to Solr, but does not commit.
 
+        Items are removed from the spool once they have been sent. If sending
+        fails they are kept, to be sent again by the next flush.
+        """
+        if not self._allow(quiet):
+            return False
         if solrinterface is None:
             try:
-                s = self.si_class(self.solr_endpoint,
-                                  http_connection=self.http_connection,
-                                  retry_timeout=self.retry_timeout)
+                solrinterface = self.pool.get()
             except Exception, e:
+                self.breaker.failure()
                 if quiet:
                     self.log.error("Could not flush to Solr due to: %s", e)
-                    return
+                    return False
                 else:
                     raise
-        else:
-            s = solrinterface
+        with self._lock:
+            with self._tracking():
+                return self._flush(solrinterface)
+
+    def _flush(self, s):
+        # The spool may hold many more items than we want in memory, e.g.
+        # during a reindex, so they are sent in batches, of at most about
+        # max_request_bytes when the items carry their bodies. Each is
+        # claimed, so other processes sharing the spool don't send it as
+        # well.
+        errors = 0
+        while True:
+            entries = self.spool.claim(self.batch_size,
+                                       self.max_request_bytes)
+            if not entries:
+                break
+            self.log.debug("Flushing from spool (%d items) to solr",
+                           len(entries))
+            try:
+                errors += self._flush_entries(s, entries)
+            except:
+                # Those still spooled are sent by the next flush, from
+                # whichever process
+                self.spool.release([key for key, entry in entries])
+                raise
+        with self._bytes_lock:
+            self._queued_bytes = 0
+        return errors == 0
 
+    def _flush_entries(self, s, entries):
+        """Send spooled (key, (action, item)) entries to Solr, remove them
+        from the spool and return the number of documents Solr rejected.
+        """
         errors = 0
         # we batch them so a single HTTP request to solr can contain
         # multiple documents
-        adds_with_extract = 0
+        extracts = []
         adds = []
         deletes = []
-        while True:
-            try:
-                item = self.get(block=False)
-            except Queue.Empty:
-                break
+        sent = []
+        unloaded = []
+        docs = self._coalesce(entries, unloaded)
+        fingerprints = {}
+        if self.fingerprints is not None:
+            docs = self._changed(docs, fingerprints)
+        for item in docs:
             if item.action in ('CREATE', 'MODIFY'):
                 if item.extract:
-                    adds_with_extract += 1
-                    # we'll do this right away, as in sunburnt's
-                    # implementation it'll be in a single POST anyway,
-                    # and this way simplifies the 'filename' handling
-                    #self.log.debug("Sending item %s to solr with extract=True", item)
-                    try:
-                      s.add(item, extract=True, filename=item.id)
-                    except sunburnt.SolrError, e:
-                      errors += 1
-                      response, content = e.args
-                      self.log.error("Encountered a Solr error indexing '%s'. "
-                                     "Solr returned: %s %s",
-                                     item, response, content)
+                    # sunburnt sends each of these in a POST of its own,
+                    # which simplifies the 'filename' handling. As Solr
+                    # spends a while extracting them they are sent in
+                    # parallel.
+                    extracts.append(item)
                 else:
                     adds.append(item)
             elif item.action == 'DELETE':
@@ -280,20 +775,253 @@ class Backend(Queue.Queue):
                 self.log.error("Unknown Solr action %s on %s",
                                item.action, item)
 
-        self.log.debug("Sent %d adds with extract=True through sunburnt", adds_with_extract)                
+        digests = {}
+        if extracts and (self.extract_cache is not None
+                         or self.extractor is not None):
+            extracts = self._extract_locally(extracts, adds, digests)
+
+        update_args = self.policy.update_args()
+        def upload(item):
+            #self.log.debug("Sending item %s to solr with extract=True", item)
+            si = self.pool.get()
+            if self.extract_cache is None:
+                si.add(item, extract=True, filename=item.id, **update_args)
+                return
+            # Solr only extracts the text, which is cached and then sent
+            # along with the other adds
+            text, metadata = si.extract_text(item, filename=item.id)
+            self.extract_cache.put(digests[item.doc_id], text, metadata)
+            _set_text(item, text, metadata)
+        failure = None
+        rejected = []
+        for item, e in self.uploads.map(upload, extracts, _body_size):
+            if e is None:
+                if self.extract_cache is None:
+                    sent.append(item)
+                else:
+                    adds.append(item)
+            elif is_connection_error(e):
+                failure = failure or e
+            else:
+                # Solr rejected it, or it couldn't be sent at all, e.g. an
+                # attachment deleted since it was loaded. Sending it again
+                # wouldn't help.
+                rejected.append((item, e))
+        if failure is not None:
+            raise failure
+
+        self.log.debug("Sent %d adds with extract=True through sunburnt", len(extracts))
         self.log.debug("Sending %d adds through sunburnt", len(adds))
-        if adds:
-            # If a single document fails, then maybe they all fail...
-            # Fortunately, it's the ones with extract=True which are
-            # more likely to fail (if Tika fails)
-            # Note: This has internal chunking to try to limit the size of a POST
-            s.add(adds)
+        # Requests are kept below max_request_bytes, sunburnt further
+        # splits them every 100 documents
+        for batch in _batches(adds, self.max_request_bytes, _doc_size):
+            sent.extend(self._add(s, batch, update_args, rejected))
         self.log.debug("Sending %d deletes through sunburnt", len(deletes))
+        deleted = []
+        kept = set()
         if deletes:
-            s.delete(deletes)
-        return errors == 0
+            try:
+                deleted = self._delete(s, deletes, update_args, rejected)
+            except Exception, e:
+                # Solr is unreachable. The adds it accepted are done with,
+                # only the deletes are kept to be sent again.
+                failure = e
+                kept = set(_res_id(item.resource) for item in deletes)
+        self.spool.remove([key for key, (action, item) in entries
+                           if _res_id(getattr(item, 'resource', item))
+                              not in kept])
+        if self.on_commit:
+            self._uncommitted.extend((item.action, item.resource, item.changed,
+                                      fingerprints.get(item.doc_id))
+                                     for item in sent + deleted)
+        if rejected:
+            self._rejected(rejected)
+        if unloaded:
+            self._unloaded(unloaded)
+        if failure is not None:
+            raise failure
+        return len(rejected) + len(unloaded)
+
+    def _changed(self, docs, fingerprints):
+        """Return `docs` without the adds whose fingerprint matches the
+        last one committed, and store the fingerprints of the adds in
+        `fingerprints`, keyed by doc_id.
+        """
+        adds = [doc for doc in docs if doc.action in ('CREATE', 'MODIFY')]
+        if not adds:
+            return docs
+        try:
+            committed = self.fingerprints([doc.resource for doc in adds])
+        except Exception:
+            self.log.exception("Failed to read the fingerprints of %d "
+                               "documents, sending them all", len(adds))
+            committed = {}
+        changed = []
+        for doc in docs:
+            if doc.action in ('CREATE', 'MODIFY'):
+                fingerprint = fingerprints[doc.doc_id] = doc.fingerprint()
+                if committed.get(_res_id(doc.resource)) == fingerprint:
+                    continue
+            changed.append(doc)
+        if len(changed) < len(docs):
+            self.log.debug("Skipped %d unchanged documents",
+                           len(docs) - len(changed))
+        return changed
+
+    def _extract_locally(self, docs, adds, digests):
+        """Replace the bodies of `docs` by their text, where it's in
+        `extract_cache` or `extractor` can extract it, and append them to
+        `adds`. Return the others, which are left to Solr.
+
+        The keys of the documents in `extract_cache` are stored in
+        `digests`, by doc_id.
+        """
+        cache = self.extract_cache
+        if cache is not None:
+            remaining = []
+            for doc in docs:
+                digest = digests[doc.doc_id] = cache.digest(doc.body,
+                                                            doc.id or '')
+                cached = cache.get(digest)
+                if cached is None:
+                    remaining.append(doc)
+                else:
+                    _set_text(doc, *cached)
+                    adds.append(doc)
+            self.log.debug("Found the text of %d documents in the "
+                           "extraction cache", len(docs) - len(remaining))
+            docs = remaining
+        if self.extractor is not None and docs:
+            remaining = []
+            for doc, text in self.extractor.extract(docs):
+                if text is None:
+                    remaining.append(doc)
+                    continue
+                if cache is not None:
+                    cache.put(digests[doc.doc_id], text, {})
+                _set_text(doc, text, {})
+                adds.append(doc)
+            self.log.debug("Extracted the text of %d documents locally",
+                           len(docs) - len(remaining))
+            docs = remaining
+        return docs
+
+    def _add(self, s, docs, update_args, rejected):
+        """Send `docs` to Solr in a single request, return the documents
+        Solr accepted.
+
+        If Solr rejects the request, or it can't be built, the documents are
+        sent one at a time, to find out which of them are at fault. Those
+        are appended to `rejected` with the error, instead of failing the
+        whole batch. Only failing to reach Solr fails it.
+        """
+        try:
+            with self.latencies.timing():
+                s.add(docs, **update_args)
+            return docs
+        except Exception, e:
+            if is_connection_error(e):
+                raise
+            if len(docs) == 1:
+                rejected.append((docs[0], e))
+                return []
+        accepted = []
+        for doc in docs:
+            accepted.extend(self._add(s, [doc], update_args, rejected))
+        return accepted
+
+    def _delete(self, s, docs, update_args, rejected):
+        """Delete `docs` from Solr in a single request, return the
+        documents Solr accepted. Rejected documents are handled as by
+        `_add()`.
+        """
+        try:
+            s.delete(docs, **update_args)
+            return docs
+        except Exception, e:
+            if is_connection_error(e):
+                raise
+            if len(docs) == 1:
+                rejected.append((docs[0], e))
+                return []
+        accepted = []
+        for doc in docs:
+            accepted.extend(self._delete(s, [doc], update_args, rejected))
+        return accepted
+
+    def _rejected(self, rejected):
+        """Log the documents Solr rejected, or which couldn't be sent, and
+        pass them to `on_error`.
+        """
+        for item, e in rejected:
+            self._check_schema(e)
+            self.log.error("Encountered an error indexing '%s': %s",
+                           item, _solr_error(e))
+        if self.on_error:
+            try:
+                self.on_error([(item.action, item.resource, _solr_error(e))
+                               for item, e in rejected])
+            except Exception:
+                self.log.exception('Failed to record rejected items')
+
+    def _unloaded(self, unloaded):
+        """Pass the queued (action, resource, error) entries which couldn't
+        be loaded to `on_error`, so they are retried later rather than lost.
+        """
+        if self.on_error:
+            try:
+                self.on_error([(action, resource, _solr_error(e))
+                               for action, resource, e in unloaded])
+            except Exception:
+                self.log.exception('Failed to record items which could not '
+                                   'be loaded')
+
+    def _coalesce(self, entries, unloaded):
+        """Return the documents for spooled (key, (action, item)) entries.
+        Those which couldn't be loaded are appended to `unloaded`, see
+        `_documents()`.
+
+        Only the last entry queued for a resource is kept, e.g. a delete
+        followed by a create becomes a single add. This is done before and
+        after loading, so superseded entries are never loaded.
+        """
+        latest = OrderedDict()
+        for key, (action, item) in entries:
+            res_id = _res_id(getattr(item, 'resource', item))
+            latest.pop(res_id, None)
+            latest[res_id] = (action, item)
+        docs = OrderedDict()
+        for doc in self._documents(latest.itervalues(), unloaded):
+            docs.pop(doc.doc_id, None)
+            docs[doc.doc_id] = doc
+        if len(docs) < len(entries):
+            self.log.debug("Coalesced %d queued items into %d documents",
+                           len(entries), len(docs))
+        return docs.values()
+
+    def _documents(self, entries, unloaded):
+        """Generate the documents for (action, item) entries.
+
+        Entries `loader` fails on, e.g. as the database is locked, are
+        appended to `unloaded` with the error. Resources which no longer
+        exist aren't errors, `loader` returns no documents for them.
+        """
+        for action, item in entries:
+            if isinstance(item, FullTextSearchObject):
+                item.action = action
+                yield item
+                continue
+            try:
+                docs = list(self.loader(action, item))
+            except Exception, e:
+                self.log.exception("Could not load %s for indexing", item)
+                unloaded.append((action, item, e))
+                continue
+            for doc in docs:
+                doc.action = doc.action or action
+                yield doc
 
-    def commit(self, quiet=False):
+    def commit(self, quiet=False, hard=False):
         """Commit the items previously sent to solr to it's database, return
         True on success.
 
@@ -302,28 +1030,90 @@ class Backend(Queue.Queue):
         all queued items have been indexed.
         If `quiet` is specified then exceptions are surpressed, but still
         counted for purposes of the return value.
+        The kind of commit is decided by the commit policy, unless `hard` is
+        specified. Committed items are only passed to `on_commit` once they
+        have been hard committed, or accepted with commitWithin.
 
         """
-        s = self.si_class(self.solr_endpoint,
-                          http_connection=self.http_connection,
-                          retry_timeout=self.retry_timeout)
+        if not self._allow(quiet):
+            return False
+        now = time.time()
+        commit_args = self.policy.commit_args(now, hard)
         try:
-            self.flush(solrinterface=s)
-            s.commit()
+            with self._tracking():
+                s = self.pool.get()
+                with self._lock:
+                    self._flush(s)
+                self._pending_since = None
+                if commit_args is not None:
+                    s.commit(**commit_args)
         except sunburnt.SolrError, e:
+            # Documents Solr rejected have already been handled by flush().
+            # Those sent are still in _uncommitted, and are passed to
+            # on_commit by the next successful commit.
             self.log.exception('SolrError encountered while committing')
-            return True  # The resource Will be saved in the next commit
+            self._check_schema(e)
+            if not quiet:
+                raise
+            return False
         except Exception, e:
             self.log.exception('Failed to commit')
             if not quiet:
                 raise
             return False
+        if not commit_args:
+            if commit_args is not None:
+                self.policy.last_hard_commit = now
+            self._notify_committed()
         return True
 
+    def _allow(self, quiet):
+        """Return True if Solr may be contacted, see `CircuitBreaker`.
+        """
+        if self.breaker.allow():
+            return True
+        self.log.debug("Solr at %s is unavailable, leaving %d items in the "
+                       "spool", self.solr_endpoint, self.qsize())
+        if not quiet:
+            raise SolrUnavailable("Solr at %s is unavailable, retrying in %d "
+                                  "seconds" % (self.solr_endpoint,
+                                               self.breaker.retry_delay()))
+        return False
+
+    @contextmanager
+    def _tracking(self):
+        """Report the outcome of communicating with Solr to the breaker.
+        Only failing to reach Solr counts as a failure, an error response,
+        or an error reading a document, still means Solr is reachable.
+        """
+        try:
+            yield
+        except Exception, e:
+            if is_connection_error(e):
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        self.breaker.success()
+
+    def _check_schema(self, e):
+        """Discard the cached Solr schema if error `e` was caused by it being
+        out of date.
+        """
+        if is_schema_error(e):
+            self.pool.invalidate()
+
+    def _notify_committed(self):
+        with self._lock:
+            committed, self._uncommitted = self._uncommitted, []
+        if committed and self.on_commit:
+            try:
+                self.on_commit(committed)
+            except Exception:
+                self.log.exception('Failed to process committed items')
+
     def optimize(self):
-        s = self.si_class(self.solr_endpoint,
-                          http_connection=self.http_connection,
-                          retry_timeout=self.retry_timeout)
+        s = self.pool.get()
         try:
             s.optimize()
         except Exception:
@@ -358,6 +1148,18 @@ class FullTextSearch(Component):
     queue_size = IntOption("search", "in_memory_queue_size", 200,
         doc="""Number of items to store in Python queue before flushing to solr.
         """)
+
+    queue_bytes = IntOption("search", "in_memory_queue_bytes", 20*2**20,
+        doc="""Total size (in bytes) of the documents to store in Python
+        queue before flushing to solr, even if there are fewer than
+        `in_memory_queue_size`.
+        """)
+
+    max_request_size = IntOption("search", "max_request_size", 5*2**20,
+        doc="""Target size (in bytes) of each request adding documents to
+        solr. Keep this below the request size limit of the servlet
+        container solr is running in.
+        """)
     
     fulltext_index_svn_nodes = BoolOption("search", "fulltext_index_svn_nodes",
         default=False,
@@ -376,22 +1178,193 @@ class FullTextSearch(Component):
 
     solr_retry_timeout = IntOption("search", "retry_timeout", 2,
         doc="""Seconds to wait before retrying an HTTP request to solr (-1 to disable retry)""")
-    
+
+    spool_path = Option("search", "spool_path", "",
+        doc="""Path of a SQLite database in which documents are spooled
+        until Solr has accepted them. Spooled documents survive restarts and
+        Solr outages, they are sent by the next commit or `fulltext index`.
+        A relative path is relative to the environment directory. When empty
+        documents are only queued in memory.
+        """)
+
+    background_indexing = BoolOption("search", "background_indexing",
+        default=True,
+        doc="""Send changed resources to Solr from a background thread, so
+        saving a ticket, wiki page, etc. doesn't wait for Solr. Once
+        `in_memory_queue_size` or `in_memory_queue_bytes` is reached the
+        queue is still sent by whoever changed a resource.
+        """)
+
+    commit_policy = ChoiceOption("search", "commit_policy",
+        ['immediate', 'grouped', 'within', 'soft'],
+        doc="""When to commit changed resources to Solr.
+        `immediate` hard commits every change. `grouped` hard commits
+        changes made within `commit_interval` seconds of each other,
+        or `commit_batch` changes, together. `within` leaves commits to Solr,
+        which commits changes within `commit_within` milliseconds. `soft`
+        groups changes like `grouped` into soft commits, with a hard commit
+        every `hard_commit_interval` seconds. Grouping requires
+        `background_indexing`.
+        """)
+
+    commit_interval = IntOption("search", "commit_interval", 5,
+        doc="""Seconds to wait for more changes before a grouped commit.
+        Also the seconds between commits whilst (re)indexing, after which
+        the progress so far is recorded.""")
+
+    commit_batch = IntOption("search", "commit_batch", 100,
+        doc="""Number of changes which trigger a grouped commit before
+        `commit_interval` has passed""")
+
+    commit_within = IntOption("search", "commit_within", 5000,
+        doc="""Milliseconds within which Solr commits changes, for the
+        `within` commit policy""")
+
+    hard_commit_interval = IntOption("search", "hard_commit_interval", 600,
+        doc="""Minimum seconds between hard commits, for the `soft` commit
+        policy""")
+
+    failure_threshold = IntOption("search", "failure_threshold", 3,
+        doc="""Number of consecutive failures to reach solr, after which it
+        is considered unavailable. Whilst it is, searches use the built-in
+        search sources and items are kept queued, instead of waiting for
+        `http_timeout`.""")
+
+    failure_cooldown = IntOption("search", "failure_cooldown", 10,
+        doc="""Seconds before solr is tried again, after it became
+        unavailable. Doubles every time the retry fails.""")
+
+    max_failure_cooldown = IntOption("search", "max_failure_cooldown", 300,
+        doc="""Maximum seconds before solr is tried again, after it became
+        unavailable""")
+
+    extract_workers = IntOption("search", "extract_workers", 4,
+        doc="""Number of attachments and files sent to Solr in parallel for
+        text extraction. Each keeps a CPU core of the Solr server busy
+        whilst their text is extracted.""")
+
+    extract_max_inflight = IntOption("search", "extract_max_inflight",
+                                     64*2**20, # 64 MB
+        doc="""Maximum total size in bytes of the attachments and files
+        being sent to Solr in parallel""")
+
+    update_format = ChoiceOption("search", "update_format", ['xml', 'json'],
+        doc="""Format in which documents are sent to solr, apart from those
+        solr extracts the text of. `json` is faster to build for large
+        numbers of documents, and requires the `/update/json` request
+        handler.""")
+
+    schema_cache = Option("search", "schema_cache", "",
+        doc="""Path of a file in which the schema fetched from Solr is
+        cached, relative to the environment directory. Empty to only cache
+        the schema in memory, for each process.""")
+
+    schema_cache_ttl = IntOption("search", "schema_cache_ttl", 3600,
+        doc="""Seconds before the cached Solr schema is fetched again. The
+        schema is also fetched again after Solr reports an unknown field.""")
+
+    extract_processes = IntOption("search", "extract_processes", 0,
+        doc="""Number of processes extracting the text of attachments and
+        files before they're sent to solr, for the types there is an
+        extractor for (plain text, HTML, office XML documents, and PDF if
+        `pdftotext` is installed). Others are still extracted by solr.
+        0 to leave all of them to solr.""")
+
+    extract_timeout = IntOption("search", "extract_timeout", 60,
+        doc="""Seconds to wait for the text of the attachments and files
+        sent to solr together to be extracted. Those still being extracted
+        are then left to solr.""")
+
+    extraction_cache = Option("search", "extraction_cache", "",
+        doc="""Directory in which the text extracted from attachments and
+        files is cached, relative to the environment directory. Files whose
+        text is cached are sent to solr as plain text, instead of having
+        solr extract it again, e.g. after `trac-admin fulltext reindex`.
+        Empty to disable the cache.""")
+
+    reindex_throttle = ChoiceOption("search", "reindex_throttle",
+        Throttle.MODES,
+        doc="""How `trac-admin fulltext index` and `reindex` are paced, so
+        they don't slow down searches. One of
+         * `none`: as fast as documents can be built and sent
+         * `bucket`: at most `reindex_docs_per_second` documents and
+           `reindex_bytes_per_second` bytes a second
+         * `adaptive`: as `bucket`, and slowing down whilst solr takes
+           longer than `reindex_target_latency` seconds to answer 5% of
+           the requests adding documents, other than files it extracts
+           the text of
+        """)
+
+    reindex_docs_per_second = FloatOption("search", "reindex_docs_per_second",
+        0,
+        doc="""Documents indexed per second at most, with a throttle. 0 for
+        no limit.""")
+
+    reindex_bytes_per_second = IntOption("search", "reindex_bytes_per_second",
+        0,
+        doc="""Bytes indexed per second at most, with a throttle. 0 for no
+        limit.""")
+
+    reindex_target_latency = FloatOption("search", "reindex_target_latency",
+        0.5,
+        doc="""Seconds solr may take to answer the 95th percentile of
+        requests adding documents before an adaptive throttle slows
+        down.""")
+
+    source_workers = IntOption("search", "source_workers", 4,
+        doc="""Number of threads reading the contents of files, when the
+        latest version of the files in the repositories is indexed by
+        `trac-admin fulltext index source`.""")
+
+    text_extractors = ExtensionPoint(ITextExtractor)
+
     #Warning, sunburnt is case sensitive via lxml on xpath searches while solr is not
     #in the default schema fieldType and fieldtype mismatch gives problem
     def __init__(self):
         self.backend = Backend(self.solr_endpoint,
                                self.log,
+                               si_class=self.update_format == 'json' and
+                                        JsonSolrInterface or SolrInterface,
                                queue_size=self.queue_size,
+                               queue_bytes=self.queue_bytes,
+                               batch_size=self.queue_size,
+                               max_request_bytes=self.max_request_size,
                                solr_retry_timeout=self.solr_retry_timeout,
-                               solr_http_timeout=self.solr_http_timeout)
+                               solr_http_timeout=self.solr_http_timeout,
+                               spool=self._open_spool(),
+                               background=self.background_indexing,
+                               on_commit=self._committed,
+                               on_error=self._failed,
+                               loader=self._load,
+                               commit_policy=CommitPolicy(
+                                   self.commit_policy,
+                                   interval=self.commit_interval,
+                                   batch=self.commit_batch,
+                                   within=self.commit_within,
+                                   hard_interval=self.hard_commit_interval),
+                               schema_cache=self.schema_cache and
+                                   os.path.join(self.env.path,
+                                                self.schema_cache),
+                               schema_ttl=self.schema_cache_ttl,
+                               extract_workers=self.extract_workers,
+                               extract_max_bytes=self.extract_max_inflight,
+                               breaker=CircuitBreaker(
+                                   self.failure_threshold,
+                                   cooldown=self.failure_cooldown,
+                                   max_cooldown=self.max_failure_cooldown),
+                               extractor=self._local_extractor(),
+                               fingerprints=self._get_fingerprints,
+                               extract_cache=self.extraction_cache and
+                                   ExtractionCache(os.path.join(
+                                       self.env.path, self.extraction_cache),
+                                       log=self.log))
         self.project = os.path.split(self.env.path)[1]
         self._realms = [
             (u'ticket',     u'Tickets',      True, self._reindex_ticket,     'TICKET_VIEW'),
             (u'wiki',       u'Wiki',         True, self._reindex_wiki,       'WIKI_VIEW'),
             (u'milestone',  u'Milestones',   True, self._reindex_milestone,  'MILESTONE_VIEW'),
             (u'changeset',  u'Changesets',   True, self._reindex_changeset,  None),
-            (u'source',     u'File archive', True, None,                     None),
+            (u'source',     u'File archive', True, self._reindex_source,     None),
             (u'attachment', u'Attachments',  True, self._reindex_attachment, None),
             ]
         self.indexing_delay = None
@@ -410,13 +1383,42 @@ class FullTextSearch(Component):
             'ChangesetModule': ChangesetModule,
             }
 
+    def _local_extractor(self):
+        if self.extract_processes <= 0:
+            return None
+        extractors = {}
+        for provider in self.text_extractors:
+            for mimetype, extractor in provider.get_text_extractors():
+                extractors.setdefault(mimetype, extractor)
+        return LocalExtractor(extractors, self.extract_processes,
+                              timeout=self.extract_timeout, log=self.log)
+
+    def _throttle(self):
+        """Return the Throttle pacing `_index()`. `indexing_delay` set by
+        `fulltext slowreindex` takes precedence over the options.
+        """
+        if self.indexing_delay:
+            return Throttle('bucket', docs_per_second=1.0 / self.indexing_delay)
+        return Throttle(self.reindex_throttle,
+                        docs_per_second=self.reindex_docs_per_second,
+                        bytes_per_second=self.reindex_bytes_per_second,
+                        latencies=self.backend.latencies,
+                        target_latency=self.reindex_target_latency)
+
+    def _open_spool(self):
+        if not self.spool_path:
+            return MemorySpool()
+        return SqliteSpool(os.path.join(self.env.path, self.spool_path),
+                           self.log)
+
     @property
     def index_realms(self):
         return [name for name, label, enabled, indexer, permission
                      in self._realms if indexer]
 
     def _index(self, realm, resources, check_cb, index_cb,
-               feedback_cb, finish_cb):
+               feedback_cb, finish_cb, since=None, mark=None,
+               statuses=None):
         """Iterate through `resources` to index `realm`, return index count
 
         The actual work of fetching the content and putting it to solr
@@ -428,65 +1430,254 @@ class FullTextSearch(Component):
         
         realm       Trac realm to which items in resources belong
         resources   Iterable of Trac resources e.g. WikiPage, Attachment
-        check_cb    Callable that accepts a resource & status,
-                    returns True if it needs to be indexed
-        index_cb    Callable that accepts a resource, indexes it
+        check_cb    Callable that accepts a resource & IndexStatus (None
+                    if it hasn't been indexed), returns True if it needs
+                    to be indexed
+        index_cb    Callable that accepts a resource, indexes it, and
+                    returns the approximate number of bytes queued
         feedback_cb Callable that accepts a realm & resource argument
         finish_cb   Callable that accepts a realm & resource argument. The
                     resource will be None if no resources are indexed
-
-        See discussion on Backend(Queue) - in future revision, I think
-        _index() should put (action, Resource) into a remote queue -
-        that would mean it can't take the index_cb - the
-        queue-consumer would decide which "extraction" function to use
-        based on the Resource.
+        since       High water mark `resources` were selected with, if any
+                    (see `_high_water_mark()`)
+        mark        Time of the latest change of `resources`, if they are
+                    ordered oldest change first. Recorded as the new high
+                    water mark once all of them are indexed.
+        statuses    IndexStatus of the resources of `realm` keyed by status
+                    id, if the caller has already read them (see
+                    `_get_statuses()`)
+
+        Unlike the change listeners, which queue (action, Resource) and
+        leave it to the queue-consumer to read the resource, _index()
+        queues complete documents: check_cb has already loaded the
+        resources anyway.
 
         """
         i = -1
         resource = None
-        resources = (r for r in resources if check_cb(r, self._get_status(r)))
+        # Read in one go, rather than a query per resource
+        if statuses is None:
+            statuses = self._get_statuses(realm, since)
+        resources = (r for r in resources
+                     if check_cb(r, statuses.get(self._status_id(r))))
+        last_commit = time.time()
+        throttle = self._throttle()
         for i, resource in enumerate(resources):
-            index_cb(resource)
+            nbytes = index_cb(resource)
             feedback_cb(realm, resource)
-            if self.indexing_delay:
-                time.sleep(self.indexing_delay)
+            throttle.wait(nbytes or 0)
+            # Commit now and then, so the status of the resources indexed so
+            # far is recorded, and an interrupted run can carry on from there.
+            # In this thread, rather than starting the background one,
+            # which would leave nothing waiting for Solr.
+            if time.time() - last_commit >= self.commit_interval:
+                self.backend.commit(quiet=True)
+                last_commit = time.time()
         self.backend.commit()
+        if mark is not None:
+            self._set_high_water_mark(realm, mark)
         finish_cb(realm, resource)
         return i + 1
 
-    def _reindex_changeset(self, realm, feedback, finish_fb):
-        """Iterate all changesets and call self.changeset_added on them"""
-        # TODO Multiple repository support
-        repo = self.env.get_repository()
-        def all_revs():
-            rev = repo.oldest_rev
-            yield rev
-            while 1:
-                rev = repo.next_rev(rev)
-                if rev is None:
-                    return
-                yield rev
+    def _reindex_changeset(self, realm, feedback, finish_fb, part=None):
+        """Iterate the changesets of all repositories and index them"""
         def check(changeset, status):
-            return status is None or changeset.date > to_datetime(int(status))
-        resources = (repo.get_changeset(rev) for rev in all_revs())
-        index = partial(self._index_changeset, repo)
+            return status is None or changeset.date != status.changed
+        repositories = sorted(RepositoryManager(self.env)
+                                .get_real_repositories(),
+                              key=operator.attrgetter('reponame'))
+        resources = (changeset for repos in repositories
+                               for changeset in self._all_changesets(repos,
+                                                                     part))
+        index = lambda changeset: self._index_changeset(changeset.repos,
+                                                        changeset)
         return self._index(realm, resources, check, index, feedback, finish_fb)
 
-    def _update_changeset(self, changeset):
-        self._set_status(changeset, to_utimestamp(changeset.date))
+    def _all_changesets(self, repos, part=None):
+        """Iterate all changesets of `repos`, oldest first, or those in
+        `part` (see `_partition()`).
 
-    def _reindex_wiki(self, realm, feedback, finish_fb):
-        def check(page, status):
-            return status is None or page.time > to_datetime(int(status))
-        resources = (WikiPage(self.env, name)
-                     for name in WikiSystem(self.env).get_pages())
-        index = self._index_wiki_page
-        return self._index(realm, resources, check, index, feedback, finish_fb)
-
-    def _update_wiki(self, page):
-        self._set_status(page, to_utimestamp(page.time))
-
-    def _reindex_attachment(self, realm, feedback, finish_fb):
+        Those of cached repositories are read from the cache a chunk at a
+        time, rather than one by one through the version control backend.
+        """
+        if not isinstance(repos, CachedRepository):
+            def all_revs():
+                rev = repos.oldest_rev
+                while rev is not None:
+                    yield rev
+                    rev = repos.next_rev(rev)
+            for rev in _partition(all_revs(), part):
+                yield repos.get_changeset(rev)
+            return
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT rev FROM revision WHERE repos=%s "
+                       "ORDER BY time, rev", (repos.id,))
+        revs = list(_partition((rev for (rev,) in cursor), part))
+        for chunk in grouper(revs, 100):
+            for changeset in self._select_changesets(repos, chunk):
+                yield changeset
+
+    def _select_changesets(self, repos, revs):
+        """Return the changesets `revs` of the cached repository `repos`, as
+        stored in the cache, in the same order.
+        """
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        changes = dict((rev, []) for rev in revs)
+        if self.fulltext_index_svn_nodes:
+            # Adapted from CachedChangeset.get_changes()
+            cursor.execute("SELECT rev,path,node_type,change_type,base_path,"
+                           "       base_rev "
+                           "FROM node_change WHERE repos=%%s AND rev IN %s"
+                           % _sql_in(revs), [repos.id] + list(revs))
+            for row in cursor:
+                changes[row[0]].append(row[1:])
+        cursor.execute("SELECT rev,time,author,message FROM revision "
+                       "WHERE repos=%%s AND rev IN %s" % _sql_in(revs),
+                       [repos.id] + list(revs))
+        rows = dict((row[0], row[1:]) for row in cursor)
+        changesets = []
+        for rev in revs:
+            if rev not in rows:
+                continue
+            t, author, message = rows[rev]
+            changesets.append(_CachedChangeset(repos, repos.rev_db(rev),
+                message, author, from_utimestamp(t),
+                [(path, _kindmap[kind], _actionmap[change], base_path,
+                  repos.rev_db(base_rev))
+                 for path, kind, change, base_path, base_rev
+                 in sorted(changes[rev])]))
+        return changesets
+
+    def _reindex_source(self, realm, feedback, finish_fb, part=None):
+        """Index the latest version of the files and directories in all
+        repositories, if `fulltext_index_svn_nodes` is set.
+        """
+        if not self.fulltext_index_svn_nodes:
+            self.log.info("Not indexing realm %s, fulltext_index_svn_nodes "
+                          "isn't set", realm)
+            return 0
+        statuses = self._get_statuses(realm)
+        def check(so, status):
+            return status is None or so.changed != status.changed
+        repositories = sorted(RepositoryManager(self.env)
+                                .get_real_repositories(),
+                              key=operator.attrgetter('reponame'))
+        resources = (so for repos in repositories
+                        for so in self._snapshot(repos, statuses, part))
+        index = lambda so: self._queue([so])
+        return self._index(realm, resources, check, index, feedback, finish_fb,
+                           statuses=statuses)
+
+    def _snapshot(self, repos, statuses, part=None):
+        """Iterate the documents of the latest version of the files and
+        directories in `repos`, or those in `part` (see `_partition()`),
+        except those which haven't changed since `statuses`.
+
+        The contents of the files are read by `source_workers` threads,
+        rather than every version of them by replaying the changesets.
+        Each thread reads from a repository object of its own, as
+        RepositoryManager keeps one per thread.
+        """
+        manager = RepositoryManager(self.env)
+        reponame = repos.reponame
+        rev = repos.youngest_rev
+        workers = max(self.source_workers, 1)
+        # Bounded, so at most this many documents are held at once
+        paths = Queue(workers * 2)
+        results = Queue(workers * 2)
+        stopping = threading.Event()
+
+        def walk():
+            try:
+                walker = manager.get_repository(reponame)
+                root = walker.get_node('', rev)
+                for node in _partition(_walk_nodes(root), part):
+                    if stopping.is_set():
+                        break
+                    status = statuses.get(self._status_id(node))
+                    if status is None or \
+                            node.get_last_modified() != status.changed:
+                        paths.put(node.path)
+            except Exception, e:
+                results.put(e)
+            finally:
+                for i in xrange(workers):
+                    paths.put(None)
+                manager.shutdown(threading._get_ident())
+
+        def fetch():
+            changesets = {}
+            try:
+                reader = manager.get_repository(reponame)
+                for path in iter(paths.get, None):
+                    if stopping.is_set():
+                        continue
+                    node = reader.get_node(path, rev)
+                    if node.rev not in changesets:
+                        changesets[node.rev] = reader.get_changeset(node.rev)
+                    results.put(self._build_node(node, changesets[node.rev]))
+            except Exception, e:
+                results.put(e)
+                stopping.set()
+                # Let the walker finish
+                for path in iter(paths.get, None):
+                    pass
+            finally:
+                results.put(None)
+                manager.shutdown(threading._get_ident())
+
+        threads = [threading.Thread(target=walk,
+                                    name='FullTextSearch source walker')]
+        threads.extend(threading.Thread(target=fetch,
+                                        name='FullTextSearch source %d' % n)
+                       for n in xrange(workers))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        finished = 0
+        try:
+            while finished < workers:
+                result = results.get()
+                if result is None:
+                    finished += 1
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    yield result
+        finally:
+            # Unblock the threads if iteration stopped early
+            stopping.set()
+            while finished < workers:
+                if results.get() is None:
+                    finished += 1
+            for thread in threads:
+                thread.join()
+
+    def _reindex_wiki(self, realm, feedback, finish_fb, part=None):
+        since = self._high_water_mark(realm)
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        # Oldest change first, see _high_water_mark()
+        cursor.execute("SELECT name, MAX(time) FROM wiki GROUP BY name "
+                       "HAVING MAX(time) >= %s ORDER BY MAX(time), name",
+                       (to_utimestamp(since) if since else 0,))
+        rows = cursor.fetchall()
+        # Parts are indexed separately, none of them sees all changes
+        mark = (rows and part is None and from_utimestamp(rows[-1][1])
+                or None)
+        names = list(_partition((name for name, t in rows), part))
+        def check(so, status):
+            return status is None or so.changed != status.changed
+        # Built a chunk at a time, rather than with queries per page
+        resources = (so for chunk in grouper(names, 100)
+                        for so in self._build_wiki_pages(realm, chunk))
+        index = lambda so: self._queue([so])
+        return self._index(realm, resources, check, index, feedback, finish_fb,
+                           since, mark)
+
+    def _reindex_attachment(self, realm, feedback, finish_fb, part=None):
         db = self.env.get_read_db()
         cursor = db.cursor()
         # This plugin was originally written for #define 4, a Trac derivative
@@ -524,35 +1715,45 @@ class FullTextSearch(Component):
             attachment._from_database(*row[2:])
             return attachment
         def check(attachment, status):
-            return (status is None
-                    or attachment.date > to_datetime(int(status)))
-        resources = (att(row) for row in cursor)
+            return status is None or attachment.date != status.changed
+        resources = (att(row) for row in _partition(cursor, part))
         index = self._index_attachment
         return self._index(realm, resources, check, index, feedback, finish_fb)
 
-    def _update_attachment(self, attachment):
-        self._set_status(attachment, to_utimestamp(attachment.date))
-
-    def _reindex_ticket(self, realm, feedback, finish_fb):
+    def _reindex_ticket(self, realm, feedback, finish_fb, part=None):
+        since = self._high_water_mark(realm)
         db = self.env.get_read_db()
         cursor = db.cursor()
-        cursor.execute("SELECT id FROM ticket")
-        def check(ticket, status):
-            return (status is None
-                    or ticket.values['changetime'] > to_datetime(int(status)))
-        resources = (Ticket(self.env, tkt_id) for (tkt_id,) in cursor)
-        index = self._index_ticket
-        return self._index(realm, resources, check, index, feedback, finish_fb)
-
-    def _update_ticket(self, ticket):
-        self._set_status(ticket, to_utimestamp(ticket.values['changetime']))
-
-    def _reindex_milestone(self, realm, feedback, finish_fb):
-        resources = Milestone.select(self.env)
-        def check(milestone, check):
-            return True
-        index = self._index_milestone
-        return self._index(realm, resources, check, index, feedback, finish_fb)
+        # Oldest change first, see _high_water_mark()
+        cursor.execute("SELECT id, changetime FROM ticket "
+                       "WHERE changetime >= %s ORDER BY changetime, id",
+                       (to_utimestamp(since) if since else 0,))
+        rows = cursor.fetchall()
+        # Parts are indexed separately, none of them sees all changes
+        mark = (rows and part is None and from_utimestamp(rows[-1][1])
+                or None)
+        ids = list(_partition((tkt_id for tkt_id, t in rows), part))
+        def check(so, status):
+            return status is None or so.changed != status.changed
+        # Built a chunk at a time, rather than with queries per ticket
+        resources = (so for chunk in grouper(ids, 100)
+                        for so in self._build_tickets(chunk))
+        index = lambda so: self._queue([so])
+        return self._index(realm, resources, check, index, feedback, finish_fb,
+                           since, mark)
+
+    def _reindex_milestone(self, realm, feedback, finish_fb, part=None):
+        statuses = self._get_statuses(realm)
+        def check(so, status):
+            # Milestones don't record when they were changed
+            return status is None or status.fingerprint != so.fingerprint()
+        milestones = _partition(Milestone.select(self.env), part)
+        resources = (self._build_milestone(milestone,
+                         statuses.get(self._status_id(milestone)))
+                     for milestone in milestones)
+        index = lambda so: self._queue([so])
+        return self._index(realm, resources, check, index, feedback, finish_fb,
+                           statuses=statuses)
 
     def _check_realms(self, realms):
         """Check specfied realms are supported by this component
@@ -580,10 +1781,21 @@ class FullTextSearch(Component):
             cursor = db.cursor()
             self.backend.remove(self.project, realms)
             self.backend.commit()
-            cursor.executemany("DELETE FROM system WHERE name LIKE %s",
-                               [('fulltextsearch_%s:%%' % r,) for r in realms])
-
-    def index(self, realms=None, clean=False, feedback=None, finish_fb=None):
+            cursor.execute("DELETE FROM fulltextsearch_status "
+                           "WHERE realm IN %s" % _sql_in(realms), tuple(realms))
+            cursor.execute("DELETE FROM fulltextsearch_failed "
+                           "WHERE realm IN %s" % _sql_in(realms), tuple(realms))
+            cursor.execute("DELETE FROM fulltextsearch_mark "
+                           "WHERE realm IN %s" % _sql_in(realms), tuple(realms))
+
+    def index(self, realms=None, clean=False, feedback=None, finish_fb=None,
+              jobs=1):
+        """Index `realms`, all of them by default, return the number of
+        resources indexed in each of them.
+
+        With `jobs` greater than 1, each realm is split into that many parts,
+        which are indexed by as many worker processes.
+        """
         realms = self._check_realms(realms)
         feedback = feedback or _do_nothing
         finish_fb = finish_fb or _do_nothing
@@ -592,30 +1804,95 @@ class FullTextSearch(Component):
             self.remove_index(realms)
         self.log.info("Started indexing realms: %s",
                       self._fmt_realms(realms))
-        summary = {}
-        for realm in realms:
-            indexer = self._indexers[realm]
-            try:
-                num_indexed = indexer(realm, feedback, finish_fb)
-                self.log.debug('Indexed %i resources in realm: "%s"',
-                               num_indexed, realm)
-                summary[realm] = num_indexed
-            except (TracError, NotImplementedError, ValueError, AttributeError, 
-                    PermissionError):
-                # Explicitly catches potential exceptions that can be raised 
-                #when trying to index a realm. Most of them derives from 
-                #TracError, for for example ResourceNotFound.
-                if self.stop_on_error:
-                    raise
-                else:
-                    self.log.exception('Failed to index realm: %s', realm)
-                    continue
+        if jobs > 1:
+            summary = self._index_parallel(realms, jobs, feedback, finish_fb)
+        else:
+            summary = {}
+            for realm in realms:
+                num_indexed = self._index_realm(realm, feedback, finish_fb)
+                if num_indexed is not None:
+                    summary[realm] = num_indexed
 
         self.log.info("Completed indexing realms: %s",
                       ', '.join('%s (%i)' % (r, summary[r]) for r in realms 
                                 if r in summary))
         return summary
 
+    def _index_realm(self, realm, feedback, finish_fb, part=None):
+        """Index `realm`, or `part` of it (see `_partition()`), return the
+        number of resources indexed, or None if it failed.
+        """
+        indexer = self._indexers[realm]
+        try:
+            num_indexed = indexer(realm, feedback, finish_fb, part=part)
+            self.log.debug('Indexed %i resources in realm: "%s"',
+                           num_indexed, realm)
+            return num_indexed
+        except (TracError, NotImplementedError, ValueError, AttributeError, 
+                PermissionError):
+            # Explicitly catches potential exceptions that can be raised 
+            #when trying to index a realm. Most of them derives from 
+            #TracError, for for example ResourceNotFound.
+            if self.stop_on_error:
+                raise
+            else:
+                self.log.exception('Failed to index realm: %s', realm)
+                return None
+
+    def _index_parallel(self, realms, jobs, feedback, finish_fb):
+        """Index `realms` in `jobs` worker processes, return the summary.
+
+        Each realm is split into `jobs` parts, interleaved rather than
+        ranges, so the workers index a realm oldest change first together.
+        The workers open the environment again, and report the resources
+        they index back to `feedback`.
+
+        The high water marks are left as they were: the parts are selected
+        and committed independently, so a resource which changed while
+        they were selected may belong to none of them.
+        """
+        # Fork the workers without any thread using the database, nor pooled
+        # connections for them to share
+        self.backend.stop()
+        DatabaseManager(self.env).shutdown()
+        feedback_queue = multiprocessing.Queue()
+        def report():
+            while True:
+                try:
+                    realm, resource = feedback_queue.get_nowait()
+                except Empty:
+                    return
+                feedback(realm, _resource_from_tuple(resource))
+        tasks = [(realm, (i, jobs)) for realm in realms for i in xrange(jobs)]
+        remaining = dict((realm, jobs) for realm in realms)
+        summary = {}
+        pool = multiprocessing.Pool(jobs, _init_index_worker,
+                                    (self.env.path, feedback_queue))
+        try:
+            results = pool.imap_unordered(_index_part, tasks)
+            done = 0
+            while done < len(tasks):
+                report()
+                try:
+                    realm, num_indexed = results.next(0.1)
+                except multiprocessing.TimeoutError:
+                    continue
+                done += 1
+                if num_indexed is not None:
+                    summary[realm] = summary.get(realm, 0) + num_indexed
+                remaining[realm] -= 1
+                if not remaining[realm]:
+                    report()
+                    finish_fb(realm, None)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        report()
+        return summary
+
     def optimize(self):
         self.log.info("Started optimizing index")
         self.backend.optimize()
@@ -627,54 +1904,360 @@ class FullTextSearch(Component):
 
     # IEnvironmentSetupParticipant methods
     def environment_created(self):
-        pass
+        @self.env.with_transaction()
+        def do_create(db):
+            self.upgrade_environment(db)
 
     def environment_needs_upgrade(self, db):
-        pass
+        return self._get_db_version(db) < DB_VERSION
 
     def upgrade_environment(self, db):
-        pass
+        version = self._get_db_version(db)
+        if version < 1:
+            create_tables(self.env, db, [FAILED_TABLE])
+        if version < 2:
+            create_tables(self.env, db, [STATUS_TABLE])
+            self._migrate_statuses(db)
+        if version < 3:
+            create_tables(self.env, db, [MARK_TABLE])
+        cursor = db.cursor()
+        if version:
+            cursor.execute("UPDATE system SET value=%s WHERE name=%s",
+                           (str(DB_VERSION), DB_NAME))
+        else:
+            cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                           (DB_NAME, str(DB_VERSION)))
+        self.log.info("Upgraded full text search tables from version %d to "
+                      "%d", version, DB_VERSION)
+
+    def _migrate_statuses(self, db):
+        '''Move the index status of resources from the system table to
+        fulltextsearch_status.
+        '''
+        cursor = db.cursor()
+        cursor.execute("SELECT name, value FROM system WHERE name LIKE %s",
+                       ('fulltextsearch_%:%',))
+        rows = []
+        for name, value in cursor.fetchall():
+            doc_id = name[len('fulltextsearch_'):]
+            try:
+                status = _parse_status(value)
+            except ValueError:
+                continue
+            rows.append((doc_id,) + _parse_res_id(doc_id)
+                        + (to_utimestamp(status.changed), status.fingerprint))
+        cursor.executemany("INSERT INTO fulltextsearch_status "
+                           "(doc_id, realm, id, parent_realm, parent_id, "
+                           " changed, fingerprint, state) "
+                           "VALUES (%s, %s, %s, %s, %s, %s, %s, 'indexed')",
+                           rows)
+        cursor.execute("DELETE FROM system WHERE name LIKE %s",
+                       ('fulltextsearch_%:%',))
+        self.log.info("Migrated the index status of %d resources", len(rows))
+
+    def _get_db_version(self, db):
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM system WHERE name=%s", (DB_NAME,))
+        row = cursor.fetchone()
+        return int(row[0]) if row else 0
 
     # Index status helpers
     def _get_status(self, resource):
-        '''Return index status of `resource`, or None if nothing is recorded.
+        '''Return the IndexStatus of `resource`, or None if nothing is
+        recorded.
         '''
         db = self.env.get_read_db()
         cursor = db.cursor()
-        cursor.execute("SELECT value FROM system WHERE name = %s",
-                       (self._status_id(resource),))
+        cursor.execute("SELECT changed, fingerprint FROM fulltextsearch_status "
+                       "WHERE doc_id = %s", (self._status_id(resource),))
         row = cursor.fetchone()
         if row:
-            return row[0]
+            return IndexStatus(row[0] and from_utimestamp(row[0]), row[1])
         else:
             return None
 
-    def _set_status(self, resource, status):
+    def _get_statuses(self, realm, since=None):
+        '''Return the IndexStatus of every resource recorded in `realm`,
+        keyed by status id (see `_status_id()`). With `since`, only of those
+        which changed since then.
+        '''
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        sql = ("SELECT doc_id, changed, fingerprint "
+               "FROM fulltextsearch_status WHERE realm = %s")
+        args = (realm,)
+        if since:
+            sql += " AND changed >= %s"
+            args += (to_utimestamp(since),)
+        cursor.execute(sql, args)
+        return dict((doc_id, IndexStatus(changed and from_utimestamp(changed),
+                                         fingerprint))
+                    for doc_id, changed, fingerprint in cursor)
+
+    def _high_water_mark(self, realm):
+        '''Return the time of the latest change seen by the last complete
+        run of `_index()` over `realm`, or None to check all of it.
+
+        Resources are indexed oldest change first, and the mark is only
+        recorded once all of them are, so everything that changed before
+        it has been indexed, and only those which changed since need to be
+        checked. An interrupted run leaves the mark where it was. The
+        statuses the change listeners record don't move it, as resources
+        they never saw may be older. Resources restored with older
+        timestamps are missed though, `fulltext reindex` catches those.
+        '''
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT changed FROM fulltextsearch_mark "
+                       "WHERE realm = %s", (realm,))
+        row = cursor.fetchone()
+        return row and row[0] and from_utimestamp(row[0]) or None
+
+    def _set_high_water_mark(self, realm, changed):
+        '''Record `changed` as the high water mark of `realm`.'''
+        @self.env.with_transaction()
+        def do_update(db):
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM fulltextsearch_mark WHERE realm = %s",
+                           (realm,))
+            cursor.execute("INSERT INTO fulltextsearch_mark (realm, changed) "
+                           "VALUES (%s, %s)", (realm, to_utimestamp(changed)))
+
+    def _get_fingerprints(self, resources):
+        '''Return the fingerprints of the documents last committed for
+        `resources`, keyed by resource id.
+        '''
+        doc_ids = list(set(self._status_id(r) for r in resources))
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        fingerprints = {}
+        for i in xrange(0, len(doc_ids), 100):
+            chunk = doc_ids[i:i + 100]
+            cursor.execute("SELECT doc_id, fingerprint "
+                           "FROM fulltextsearch_status WHERE doc_id IN %s"
+                           % _sql_in(chunk), chunk)
+            fingerprints.update((doc_id, fingerprint)
+                                for doc_id, fingerprint in cursor
+                                if fingerprint)
+        return fingerprints
+
+    def _set_status(self, resource, changed, fingerprint=None):
         '''Save the index status of a resource'''
+        self._set_statuses([(resource, IndexStatus(changed, fingerprint))])
+
+    def _clear_status(self, resource):
+        '''Forget the index status of a resource'''
+        self._set_statuses([(resource, None)])
+
+    def _set_statuses(self, items):
+        '''Save the index status of (resource, IndexStatus) items in a single
+        transaction. Statuses which are None are forgotten.
+        '''
+        # Only the last status of a resource counts
+        statuses = OrderedDict()
+        for resource, status in items:
+            resource = getattr(resource, 'resource', resource)
+            statuses.pop(_res_id(resource), None)
+            statuses[_res_id(resource)] = (resource, status)
+        now = to_utimestamp(datetime.now(utc))
+        rows = []
+        for doc_id, (resource, status) in statuses.iteritems():
+            if status is None:
+                continue
+            parent = resource.parent
+            rows.append((doc_id, resource.realm, unicode(resource.id),
+                         parent and parent.realm,
+                         parent and unicode(parent.id),
+                         status.changed and to_utimestamp(status.changed),
+                         status.fingerprint, now))
         @self.env.with_transaction()
         def do_update(db):
             cursor = db.cursor()
-            row = (str(status), self._status_id(resource))
             # TODO use try/except, but take care with psycopg2 and rollbacks
-            cursor.execute("DELETE FROM system WHERE name = %s", row[1:])
-            cursor.execute("INSERT INTO system (value, name) VALUES (%s, %s)",
-                           row)
+            cursor.executemany("DELETE FROM fulltextsearch_status "
+                               "WHERE doc_id = %s",
+                               [(doc_id,) for doc_id in statuses])
+            cursor.executemany("INSERT INTO fulltextsearch_status "
+                               "(doc_id, realm, id, parent_realm, parent_id, "
+                               " changed, fingerprint, state, indexed) "
+                               "VALUES (%s, %s, %s, %s, %s, %s, %s, "
+                               "        'indexed', %s)", rows)
 
     def _status_id(self, resource):
-        return 'fulltextsearch_%s' % _res_id(resource.resource)
+        '''Return the status key of `resource`, a Trac model object such as
+        Ticket or WikiPage, or a Resource.
+        '''
+        return _res_id(getattr(resource, 'resource', resource))
+
+    def _committed(self, items):
+        '''Record the index status of items committed by the backend, a
+        batch at a time.
+        '''
+        statuses = []
+        for action, resource, changed, fingerprint in items:
+            if action == 'DELETE':
+                statuses.append((resource, None))
+            elif changed or fingerprint:
+                statuses.append((resource, IndexStatus(changed, fingerprint)))
+        @self.env.with_transaction()
+        def do_update(db):
+            self._set_statuses(statuses)
+            self._clear_failed([item[1] for item in items])
+
+    # Failed documents helpers
+    def _failed(self, items):
+        '''Record (action, resource, error) items Solr rejected, so they can
+        be retried with `retry_failed()`.
+        '''
+        now = to_utimestamp(datetime.now(utc))
+        @self.env.with_transaction()
+        def do_record(db):
+            cursor = db.cursor()
+            for action, resource, error in items:
+                doc_id = _res_id(resource)
+                cursor.execute("UPDATE fulltextsearch_status "
+                               "SET state='failed' WHERE doc_id=%s",
+                               (doc_id,))
+                cursor.execute("UPDATE fulltextsearch_failed "
+                               "SET action=%s, error=%s, "
+                               "attempts=attempts+1, time=%s "
+                               "WHERE doc_id=%s",
+                               (action, error, now, doc_id))
+                if cursor.rowcount:
+                    continue
+                parent = resource.parent
+                cursor.execute("INSERT INTO fulltextsearch_failed "
+                               "(doc_id, realm, id, parent_realm, parent_id, "
+                               " action, error, attempts, time) "
+                               "VALUES (%s, %s, %s, %s, %s, %s, %s, 1, %s)",
+                               (doc_id, resource.realm,
+                                unicode(resource.id),
+                                parent and parent.realm,
+                                parent and unicode(parent.id),
+                                action, error, now))
+
+    def _clear_failed(self, resources):
+        '''Forget failures of `resources`, e.g. as they have been indexed.
+        '''
+        @self.env.with_transaction()
+        def do_delete(db):
+            cursor = db.cursor()
+            cursor.executemany("DELETE FROM fulltextsearch_failed "
+                               "WHERE doc_id=%s",
+                               [(_res_id(r),) for r in resources])
+
+    def get_failed(self, realms=None):
+        '''Yield (resource, action, error, attempts, time) of the documents
+        Solr rejected, oldest first.
+        '''
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        sql = ("SELECT realm, id, parent_realm, parent_id, action, error, "
+               "attempts, time FROM fulltextsearch_failed")
+        args = ()
+        if realms:
+            sql += " WHERE realm IN %s" % _sql_in(realms)
+            args = tuple(realms)
+        cursor.execute(sql + " ORDER BY time, doc_id", args)
+        for (realm, id, parent_realm, parent_id, action, error, attempts,
+             time_) in cursor.fetchall():
+            parent = parent_realm and Resource(parent_realm, parent_id)
+            yield (Resource(realm, id, parent=parent), action, error,
+                   attempts, from_utimestamp(time_))
+
+    def retry_failed(self, realms=None, feedback=None):
+        '''Queue the documents Solr rejected again, and commit them in
+        batches of `in_memory_queue_size`. Return the number of documents
+        retried. Those rejected again remain recorded, with an increased
+        number of attempts.
+        '''
+        feedback = feedback or _do_nothing
+        failed = list(self.get_failed(realms and self._check_realms(realms)))
+        for i, (resource, action, error, attempts, time_) \
+                in enumerate(failed):
+            if action == 'DELETE':
+                self.backend.delete(resource, quiet=True)
+            else:
+                self.backend.create(resource, quiet=True)
+            feedback(resource.realm, resource)
+            if (i + 1) % self.queue_size == 0:
+                self.backend.commit(hard=True)
+        self.backend.commit(hard=True)
+        return len(failed)
+
+    # Document builders
+    def _load(self, action, resource):
+        """Return the documents to send to Solr for a queued `resource`.
+
+        Called by the backend as it flushes, so the database and repository
+        are only read once the documents are about to be sent.
+        """
+        if action == 'DELETE':
+            return [FullTextSearchObject(self.project, resource)]
+        realm = resource.realm
+        try:
+            if realm == 'ticket':
+                return [self._build_ticket(Ticket(self.env, resource.id))]
+            elif realm == 'wiki':
+                page = WikiPage(self.env, resource.id)
+                if not page.exists:
+                    raise ResourceNotFound(resource.id)
+                return [self._build_wiki_page(page)]
+            elif realm == 'attachment':
+                attachment = Attachment(self.env, resource(version=None))
+                return [self._build_attachment(attachment)]
+            elif realm == 'milestone':
+                return [self._build_milestone(Milestone(self.env,
+                                                        resource.id))]
+            elif realm == 'changeset':
+                reponame = resource.parent and resource.parent.id or ''
+                repos = RepositoryManager(self.env).get_repository(reponame)
+                if repos is None:
+                    raise ResourceNotFound(reponame)
+                changeset = repos.get_changeset(resource.id)
+                return self._build_changeset(repos, changeset)
+            elif realm == 'source':
+                reponame = resource.parent and resource.parent.id or ''
+                repos = RepositoryManager(self.env).get_repository(reponame)
+                if repos is None:
+                    raise ResourceNotFound(reponame)
+                node = repos.get_node(resource.id)
+                changeset = repos.get_changeset(node.rev)
+                return [self._build_node(node, changeset)]
+        except ResourceNotFound:
+            # Deleted after it was queued, the deletion is queued as well
+            self.log.debug("Resource %s no longer exists, not indexing it",
+                           resource)
+            return []
+        self.log.error("Unknown realm %s queued for indexing", realm)
+        return []
+
+    def _queue(self, docs):
+        """Queue `docs`, return their approximate size in bytes."""
+        nbytes = 0
+        for so in docs:
+            if so.action == 'DELETE':
+                self.backend.delete(so, quiet=True)
+            else:
+                nbytes += _doc_size(so)
+                self.backend.create(so, quiet=True)
+        return nbytes
 
     # ITicketChangeListener methods
     def ticket_created(self, ticket):
-        self._index_ticket(ticket)
-        if self.backend.commit():
-            self._update_ticket(ticket)
-        
+        self.backend.create(ticket.resource, quiet=True)
+        self.backend.request_commit()
+        self.log.debug("Ticket added for indexing: %s", ticket)
+
     def _index_ticket(self, ticket):
+        return self._queue([self._build_ticket(ticket)])
+
+    def _build_ticket(self, ticket):
         ticketsystem = TicketSystem(self.env)
         resource_name = get_resource_shortname(self.env, ticket.resource)
         resource_desc = ticketsystem.get_resource_description(ticket.resource,
                                                               format='summary')
-        so = FullTextSearchObject(
+        return FullTextSearchObject(
                 self.project, ticket.resource,
                 title = u"%(title)s: %(message)s" % {'title': resource_name,
                                                      'message': resource_desc},
@@ -687,33 +2270,118 @@ class FullTextSearch(Component):
                 popularity = 0, #FIXME
                 oneline = shorten_result(ticket.values.get('description', '')),
                 body = u'%r' % (ticket.values,),
-                comments = [t[4] for t in ticket.get_changelog()],
+                comments = _changelog_comments(
+                    (to_utimestamp(t), permanent, author, field, oldvalue,
+                     newvalue)
+                    for t, author, field, oldvalue, newvalue, permanent
+                    in ticket.get_changelog()),
                 )
-        self.backend.create(so, quiet=True)
-        self.log.debug("Ticket added for indexing: %s", ticket)
-        
+
+    def _build_tickets(self, ids):
+        """Return the documents of the tickets `ids`, as `_build_ticket()`
+        would, but reading them with a few queries for all of them.
+        Tickets which don't exist are skipped.
+        """
+        ticketsystem = TicketSystem(self.env)
+        fields = ticketsystem.get_ticket_fields()
+        std_fields = [f['name'] for f in fields if not f.get('custom')]
+        custom_fields = set(f['name'] for f in fields if f.get('custom'))
+        time_fields = set(f['name'] for f in fields if f['type'] == 'time')
+        ids = [int(tkt_id) for tkt_id in ids]
+        if not ids:
+            return []
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        # Adapted from Ticket._fetch_ticket()
+        cursor.execute("SELECT id,%s FROM ticket WHERE id IN %s"
+                       % (','.join(std_fields), _sql_in(ids)), ids)
+        values = {}
+        for row in cursor:
+            ticket_values = values[row[0]] = {}
+            for field, value in zip(std_fields, row[1:]):
+                if field in time_fields:
+                    ticket_values[field] = from_utimestamp(value)
+                elif value is None:
+                    ticket_values[field] = empty
+                else:
+                    ticket_values[field] = value
+        cursor.execute("SELECT ticket,name,value FROM ticket_custom "
+                       "WHERE ticket IN %s ORDER BY ticket,name"
+                       % _sql_in(ids), ids)
+        for tkt_id, name, value in cursor:
+            if tkt_id in values and name in custom_fields:
+                values[tkt_id][name] = empty if value is None else value
+        # Adapted from Ticket.get_changelog()
+        changelogs = dict((tkt_id, []) for tkt_id in values)
+        cursor.execute("SELECT ticket,time,author,field,oldvalue,newvalue "
+                       "FROM ticket_change WHERE ticket IN %s"
+                       % _sql_in(ids), ids)
+        for tkt_id, t, author, field, oldvalue, newvalue in cursor:
+            if tkt_id in changelogs:
+                changelogs[tkt_id].append((t, 1, author, field,
+                                           oldvalue or '', newvalue or ''))
+        sids = [str(tkt_id) for tkt_id in ids]
+        cursor.execute("SELECT id,time,author,filename,description "
+                       "FROM attachment WHERE type='ticket' AND id IN %s"
+                       % _sql_in(sids), sids)
+        for sid, t, author, filename, description in cursor:
+            changelog = changelogs.get(int(sid))
+            if changelog is not None:
+                changelog.append((t, 0, author, 'attachment', '',
+                                  filename or ''))
+                changelog.append((t, 0, author, 'comment', '',
+                                  description or ''))
+        docs = []
+        for tkt_id in ids:
+            if tkt_id not in values:
+                continue
+            ticket_values = values[tkt_id]
+            resource = Resource('ticket', tkt_id)
+            summary = ticketsystem.format_summary(
+                            *[ticket_values.get(f) for f in
+                              ('summary', 'status', 'resolution', 'type')])
+            docs.append(FullTextSearchObject(
+                self.project, resource,
+                title = u"%(title)s: %(message)s" % {
+                            'title': get_resource_shortname(self.env,
+                                                            resource),
+                            'message': summary},
+                author = ticket_values.get('reporter'),
+                changed = ticket_values.get('changetime'),
+                created = ticket_values.get('time'),
+                tags = ticket_values.get('keywords'),
+                involved = re.split(r'[;,\s]+', ticket_values.get('cc', ''))
+                           or ticket_values.get('reporter'),
+                popularity = 0, #FIXME
+                oneline = shorten_result(ticket_values.get('description',
+                                                           '')),
+                body = u'%r' % (ticket_values,),
+                comments = _changelog_comments(changelogs[tkt_id]),
+                ))
+        return docs
+
     def ticket_changed(self, ticket, comment, author, old_values):
-        self._index_ticket(ticket)
-        if self.backend.commit():
-            self._update_ticket(ticket)
-        self.log.debug("Ticket updated: %s", ticket)            
+        self.backend.create(ticket.resource, quiet=True)
+        self.backend.request_commit()
+        self.log.debug("Ticket updated: %s", ticket)
 
     def ticket_deleted(self, ticket):
-        so = FullTextSearchObject(self.project, ticket.resource)
-        self.backend.delete(so, quiet=True)
-        if self.backend.commit():
-            self._update_ticket(ticket)
+        self.backend.delete(ticket.resource, quiet=True)
+        self.backend.request_commit()
         self.log.debug("Ticket deleted; deleting from index: %s", ticket)
 
     #IWikiChangeListener methods
     def wiki_page_added(self, page):
-        self._index_wiki_page(page)
-        if self.backend.commit():
-            self._update_wiki(page)
+        self.backend.create(page.resource, quiet=True)
+        self.backend.request_commit()
+        self.log.debug("WikiPage created for indexing: %s", page.name)
 
     def _index_wiki_page(self, page):
+        return self._queue([self._build_wiki_page(page)])
+
+    def _build_wiki_page(self, page):
         history = list(page.get_history())
-        so = FullTextSearchObject(
+        return FullTextSearchObject(
                 self.project, page.resource,
                 title = u'%s: %s' % (page.name, shorten_line(page.text)),
                 author = page.author,
@@ -726,39 +2394,83 @@ class FullTextSearch(Component):
                 body = page.text,
                 comments = [r[3] for r in history],
                 )
-        self.backend.create(so, quiet=True)
-        self.log.debug("WikiPage created for indexing: %s", page.name)
+
+    def _build_wiki_pages(self, realm, names):
+        """Return the documents of the latest versions of the wiki pages
+        `names`, as `_build_wiki_page()` would, but reading them with a few
+        queries for all of them. Pages which don't exist are skipped.
+        """
+        if not names:
+            return []
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        # Like WikiPage.get_history(), newest version first
+        cursor.execute("SELECT name,version,time,author,comment FROM wiki "
+                       "WHERE name IN %s ORDER BY name, version DESC"
+                       % _sql_in(names), names)
+        histories = {}
+        for name, version, t, author, comment in cursor:
+            histories.setdefault(name, []).append(
+                (version, from_utimestamp(t), author, comment))
+        cursor.execute("SELECT w.name,w.text FROM wiki w "
+                       "JOIN (SELECT name AS c_name, MAX(version) AS c_version "
+                       "      FROM wiki WHERE name IN %s GROUP BY name) c "
+                       "     ON w.name = c_name AND w.version = c_version"
+                       % _sql_in(names), names)
+        texts = dict(cursor)
+        tags = self._select_tags(realm, names)
+        docs = []
+        for name in names:
+            history = histories.get(name)
+            if not history or name not in texts:
+                continue
+            text = texts[name]
+            docs.append(FullTextSearchObject(
+                self.project, Resource(realm, name),
+                title = u'%s: %s' % (name, shorten_line(text)),
+                author = history[0][2],
+                changed = history[0][1],
+                created = history[-1][1], # .time of oldest version
+                tags = tags.get(name, []),
+                involved = list(set(r[2] for r in history)),
+                popularity = 0, #FIXME
+                oneline = shorten_result(text),
+                body = text,
+                comments = [r[3] for r in history],
+                ))
+        return docs
 
     def wiki_page_changed(self, page, version, t, comment, author, ipnr):
-        self._index_wiki_page(page)
-        if self.backend.commit():
-            self._update_wiki(page)
+        self.backend.create(page.resource, quiet=True)
+        self.backend.request_commit()
 
     def wiki_page_deleted(self, page):
-        so = FullTextSearchObject(self.project, page.resource)
-        self.backend.delete(so, quiet=True)
-        if self.backend.commit():
-            self._update_wiki(page)
+        self.backend.delete(page.resource, quiet=True)
+        self.backend.request_commit()
 
     def wiki_page_version_deleted(self, page):
         #We don't care about old versions
         pass
 
-    def wiki_page_renamed(self, page, old_name): 
-        so = FullTextSearchObject(self.project, page.resource.realm, old_name)
-        self.backend.delete(so, quiet=True)
-        self._index_wiki_page(page)
-        if self.backend.commit():
-            self._update_wiki(page)
+    def wiki_page_renamed(self, page, old_name):
+        self.backend.delete(page.resource(id=old_name), quiet=True)
+        self.backend.create(page.resource, quiet=True)
+        self.backend.request_commit()
 
     def _page_tags(self, realm, page):
+        return self._select_tags(realm, [page]).get(page, [])
+
+    def _select_tags(self, realm, names):
+        """Return the tags of the resources `names` of `realm`, as sorted
+        lists keyed by name. Resources without tags are left out.
+        """
         db = self.env.get_read_db()
         cursor = db.cursor()
         try:
-            cursor.execute('SELECT tag FROM tags '
-                           'WHERE tagspace=%s AND name=%s '
-                           'ORDER BY tag',
-                           (realm, page))
+            cursor.execute('SELECT name, tag FROM tags '
+                           'WHERE tagspace=%%s AND name IN %s '
+                           'ORDER BY name, tag' % _sql_in(names),
+                           [realm] + list(names))
         except Exception, e:
             # Prior to Trac 0.13 errors from a wrapped cursor are returned as
             # the native exceptions from the database library 
@@ -773,19 +2485,24 @@ class FullTextSearch(Component):
             if e.__class__.__name__ in ('ProgrammingError',
                                         'OperationalError'):
                 db.rollback()
-                return iter([])
+                return {}
             else:
                 raise e
-        return (tag for (tag,) in cursor)
+        tags = {}
+        for name, tag in cursor:
+            tags.setdefault(name, []).append(tag)
+        return tags
 
     #IAttachmentChangeListener methods
     def attachment_added(self, attachment):
-        self._index_attachment(attachment)
-        if self.backend.commit():
-            self._update_attachment(attachment)
-    
-    def _index_attachment(self, attachment):
         """Called when an attachment is added."""
+        self.backend.create(attachment.resource, quiet=True)
+        self.backend.request_commit()
+
+    def _index_attachment(self, attachment):
+        return self._queue([self._build_attachment(attachment)])
+
+    def _build_attachment(self, attachment):
         if hasattr(attachment, 'version'):
             history = list(attachment.get_history())
             created = history[-1].date
@@ -806,47 +2523,56 @@ class FullTextSearch(Component):
                 involved = involved,
                 )
         if attachment.size <= self.max_size:
-            try:
-                so.body = attachment.open().read()
+            # The file is read as it is sent to Solr
+            if os.path.isfile(attachment.path):
+                so.body = LazyFile(attachment.path)
                 so.extract = True
-            except ResourceNotFound:
+            else:
                 self.log.warning('Missing attachment file "%s" encountered '
                                  'whilst indexing full text search', 
                                  attachment)
-        self.backend.create(so, quiet=True)
+        return so
 
     def attachment_deleted(self, attachment):
         """Called when an attachment is deleted."""
-        so = FullTextSearchObject(self.project, attachment.resource)
-        self.backend.delete(so, quiet=True)
-        if self.backend.commit():        
-            self._update_attachment(attachment)
+        self.backend.delete(attachment.resource, quiet=True)
+        self.backend.request_commit()
 
     def attachment_reparented(self, attachment, old_parent_realm, old_parent_id):
         """Called when an attachment is reparented."""
-        self._index_attachment(attachment)
-        if self.backend.commit():
-            self._update_attachment(attachment)
+        old_resource = Resource(old_parent_realm, old_parent_id) \
+                       .child('attachment', attachment.filename)
+        self.backend.delete(old_resource, quiet=True)
+        self.backend.create(attachment.resource, quiet=True)
+        self.backend.request_commit()
 
     #IMilestoneChangeListener methods
     def milestone_created(self, milestone):
-        self._index_milestone(milestone)
-        self.backend.commit()
+        self.backend.create(milestone.resource, quiet=True)
+        self.backend.request_commit()
         self.log.debug("Milestone created for indexing: %s", milestone)
     
-    def _index_milestone(self, milestone):
-        so = FullTextSearchObject(
+    def _build_milestone(self, milestone, status=False):
+        '''Return the document of `milestone`. `status` is its IndexStatus,
+        or None if it isn't indexed, when the caller has already read it.
+        '''
+        changed = milestone.completed or milestone.due
+        if not changed:
+            # Milestones don't record when they were changed, keep the time
+            # they were first indexed so the document's fingerprint is stable
+            if status is False:
+                status = self._get_status(milestone)
+            changed = status and status.changed or datetime.now(utc)
+        return FullTextSearchObject(
                 self.project, milestone.resource,
                 title = u'%s: %s' % (milestone.name,
                                      shorten_line(milestone.description)),
-                changed = milestone.completed or milestone.due
-                                              or datetime.now(utc),
+                changed = changed,
                 involved = (),
                 popularity = 0, #FIXME
                 oneline = shorten_result(milestone.description),
                 body = milestone.description,
                 )
-        self.backend.create(so, quiet=True)
 
     def milestone_changed(self, milestone, old_values):
         """
@@ -854,26 +2580,30 @@ class FullTextSearch(Component):
         milestone properties that changed. Currently those properties can be
         'name', 'due', 'completed', or 'description'.
         """
-        self._index_milestone(milestone)
-        self.backend.commit()
+        self.backend.create(milestone.resource, quiet=True)
+        self.backend.request_commit()
         self.log.debug("Milestone changed for indexing: %s", milestone)
 
     def milestone_deleted(self, milestone):
         """Called when a milestone is deleted."""
-        so = FullTextSearchObject(self.project, milestone.resource)
-        self.backend.delete(so, quiet=True)
-        self.backend.commit()
+        self.backend.delete(milestone.resource, quiet=True)
+        self.backend.request_commit()
 
     #IRepositoryChangeListener methods
     def changeset_added(self, repos, changeset):
         """Called after a changeset has been added to a repository."""
-        self._index_changeset(repos, changeset)
-        if self.backend.commit():
-            self._update_changeset(changeset)
-        
+        self.backend.create(changeset.resource, quiet=True)
+        self.backend.request_commit()
+
     def _index_changeset(self, repos, changeset):
+        return self._queue(self._build_changeset(repos, changeset))
+
+    def _build_changeset(self, repos, changeset):
+        """Generate the documents for a changeset, and the files it changed
+        if `fulltext_index_svn_nodes` is set.
+        """
         #Index the commit message
-        so = FullTextSearchObject(
+        yield FullTextSearchObject(
                 self.project, changeset.resource,
                 title=u'[%s]: %s' % (changeset.rev,
                                        shorten_line(changeset.message)),
@@ -883,40 +2613,41 @@ class FullTextSearch(Component):
                 created=changeset.date,
                 changed=changeset.date,
                 )
-        success = self.backend.create(so, quiet=True)
 
         if not self.fulltext_index_svn_nodes:
             return
 
-        def _changes(repos, changeset):
-            for path, kind, change, base_path, base_rev in changeset.get_changes():
-                if change == Changeset.MOVE:
-                    yield FullTextSearchObject(self.project, 'source', base_path,
-                                               repos.resource, action='DELETE')
-                elif change == Changeset.DELETE:
-                    yield FullTextSearchObject(self.project, 'source', path,
-                                               repos.resource, action='DELETE')
-                if change in (Changeset.ADD, Changeset.EDIT, Changeset.COPY,
-                              Changeset.MOVE):
-                    node = repos.get_node(path, changeset.rev)
-                    so = FullTextSearchObject(
-                            self.project, node.resource,
-                            title = node.path,
-                            oneline = u'[%s]: %s' % (changeset.rev, shorten_result(changeset.message)),
-                            comments = [changeset.message],
-                            changed = node.get_last_modified(),
-                            author = changeset.author,
-                            created = changeset.date
-                            )
-                    if node.content_length <= self.max_size:
-                        stream = node.get_content()
-                        if stream:
-                            so.body = stream.read()
-                            so.extract = True                        
-                    yield so
-        
-        for so in _changes(repos, changeset):
-            self.backend.create(so, quiet=True)
+        for path, kind, change, base_path, base_rev in changeset.get_changes():
+            if change == Changeset.MOVE:
+                yield FullTextSearchObject(self.project, 'source', base_path,
+                                           repos.resource, action='DELETE')
+            elif change == Changeset.DELETE:
+                yield FullTextSearchObject(self.project, 'source', path,
+                                           repos.resource, action='DELETE')
+            if change in (Changeset.ADD, Changeset.EDIT, Changeset.COPY,
+                          Changeset.MOVE):
+                node = repos.get_node(path, changeset.rev)
+                yield self._build_node(node, changeset)
+
+    def _build_node(self, node, changeset):
+        """Return the document of a file or directory in a repository, as of
+        `changeset`.
+        """
+        so = FullTextSearchObject(
+                self.project, node.resource,
+                title = node.path,
+                oneline = u'[%s]: %s' % (changeset.rev, shorten_result(changeset.message)),
+                comments = [changeset.message],
+                changed = node.get_last_modified(),
+                author = changeset.author,
+                created = changeset.date
+                )
+        if node.content_length <= self.max_size:
+            stream = node.get_content()
+            if stream:
+                so.body = SpooledStream(stream)
+                so.extract = True
+        return so
 
     def changeset_modified(self, repos, changeset, old_changeset):
         """Called after a changeset has been modified in a repository.
@@ -941,11 +2672,18 @@ class FullTextSearch(Component):
         filters = list(self._allowed_realms(req, filters))
         if not filters:
             return []
+        if not self.backend.breaker.allow():
+            # Don't wait for Solr to time out
+            self.log.debug("Solr is unavailable, falling back to built-in "
+                           "search sources")
+            return self._do_fallback(req, terms, filters)
         try:
-            query, response = self._do_search(terms, filters)
+            with self.backend._tracking():
+                query, response = self._do_search(terms, filters)
         except Exception, e:
             self.log.exception("Couldn't perform Full text search, falling back "
                            "to built-in search sources: %s %s", type(e), repr(e))
+            self.backend._check_schema(e)
             return self._do_fallback(req, terms, filters)
         docs = (FullTextSearchObject(**doc) for doc in self._docs(query))
         def _result(doc):
@@ -1000,9 +2738,7 @@ class FullTextSearch(Component):
 
     def _do_search(self, terms, filters, facet='realm', sort_by=None,
                                          field_limit=None):
-        si = self.backend.si_class(self.solr_endpoint,
-                                   http_connection=self.backend.http_connection,
-                                   retry_timeout=self.backend.retry_timeout)
+        si = self.backend.pool.get()
 
         # Restrict search to chosen realms, if none of our filters were chosen
         # then we won't have any results - return early, empty handed
@@ -0,0 +1,632 @@
+"""Helpers for communicating with Apache Solr through sunburnt."""
+import httplib
+import json
+import os
+import Queue
+import re
+import socket
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+from cStringIO import StringIO
+
+import httplib2
+import sunburnt
+from sunburnt.schema import SolrSchema, object_to_dict
+from sunburnt.sunburnt import grouper
+
+
+__all__ = ['CircuitBreaker', 'JsonSolrInterface', 'SolrInterface',
+           'SolrInterfacePool', 'SolrUnavailable', 'UploadPool',
+           'is_connection_error', 'is_schema_error']
+
+_SCHEMA_ERRORS = ('no such field', 'unknown field', 'undefined field',
+                  'required fields are unspecified')
+
+def is_schema_error(e):
+    '''Return True if exception `e` indicates that the Solr schema differs
+    from the one we know about.
+    '''
+    message = u' '.join(unicode(arg) for arg in getattr(e, 'args', ()))
+    message = message.lower()
+    return any(error in message for error in _SCHEMA_ERRORS)
+
+
+class SolrUnavailable(IOError):
+    """Raised instead of contacting Solr, whilst it is considered down."""
+
+
+def is_connection_error(e):
+    '''Return True if exception `e` means that Solr couldn't be reached,
+    rather than that Solr, or a document sent to it, caused an error.
+    '''
+    return isinstance(e, (socket.error, httplib.HTTPException,
+                          httplib2.HttpLib2Error, SolrUnavailable))
+
+
+class CircuitBreaker(object):
+    """Tracks failures to reach Solr, so callers can stop waiting for
+    timeouts whilst it is down.
+
+    After `threshold` consecutive failures the breaker opens for `cooldown`
+    seconds, during which `allow()` returns False. Afterwards a single
+    caller is allowed to probe Solr. If the probe fails the breaker opens
+    again, for twice as long each time, up to `max_cooldown` seconds.
+    """
+
+    def __init__(self, threshold=3, cooldown=10, max_cooldown=300):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self._opened_for = 0
+        self._retry_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._retry_at is not None
+
+    def allow(self, now=None):
+        """Return True if Solr should be contacted. The caller must report
+        the outcome with `success()` or `failure()`.
+        """
+        with self._lock:
+            if self._retry_at is None:
+                return True
+            now = now if now is not None else time.time()
+            if self._probing or now < self._retry_at:
+                return False
+            self._probing = True
+            return True
+
+    def retry_delay(self, now=None):
+        """Return the seconds until Solr may be probed, 0 if it's closed."""
+        if self._retry_at is None:
+            return 0
+        now = now if now is not None else time.time()
+        return max(self._retry_at - now, 0)
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_for = 0
+            self._retry_at = None
+            self._probing = False
+
+    def failure(self, now=None):
+        with self._lock:
+            now = now if now is not None else time.time()
+            self.failures += 1
+            if self._probing:
+                self._opened_for = min(self._opened_for * 2,
+                                       self.max_cooldown)
+            elif self._retry_at is None and self.failures >= self.threshold:
+                self._opened_for = self.cooldown
+            else:
+                return
+            self._retry_at = now + self._opened_for
+            self._probing = False
+
+
+# Dublin Core terms, Solr maps file metadata of these names to dc_<term>
+# fields (see solrconfig.xml)
+_DC_TERMS = frozenset(['contributor', 'coverage', 'creator', 'date',
+                       'description', 'format', 'identifier', 'language',
+                       'publisher', 'relation', 'rights', 'source', 'subject',
+                       'title', 'type'])
+
+def _metadata_fields(metadata):
+    '''Return the dc_* fields Solr sets from the metadata Tika extracted
+    from a file, a dict of lists of values keyed by metadata name.
+    '''
+    fields = {}
+    for name, values in metadata.iteritems():
+        name = re.sub(r'[^a-z0-9_]', '_', name.lower())
+        if name.startswith('dc_'):
+            name = name[3:]
+        if name in _DC_TERMS:
+            if not isinstance(values, list):
+                values = [values]
+            fields.setdefault('dc_' + name, []).extend(values)
+    return fields
+
+
+class SolrConnection(sunburnt.sunburnt.SolrConnection):
+    """SolrConnection which sends commitWithin as an integer. sunburnt sends
+    it as a float, e.g. 5000.0, which Solr rejects.
+    """
+
+    def url_for_update(self, commitWithin=None, **kwargs):
+        url = super(SolrConnection, self).url_for_update(**kwargs)
+        if commitWithin is None:
+            return url
+        try:
+            commitWithin = int(commitWithin)
+        except (TypeError, ValueError):
+            raise ValueError("commitWithin should be a number in milliseconds")
+        if commitWithin < 0:
+            raise ValueError("commitWithin should be a number in milliseconds")
+        return '%s%s%s' % (url, '?' in url and '&' or '?',
+                           urllib.urlencode([('commitWithin', commitWithin)]))
+
+
+class SolrInterface(sunburnt.SolrInterface):
+    """SolrInterface which streams documents to Solr for text extraction.
+
+    `add(doc, extract=True, filename=...)` posts the fields of `doc` along
+    with its body, a string or one of the streams in
+    `fulltextsearchplugin.streams`, to /update/extract. The body is read in
+    chunks as it is sent, so it is never held in memory as a whole. It is
+    sent through the same httplib2 connection as other requests, with its
+    credentials, proxy and timeout.
+
+    `extract_text(doc)` has Solr extract the text of the body, without
+    adding the document, so the text can be kept for later.
+
+    A SolrSchema returned by `parse_schema()` can be passed as `schema`,
+    instead of a `schemadoc` to parse, so interfaces can share it.
+    """
+
+    extract_path = 'update/extract'
+
+    def __init__(self, url, *args, **kwargs):
+        self._shared_schema = kwargs.pop('schema', None)
+        super(SolrInterface, self).__init__(url, *args, **kwargs)
+        conn = self.conn
+        self.conn = SolrConnection(conn.url, conn.http_connection,
+                                   conn.retry_timeout, conn.max_length_get_url)
+
+    @staticmethod
+    def parse_schema(schemadoc):
+        """Return the SolrSchema of the file like object `schemadoc`."""
+        return SolrSchema(schemadoc)
+
+    def init_schema(self):
+        if self._shared_schema is not None:
+            self.schema = self._shared_schema
+        else:
+            super(SolrInterface, self).init_schema()
+
+    def add(self, docs, extract=False, filename=None, **kwargs):
+        if not extract:
+            return super(SolrInterface, self).add(docs, **kwargs)
+        if not self.writeable:
+            raise TypeError("This Solr instance is only for reading")
+        if hasattr(docs, "items") or not hasattr(docs, "__iter__"):
+            docs = [docs]
+        for doc in docs:
+            self._extract(doc, filename or doc.id, **kwargs)
+
+    def _extract(self, doc, filename, **kwargs):
+        fields = [('resource.name', filename)]
+        for name, values in object_to_dict(doc, self.schema).iteritems():
+            if name == 'body':
+                continue
+            if not hasattr(values, '__iter__'):
+                values = [values]
+            for value in values:
+                value = self.schema.field_from_user_data(name, value)
+                fields.append(('literal.%s' % name, value.to_solr()))
+        query = urlparse.urlsplit(self.conn.url_for_update(**kwargs)).query
+        self._post_extract(query, fields, filename, doc)
+
+    def extract_text(self, doc, filename=None):
+        """Return the text Solr extracts from the body of `doc`, and the
+        dc_* fields it sets from the metadata of the file, as a dict.
+        """
+        filename = filename or doc.id
+        content = self._post_extract('extractOnly=true&extractFormat=text'
+                                     '&wt=json&json.nl=map',
+                                     [('resource.name', filename)],
+                                     filename, doc)
+        response = json.loads(content)
+        for name, value in response.iteritems():
+            if name != 'responseHeader' and not name.endswith('_metadata'):
+                metadata = response.get(name + '_metadata') or {}
+                return value or u'', _metadata_fields(metadata)
+        return u'', {}
+
+    def _post_extract(self, query, fields, filename, doc):
+        url = self.conn.url + self.extract_path + (query and '?' + query)
+        body = _MultipartBody(fields, filename,
+                              getattr(doc, 'body', None) or '')
+        headers = {'Content-Type': 'multipart/form-data; boundary=%s'
+                                   % body.boundary,
+                   'Content-Length': str(len(body))}
+        def post():
+            body.rewind()
+            return self.conn.http_connection.request(url, method='POST',
+                                                     body=body,
+                                                     headers=headers)
+        # As SolrConnection.request(), but sending the body from the start
+        try:
+            response, content = post()
+        except socket.error:
+            if self.conn.retry_timeout < 0:
+                raise
+            time.sleep(self.conn.retry_timeout)
+            response, content = post()
+        if response.status != 200:
+            raise sunburnt.SolrError(response, content)
+        return content
+
+
+class JsonSolrInterface(SolrInterface):
+    """SolrInterface which sends documents that aren't extracted to
+    /update/json, instead of as XML to /update.
+
+    The fields of a document are the same as sunburnt sends, but they are
+    converted with the field types looked up once per schema, and the
+    request body is built by the json module rather than as an lxml tree.
+    """
+
+    json_path = 'update/json'
+
+    def add(self, docs, extract=False, chunk=100, **kwargs):
+        if extract:
+            return super(JsonSolrInterface, self).add(docs, extract=True,
+                                                      **kwargs)
+        if not self.writeable:
+            raise TypeError("This Solr instance is only for reading")
+        if hasattr(docs, "items") or not hasattr(docs, "__iter__"):
+            docs = [docs]
+        query = urlparse.urlsplit(self.conn.url_for_update(**kwargs)).query
+        url = self.conn.url + self.json_path + (query and '?' + query)
+        for doc_chunk in grouper(docs, chunk):
+            body = json.dumps([self._json_doc(doc) for doc in doc_chunk],
+                              separators=(',', ':'))
+            response, content = self.conn.request(url, method="POST",
+                body=body, headers={"Content-Type": "application/json"})
+            if response.status != 200:
+                raise sunburnt.SolrError(response, content)
+
+    def _json_doc(self, doc):
+        fields = self._fields()
+        d = {}
+        for name, field in fields.iteritems():
+            value = _attribute(doc, name)
+            if value is not None:
+                d[name] = _to_solr(field, value)
+        # and now for dynamicFields, as sunburnt does
+        for name in getattr(doc, '__dict__', ()):
+            if name in fields:
+                continue
+            field = self._dynamic_field(name)
+            if field is not None:
+                value = _attribute(doc, name)
+                if value is not None:
+                    d[name] = _to_solr(field, value)
+        missing_fields = self.schema.missing_fields(d.keys())
+        if missing_fields:
+            raise sunburnt.SolrError("These required fields are unspecified:"
+                                     "\n %s" % missing_fields)
+        return d
+
+    def _fields(self):
+        fields = getattr(self, '_field_cache', None)
+        if fields is None:
+            fields = self._field_cache = dict(self.schema.fields)
+            self._dynamic_cache = {}
+        return fields
+
+    def _dynamic_field(self, name):
+        try:
+            return self._dynamic_cache[name]
+        except KeyError:
+            field = self._dynamic_cache[name] = \
+                    self.schema.match_dynamic_field(name)
+            return field
+
+def _attribute(doc, name):
+    value = getattr(doc, name, None)
+    if callable(value):
+        try:
+            value = value()
+        except TypeError:
+            value = None
+    return value
+
+def _to_solr(field, value):
+    if hasattr(value, '__iter__'):
+        return [field.instance_from_user_data(v).to_solr() for v in value]
+    return field.instance_from_user_data(value).to_solr()
+
+
+class _MultipartBody(object):
+    """multipart/form-data request body of `fields` and a file named
+    `filename`, whose contents are `body`. A string, or a file like object
+    which is read as the request is sent, such as one of the streams in
+    `fulltextsearchplugin.streams`.
+
+    httplib2 sends a body again after an authentication challenge, so once
+    it has been read to the end it starts over.
+    """
+
+    def __init__(self, fields, filename, body):
+        self.boundary = uuid.uuid4().hex
+        head = StringIO()
+        for name, value in fields:
+            head.write('--%s\r\nContent-Disposition: form-data; name="%s"\r\n'
+                       'Content-Type: text/plain; charset=utf-8\r\n\r\n'
+                       '%s\r\n' % (self.boundary, name, _utf8(value)))
+        head.write('--%s\r\nContent-Disposition: form-data; name="file"; '
+                   'filename="%s"\r\nContent-Type: application/octet-stream'
+                   '\r\n\r\n'
+                   % (self.boundary, _utf8(filename).replace('"', '%22')))
+        if isinstance(body, basestring):
+            body = StringIO(_utf8(body))
+        if hasattr(body, 'size'):
+            body_size = body.size
+        else:
+            body.seek(0, 2)
+            body_size = body.tell()
+        tail = '\r\n--%s--\r\n' % self.boundary
+        self._size = head.tell() + body_size + len(tail)
+        head.seek(0)
+        self._parts = [head, body, StringIO(tail)]
+        self._current = 0
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size=-1):
+        while self._current < len(self._parts):
+            data = self._parts[self._current].read(size)
+            if data:
+                return data
+            self._current += 1
+        self.rewind()
+        return ''
+
+    def rewind(self):
+        for part in self._parts:
+            part.seek(0)
+        self._current = 0
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class SolrInterfacePool(object):
+    """Thread safe source of long-lived SolrInterface instances for one Solr
+    endpoint.
+
+    Each thread is given its own interface, with its own HTTP connection,
+    which it keeps reusing. Constructing a sunburnt SolrInterface downloads
+    and parses the Solr schema, so the pool downloads the schema once and
+    caches it in memory, and in `cache_path` if specified, for `ttl` seconds.
+    If `si_class` has a `parse_schema` method, the schema is also parsed
+    once, and the parsed schema is shared by the interfaces.
+    """
+
+    def __init__(self, solr_endpoint, si_class, http_timeout=None,
+                 retry_timeout=None, cache_path=None, ttl=3600, log=None):
+        """
+        solr_endpoint -- URL of the Solr instance
+        si_class -- Class which will be instantiated to communicate with Solr.
+            Must match the signature of sunburnt.SolrInterface. The schema is
+            only cached for classes with a `remote_schema_file` attribute.
+        http_timeout -- Seconds to wait for http requests to solr
+        retry_timeout -- Seconds to wait before retrying http request to solr
+        cache_path -- File in which the schema is cached (None to disable)
+        ttl -- Seconds the cached schema is used before it is downloaded again
+        """
+        self.solr_endpoint = solr_endpoint
+        self.si_class = si_class
+        self.http_timeout = http_timeout
+        self.retry_timeout = retry_timeout
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.log = log
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._schema = None
+        self._parsed = None
+        self._fetched = 0
+        self._generation = 0
+
+    def get(self):
+        """Return the SolrInterface of the calling thread."""
+        schema, parsed = self._get_schema()
+        local = self._local
+        if getattr(local, 'generation', None) != self._generation:
+            local.si = self._create(schema, parsed)
+            local.generation = self._generation
+        return local.si
+
+    def invalidate(self):
+        """Discard the cached schema and interfaces, e.g. because the schema
+        has changed in Solr.
+        """
+        with self._lock:
+            self._schema = self._parsed = None
+            self._generation += 1
+            if self.cache_path and os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+        if self.log:
+            self.log.info("Discarded cached Solr schema of %s",
+                          self.solr_endpoint)
+
+    def _create(self, schema, parsed):
+        kwargs = {'http_connection': httplib2.Http(timeout=self.http_timeout),
+                  'retry_timeout': self.retry_timeout}
+        if parsed is not None:
+            kwargs['schema'] = parsed
+        elif schema is not None:
+            kwargs['schemadoc'] = StringIO(schema)
+        return self.si_class(self.solr_endpoint, **kwargs)
+
+    def _get_schema(self):
+        """Return the schema document, and the parsed schema if `si_class`
+        can share it, either may be None.
+        """
+        if not hasattr(self.si_class, 'remote_schema_file'):
+            return None, None
+        with self._lock:
+            now = time.time()
+            if self._schema is not None and now - self._fetched < self.ttl:
+                return self._schema, self._parsed
+            schema, fetched = self._read_cache(now)
+            cached = schema is not None
+            if not cached:
+                schema, fetched = self._fetch_schema(), now
+            parse = getattr(self.si_class, 'parse_schema', None)
+            parsed = parse(StringIO(schema)) if parse else None
+            if not cached:
+                self._write_cache(schema)
+            self._schema, self._parsed, self._fetched = schema, parsed, fetched
+            self._generation += 1
+            return schema, parsed
+
+    def _fetch_schema(self):
+        url = urlparse.urljoin(self.solr_endpoint.rstrip('/') + '/',
+                               self.si_class.remote_schema_file)
+        http = httplib2.Http(timeout=self.http_timeout)
+        response, content = http.request(url)
+        if response.status != 200:
+            raise EnvironmentError("Couldn't retrieve schema document from "
+                                   "%s - received status code %s"
+                                   % (url, response.status))
+        return content
+
+    def _read_cache(self, now):
+        if not self.cache_path:
+            return None, None
+        try:
+            mtime = os.path.getmtime(self.cache_path)
+            if now - mtime >= self.ttl:
+                return None, None
+            f = open(self.cache_path, 'rb')
+            try:
+                return f.read(), mtime
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return None, None
+
+    def _write_cache(self, schema):
+        if not self.cache_path:
+            return
+        try:
+            dirname = os.path.dirname(self.cache_path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+            f = open(tmp_path, 'wb')
+            try:
+                f.write(schema)
+            finally:
+                f.close()
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError), e:
+            if self.log:
+                self.log.warning("Couldn't cache Solr schema in %s: %s",
+                                 self.cache_path, e)
+
+
+class UploadPool(object):
+    """Runs uploads to Solr in `workers` threads, with at most `max_bytes`
+    of document bodies in flight at once.
+
+    The threads are started by the first `map()` and kept for the next
+    ones, along with the SolrInterface each of them is given by
+    SolrInterfacePool, until `close()`.
+
+    A document larger than `max_bytes` is still uploaded, but only once
+    nothing else is in flight.
+    """
+
+    def __init__(self, workers=1, max_bytes=64*2**20):
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._threads_lock = threading.Lock()
+
+    def map(self, upload, items, size=len):
+        """Call `upload(item)` for each of `items`, return a list of
+        (item, exception) pairs in the order of `items`. exception is None
+        if the upload succeeded.
+
+        size -- Callable returning the number of bytes uploaded for an item
+        """
+        items = list(items)
+        results = [None] * len(items)
+        if self.workers <= 1 or len(items) <= 1:
+            for i, item in enumerate(items):
+                results[i] = self._call(upload, item)
+            return zip(items, results)
+
+        self._start()
+        done = Queue.Queue()
+        submitted = 0
+        try:
+            for i, item in enumerate(items):
+                nbytes = size(item)
+                self._acquire(nbytes)
+                self._tasks.put((upload, item, nbytes, results, i, done))
+                submitted += 1
+        finally:
+            for n in xrange(submitted):
+                done.get()
+        return zip(items, results)
+
+    def close(self):
+        """Stop the threads, once they have finished their uploads."""
+        with self._threads_lock:
+            threads, self._threads = self._threads, []
+            for thread in threads:
+                self._tasks.put(None)
+            for thread in threads:
+                thread.join()
+
+    def _start(self):
+        with self._threads_lock:
+            # Threads don't survive a fork
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for n in xrange(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._work,
+                                          name='FullTextSearch upload %d' % n)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            upload, item, nbytes, results, i, done = task
+            try:
+                results[i] = self._call(upload, item)
+            finally:
+                self._release(nbytes)
+                done.put(i)
+
+    def _call(self, upload, item):
+        try:
+            upload(item)
+        except Exception, e:
+            return e
+        return None
+
+    def _acquire(self, nbytes):
+        with self._cond:
+            while self._in_flight and \
+                    self._in_flight + nbytes > self.max_bytes:
+                self._cond.wait()
+            self._in_flight += nbytes
+
+    def _release(self, nbytes):
+        with self._cond:
+            self._in_flight -= nbytes
+            self._cond.notify_all()
@@ -0,0 +1,217 @@
+"""Spools holding documents that are waiting to be sent to Apache Solr.
+
+A spool is an ordered store of items. Items are only removed once the
+consumer explicitly asks for it, so a consumer can `claim()` a batch, send it
+to Solr and `remove()` it afterwards. If sending fails, the consumer
+`release()`s the items, which stay in the spool and are sent again by the
+next consumer.
+"""
+import cPickle
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from itertools import islice
+
+__all__ = ['MemorySpool', 'SqliteSpool']
+
+
+class MemorySpool(object):
+    """In process spool, the contents are lost when the process exits.
+    """
+    def __init__(self):
+        self._items = OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        with self._lock:
+            self._next_key += 1
+            self._items[self._next_key] = item
+
+    def peek(self, limit=None):
+        '''Return a list of up to `limit` (key, item) pairs, oldest first.'''
+        with self._lock:
+            return list(islice(self._items.iteritems(), limit))
+
+    def claim(self, limit=None, max_bytes=None):
+        '''Return a list of up to `limit` (key, item) pairs to send, oldest
+        first. Only one process uses a MemorySpool, so this is `peek()`.
+        The items are in memory already, `max_bytes` is ignored.
+        '''
+        return self.peek(limit)
+
+    def release(self, keys):
+        pass
+
+    def remove(self, keys):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def close(self):
+        pass
+
+
+class SqliteSpool(object):
+    """On disk spool, stored as pickled items in a SQLite database.
+
+    The contents survive restarts of the process and can be shared between
+    processes, e.g. the workers of a web server and trac-admin. A process
+    sending items claims them first, for `lease` seconds, so they aren't
+    sent by others as well. Whilst a process holds claims, others claim
+    nothing, so the items are sent in the order they were queued. Claims
+    of a process which died expire with their lease.
+    """
+    def __init__(self, path, log=None, lease=300):
+        self.path = path
+        self.log = log
+        self.lease = lease
+        self._id = uuid.uuid4().hex
+        self._local = threading.local()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        cnx = self._cnx()
+        cnx.execute("CREATE TABLE IF NOT EXISTS spool ("
+                    "key INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "item BLOB NOT NULL, "
+                    "claimed_by TEXT, "
+                    "claimed_until REAL)")
+        columns = [row[1] for row in cnx.execute("PRAGMA table_info(spool)")]
+        if 'claimed_by' not in columns:
+            # Spooled by a version without claims
+            cnx.execute("ALTER TABLE spool ADD COLUMN claimed_by TEXT")
+            cnx.execute("ALTER TABLE spool ADD COLUMN claimed_until REAL")
+
+    def _cnx(self):
+        # sqlite3 connections can't be shared between threads
+        cnx = getattr(self._local, 'cnx', None)
+        if cnx is None:
+            cnx = sqlite3.connect(self.path, timeout=30)
+            # Transactions are begun explicitly, see _transaction()
+            cnx.isolation_level = None
+            cnx.text_factory = str
+            cnx.execute("PRAGMA journal_mode=WAL")
+            cnx.execute("PRAGMA synchronous=NORMAL")
+            self._local.cnx = cnx
+        return cnx
+
+    def __len__(self):
+        cursor = self._cnx().execute("SELECT COUNT(*) FROM spool")
+        return cursor.fetchone()[0]
+
+    def _transaction(self, fn):
+        '''Call `fn` with the connection in a transaction holding the write
+        lock from the start, return what it returns.
+        '''
+        cnx = self._cnx()
+        cnx.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(cnx)
+        except:
+            cnx.execute("ROLLBACK")
+            raise
+        cnx.execute("COMMIT")
+        return result
+
+    def _claimant(self):
+        # A forked process has claims of its own
+        return '%d:%s' % (os.getpid(), self._id)
+
+    def put(self, item):
+        cnx = self._cnx()
+        data = cPickle.dumps(item, cPickle.HIGHEST_PROTOCOL)
+        cnx.execute("INSERT INTO spool (item) VALUES (?)",
+                    (sqlite3.Binary(data),))
+
+    def peek(self, limit=None):
+        '''Return a list of up to `limit` (key, item) pairs, oldest first.'''
+        cursor = self._cnx().execute("SELECT key, item FROM spool "
+                                     "ORDER BY key LIMIT ?",
+                                     (limit if limit is not None else -1,))
+        return self._load(cursor.fetchall())
+
+    def claim(self, limit=None, max_bytes=None):
+        '''Claim up to `limit` items to send, return them as a list of
+        (key, item) pairs, oldest first. Items this spool already claimed
+        aren't returned again, and none are whilst another process holds
+        claims.
+
+        With `max_bytes`, only as many items as add up to that many bytes
+        pickled are claimed, but at least one. Pickled items include their
+        bodies, e.g. the contents of repository files, so this bounds the
+        memory a batch takes when loaded.
+        '''
+        claimant = self._claimant()
+        now = time.time()
+        def do_claim(cnx):
+            cursor = cnx.execute("SELECT 1 FROM spool WHERE claimed_by != ? "
+                                 "AND claimed_until > ? LIMIT 1",
+                                 (claimant, now))
+            if cursor.fetchone():
+                return []
+            keys = []
+            total = 0
+            for key, nbytes in cnx.execute(
+                    "SELECT key, LENGTH(item) FROM spool "
+                    "WHERE claimed_by IS NULL OR claimed_until <= ? "
+                    "ORDER BY key LIMIT ?",
+                    (now, limit if limit is not None else -1)).fetchall():
+                if max_bytes is not None and keys and \
+                        total + nbytes > max_bytes:
+                    break
+                keys.append(key)
+                total += nbytes
+            cnx.executemany("UPDATE spool SET claimed_by = ?, "
+                            "claimed_until = ? WHERE key = ?",
+                            [(claimant, now + self.lease, key)
+                             for key in keys])
+            return [cnx.execute("SELECT key, item FROM spool WHERE key = ?",
+                                (key,)).fetchone()
+                    for key in keys]
+        return self._load(self._transaction(do_claim))
+
+    def release(self, keys):
+        '''Give up the claims on `keys`, so any process may send them.'''
+        claimant = self._claimant()
+        def do_release(cnx):
+            cnx.executemany("UPDATE spool SET claimed_by = NULL, "
+                            "claimed_until = NULL "
+                            "WHERE key = ? AND claimed_by = ?",
+                            [(key, claimant) for key in keys])
+        self._transaction(do_release)
+
+    def _load(self, rows):
+        entries = []
+        broken = []
+        for key, data in rows:
+            try:
+                entries.append((key, cPickle.loads(str(data))))
+            except Exception:
+                # Don't let an item that can't be unpickled (e.g. written by
+                # an older version of this plugin) block the whole spool
+                if self.log:
+                    self.log.exception("Discarding unreadable item %s from "
+                                       "spool %s", key, self.path)
+                broken.append(key)
+        if broken:
+            self.remove(broken)
+        return entries
+
+    def remove(self, keys):
+        def do_remove(cnx):
+            cnx.executemany("DELETE FROM spool WHERE key = ?",
+                            [(key,) for key in keys])
+        self._transaction(do_remove)
+
+    def close(self):
+        cnx = getattr(self._local, 'cnx', None)
+        if cnx is not None:
+            cnx.close()
+            self._local.cnx = None
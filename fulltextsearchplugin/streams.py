@@ -0,0 +1,134 @@
+"""File like objects carrying the bodies of documents to index.
+
+Attachments and repository files can be large, so instead of reading them
+into memory when a document is built, the document holds one of these and
+the body is read in chunks while it is sent to Solr.
+"""
+import os
+import tempfile
+from cStringIO import StringIO
+
+__all__ = ['LazyFile', 'SpooledStream', 'hash_stream', 'stream_size']
+
+CHUNK_SIZE = 64 * 1024
+
+
+def stream_size(body):
+    '''Return the size in bytes of a document body, a string or one of the
+    streams in this module. Unicode strings are measured as UTF-8.
+    '''
+    if body is None:
+        return 0
+    if isinstance(body, unicode):
+        return len(body.encode('utf-8'))
+    if isinstance(body, str):
+        return len(body)
+    return getattr(body, 'size', 0)
+
+
+def hash_stream(h, body):
+    """Update the hashlib object `h` with a document body, a string or one
+    of the streams in this module, and return `h`. Unicode bodies are
+    hashed as UTF-8.
+    """
+    if isinstance(body, unicode):
+        h.update(body.encode('utf-8'))
+    elif isinstance(body, str):
+        h.update(body)
+    elif body is not None:
+        body.seek(0)
+        while True:
+            data = body.read(CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+        body.seek(0)
+    return h
+
+
+class LazyFile(object):
+    """Read-only file, which is only opened once it is read.
+
+    The file is closed once it has been read to the end, and reopened if it
+    is read again after `seek()`. Only the path is pickled.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+
+    @property
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def _file(self):
+        if self._f is None:
+            self._f = open(self.path, 'rb')
+        return self._f
+
+    def read(self, size=-1):
+        data = self._file().read(size)
+        if not data or size < 0:
+            self.close()
+        return data
+
+    def seek(self, offset, whence=0):
+        self._file().seek(offset, whence)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._f = None
+
+    def __repr__(self):
+        return '<LazyFile %r>' % (self.path,)
+
+
+class SpooledStream(object):
+    """Copy of a stream that can only be read once, such as the contents of a
+    file in a repository.
+
+    Up to `max_memory` bytes are kept in memory, larger contents are written
+    to a temporary file. When pickled the contents are included, as the
+    temporary file doesn't outlive the process; spools load such items in
+    batches bounded by size, see `SqliteSpool.claim()`.
+    """
+    def __init__(self, stream, max_memory=2**20):
+        self._f = tempfile.SpooledTemporaryFile(max_memory)
+        self.size = 0
+        while True:
+            data = stream.read(CHUNK_SIZE)
+            if not data:
+                break
+            self._f.write(data)
+            self.size += len(data)
+        self._f.seek(0)
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def seek(self, offset, whence=0):
+        self._f.seek(offset, whence)
+
+    def close(self):
+        self._f.close()
+
+    def __getstate__(self):
+        self._f.seek(0)
+        return {'data': self._f.read()}
+
+    def __setstate__(self, state):
+        self._f = StringIO(state['data'])
+        self.size = len(state['data'])
+
+    def __repr__(self):
+        return '<SpooledStream %d bytes>' % self.size
@@ -1,13 +1,19 @@
 import unittest
 
 import fulltextsearchplugin
-from fulltextsearchplugin.tests import fulltextsearch, admin, dates
+from fulltextsearchplugin.tests import (fulltextsearch, admin, dates, spool,
+                                        solr, streams, extract, throttle)
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(fulltextsearch.suite())
     suite.addTest(admin.suite())
     suite.addTest(dates.suite())
+    suite.addTest(spool.suite())
+    suite.addTest(solr.suite())
+    suite.addTest(streams.suite())
+    suite.addTest(extract.suite())
+    suite.addTest(throttle.suite())
     return suite
 
 if __name__ == '__main__':
@@ -4,7 +4,9 @@ import sys
 import unittest
 from StringIO import StringIO
 
-from trac.admin import console
+from sunburnt import SolrError
+
+from trac.admin import AdminCommandError, console
 from trac.admin.tests.console import (STRIP_TRAILING_SPACE,
                                       load_expected_results)
 from trac.test import EnvironmentStub
@@ -30,8 +32,12 @@ class FullTextSearchAdminTestCase(unittest.TestCase):
         self._admin.env_set('', self.env)
 
         self.fts = FullTextSearch(self.env)
+        self.fts.environment_created()
         self.fts.backend = Backend(self.fts.solr_endpoint, self.env.log,
-                                   MockSolrInterface)
+                                   MockSolrInterface, loader=self.fts._load,
+                                   on_commit=self.fts._committed,
+                                   on_error=self.fts._failed,
+                                   fingerprints=self.fts._get_fingerprints)
 
     def tearDown(self):
         MockSolrInterface._reset()
@@ -86,17 +92,30 @@ class FullTextSearchAdminTestCase(unittest.TestCase):
         """
         self.assertEqual(
                 sorted(['status', 'info', 'reindex', 'remove', 'index',
-                        'list', 'optimize']),
+                        'list', 'optimize', 'retry-failed']),
                 sorted(self._admin.complete_line('', 'fulltext ')))
 
     def test_realm_suggest(self):
         """Test suggestions as if the user typed "fulltext index <TAB>"
         """
         self.assertEqual(
-                sorted(['attachment', 'changeset', 'milestone', 'ticket',
-                        'wiki']),
+                sorted(['attachment', 'changeset', 'milestone', 'source',
+                        'ticket', 'wiki']),
                 sorted(self._admin.complete_line('', 'fulltext index ')))
 
+    def test_parse_jobs(self):
+        admin = FullTextSearchAdmin(self.env)
+        self.assertEqual((1, []), admin._parse_jobs([]))
+        self.assertEqual((4, ['ticket']),
+                         admin._parse_jobs(['--jobs', '4', 'ticket']))
+        self.assertEqual((2, ['wiki']),
+                         admin._parse_jobs(['wiki', '--jobs', '2']))
+        self.assertRaises(AdminCommandError, admin._parse_jobs, ['--jobs'])
+        self.assertRaises(AdminCommandError, admin._parse_jobs,
+                          ['--jobs', '0'])
+        self.assertRaises(AdminCommandError, admin._parse_jobs,
+                          ['ticket', 'wiki'])
+
     def test_optimize(self):
         test_name = sys._getframe().f_code.co_name
         expected = self.expected_results[test_name]
@@ -159,6 +178,37 @@ class FullTextSearchAdminTestCase(unittest.TestCase):
         rv, output = self._execute('fulltext remove milestone')
         self.assertEqual(expected, output)
 
+    def test_retry_failed(self):
+        test_name = sys._getframe().f_code.co_name
+        expected = self.expected_results[test_name]
+        class RejectingSolrInterface(MockSolrInterface):
+            rejecting = True
+            def add(self, docs, extract=False, **kwargs):
+                if self.rejecting:
+                    raise SolrError({'status': '400'},
+                                    "ERROR: Error adding field 'changed'")
+                MockSolrInterface.add(self, docs, extract, **kwargs)
+        self.fts.backend.si_class = self.fts.backend.pool.si_class = \
+            RejectingSolrInterface
+        ticket = Ticket(self.env)
+        ticket.populate({'reporter': 'santa', 'summary': 'Summary line',
+                         'description': 'Lorem ipsum dolor sit amet',
+                         })
+        ticket.insert()
+        self.assertEqual(0, len(self._get_docs()))
+        (resource, action, error, attempts, time), = self.fts.get_failed()
+        self.assertEqual(('ticket', '1'), (resource.realm, resource.id))
+        self.assertEqual(u"400 ERROR: Error adding field 'changed'", error)
+        self.assertEqual(1, attempts)
+        self._execute('fulltext retry-failed')
+        self.assertEqual(2, list(self.fts.get_failed())[0][3])
+        RejectingSolrInterface.rejecting = False
+        rv, output = self._execute('fulltext retry-failed ticket')
+        self.assertEqual(expected, output)
+        self.assertEqual(0, rv)
+        self.assertEqual(1, len(self._get_docs()))
+        self.assertEqual([], list(self.fts.get_failed()))
+
     def test_remove_unknown_realm(self):
         test_name = sys._getframe().f_code.co_name
         expected = self.expected_results[test_name]
@@ -0,0 +1,169 @@
+from StringIO import StringIO
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+
+from fulltextsearchplugin.extract import (ExtractionCache, LocalExtractor,
+                                          extract_html, extract_office_xml,
+                                          extract_plain_text, guess_mimetype)
+from fulltextsearchplugin.fulltextsearch import FullTextSearchObject
+from fulltextsearchplugin.streams import LazyFile, SpooledStream
+
+def broken_extractor(path):
+    raise ValueError(path)
+
+def slow_extractor(path):
+    time.sleep(60)
+    return u'Too late'
+
+
+class ExtractorsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='fts-extract')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.dir, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def test_guess_mimetype(self):
+        self.assertEqual('text/plain', guess_mimetype('foo.txt'))
+        self.assertEqual('application/vnd.oasis.opendocument.text',
+                         guess_mimetype('Foo.ODT'))
+        self.assertEqual(None, guess_mimetype('foo'))
+
+    def test_plain_text(self):
+        path = self._write('foo.txt', 'Caf\xc3\xa9 ipsum')
+        self.assertEqual(u'Caf\xe9 ipsum', extract_plain_text(path))
+
+    def test_html(self):
+        path = self._write('foo.html', '<html><head><title>Lorem</title>'
+                           '<script>var x = 1;</script></head>'
+                           '<body><p>Caf&eacute;\n  ipsum</p></body></html>')
+        self.assertEqual(u'Lorem Caf\xe9 ipsum', extract_html(path))
+
+    def test_office_xml(self):
+        path = os.path.join(self.dir, 'foo.docx')
+        archive = zipfile.ZipFile(path, 'w')
+        archive.writestr('[Content_Types].xml', '<Types/>')
+        archive.writestr('word/document.xml',
+            '<w:document xmlns:w="urn:w"><w:body>'
+            '<w:p><w:r><w:t>Lorem</w:t></w:r></w:p>'
+            '<w:p><w:r><w:t>ipsum</w:t></w:r></w:p>'
+            '</w:body></w:document>')
+        archive.close()
+        self.assertEqual(u'Lorem ipsum', extract_office_xml(path))
+
+
+class LocalExtractorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='fts-extract')
+        self.extractor = LocalExtractor({'text/plain': extract_plain_text,
+                                         'text/html': broken_extractor},
+                                        processes=2, timeout=10)
+
+    def tearDown(self):
+        self.extractor.close()
+        shutil.rmtree(self.dir)
+
+    def _doc(self, name, body):
+        return FullTextSearchObject('ftsproj', 'attachment', name, body=body)
+
+    def test_extract(self):
+        path = os.path.join(self.dir, 'foo.txt')
+        f = open(path, 'wb')
+        f.write('Lorem ipsum')
+        f.close()
+        docs = [self._doc('foo.txt', LazyFile(path)),
+                self._doc('bar.txt', SpooledStream(StringIO('dolor sit'))),
+                self._doc('baz.txt', 'amet'),
+                self._doc('foo.pdf', 'Unknown type'),
+                self._doc('foo.html', 'Broken extractor')]
+        results = self.extractor.extract(docs)
+        self.assertEqual(docs, [doc for doc, text in results])
+        self.assertEqual([u'Lorem ipsum', u'dolor sit', u'amet', None, None],
+                         [text for doc, text in results])
+
+    def test_lazy_processes(self):
+        self.assertEqual([], self.extractor.extract([]))
+        self.assertEqual([], self.extractor._processes)
+
+    def test_reuse_processes(self):
+        self.extractor.extract([self._doc('foo.txt', 'Lorem')])
+        processes = list(self.extractor._processes)
+        self.assertEqual(1, len(processes))
+        self.extractor.extract([self._doc('foo.html', 'Broken extractor')])
+        self.assertEqual(processes, self.extractor._processes)
+        self.assertEqual(None, processes[0].process.poll())
+
+    def test_timeout(self):
+        extractor = LocalExtractor({'text/plain': extract_plain_text,
+                                    'application/pdf': slow_extractor},
+                                   processes=2, timeout=1)
+        try:
+            docs = [self._doc('foo.pdf', 'Slow'),
+                    self._doc('bar.pdf', 'Slow'),
+                    self._doc('baz.pdf', 'Slow'),
+                    self._doc('foo.txt', 'Lorem')]
+            start = time.time()
+            results = extractor.extract(docs)
+            self.assertTrue(time.time() - start < 10)
+            self.assertEqual([None, None, None, None],
+                             [text for doc, text in results])
+            # The busy processes were killed rather than kept
+            self.assertEqual([], extractor._processes)
+        finally:
+            extractor.close()
+
+
+class ExtractionCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='fts-extract')
+        self.cache = ExtractionCache(os.path.join(self.dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_digest(self):
+        digest = self.cache.digest('Lorem ipsum', 'foo.txt')
+        self.assertEqual(digest,
+                         self.cache.digest(StringIO('Lorem ipsum'), 'foo.txt'))
+        self.assertEqual(digest, self.cache.digest(u'Lorem ipsum', 'foo.txt'))
+        self.assertEqual(digest, self.cache.digest('Lorem ipsum', 'BAR.TXT'))
+        self.assertNotEqual(digest,
+                            self.cache.digest('Lorem ipsum.', 'foo.txt'))
+        # The same bytes in a file of another type
+        self.assertNotEqual(digest,
+                            self.cache.digest('Lorem ipsum', 'foo.html'))
+        self.assertNotEqual(digest,
+                            self.cache.digest('Lorem ipsum', 'foo.xyz'))
+        self.assertNotEqual(digest, self.cache.digest('Lorem ipsum', 'foo'))
+
+    def test_get_put(self):
+        digest = self.cache.digest('Lorem ipsum', 'foo.txt')
+        self.assertEqual(None, self.cache.get(digest))
+        self.cache.put(digest, u'Caf\xe9', {'dc_title': [u'Lorem']})
+        self.assertEqual((u'Caf\xe9', {'dc_title': [u'Lorem']}),
+                         self.cache.get(digest))
+        # Shared by other processes
+        cache = ExtractionCache(self.cache.path)
+        self.assertEqual(u'Caf\xe9', cache.get(digest)[0])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ExtractorsTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(LocalExtractorTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ExtractionCacheTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
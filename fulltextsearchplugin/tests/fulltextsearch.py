@@ -1,11 +1,17 @@
 from datetime import datetime, timedelta
 from StringIO import StringIO
+import cPickle
+import errno
 import os
 import shutil
+import socket
 import tempfile
+import time
 import unittest
 import logging
 
+from sunburnt import SolrError
+
 from trac.attachment import Attachment
 from trac.resource import Resource
 from trac.test import EnvironmentStub, Mock
@@ -16,8 +22,10 @@ from trac.ticket.api import TicketSystem
 from tracremoteticket.api import RemoteTicketSystem
 
 from fulltextsearchplugin.fulltextsearch import (FullTextSearchObject, Backend,
-                                                 FullTextSearch,
-                                                 )
+                                                 CommitPolicy, FullTextSearch,
+                                                 IndexStatus)
+from fulltextsearchplugin.extract import ExtractionCache
+from fulltextsearchplugin.solr import CircuitBreaker, SolrUnavailable
 from trac.versioncontrol.api import RepositoryManager, DbRepositoryProvider
 from trac.loader import load_components
 import pkg_resources
@@ -56,14 +64,15 @@ class MockSolrInterface(object):
             docs = []
         return docs
 
-    def add(self, docs, extract=False):
+    def add(self, docs, extract=False, **kwargs):
         docs = self._doc2docs(docs)
         for doc in docs:
             self.pending.append(('add', doc.doc_id, doc))
 
-    def delete(self, docs=None, queries=None):
+    def delete(self, docs=None, queries=None, **kwargs):
         docs = self._doc2docs(docs)
-        docs += self.query(queries)
+        if queries:
+            docs += self.query(queries)
         for doc in docs:
             self.pending.append(('delete', doc.doc_id, doc))
 
@@ -79,7 +88,7 @@ class MockSolrInterface(object):
                     if all((f[0] == '*' or getattr(doc, f[0], None) == f[1])
                            for f in field_vals)]
 
-    def commit(self):
+    def commit(self, **kwargs):
         for op, docid, doc in self.pending:
             # Simulate round-trip through SOLR - id is a string field
             doc.id = unicode(doc.id)
@@ -88,12 +97,13 @@ class MockSolrInterface(object):
             elif op == 'add':
                 self.docs[docid] = doc
             self.hist.append((op,docid,doc))
-        self.pending = []
+        del self.pending[:]
 
     @classmethod
     def _reset(cls):
         cls.docs = {}
         cls.hist = []
+        del global_pending[:]
 
     def optimize(self):
         pass
@@ -150,6 +160,406 @@ class BackendTestCase(unittest.TestCase):
         si = backend.si_class(backend.solr_endpoint)
         self.assertEquals(0, len(si.query('realm:wiki')))
 
+    def test_flush_failure_keeps_items(self):
+        class FailingSolrInterface(MockSolrInterface):
+            failing = True
+            def add(self, docs, extract=False):
+                if self.failing:
+                    raise socket.error(errno.ECONNREFUSED,
+                                       'Connection refused')
+                MockSolrInterface.add(self, docs, extract)
+        backend = Backend(self.endpoint, self.log, FailingSolrInterface,
+                          queue_size=10)
+        backend.create(self._fts_obj('ftsproj', 'wiki', 'TestPage'))
+        self.assertFalse(backend.commit(quiet=True))
+        self.assertEquals(1, backend.qsize())
+        FailingSolrInterface.failing = False
+        self.assertTrue(backend.commit())
+        self.assertEquals(0, backend.qsize())
+        si = backend.si_class(backend.solr_endpoint)
+        self.assertEquals(1, len(si.query('realm:wiki')))
+
+    def test_parallel_extract(self):
+        class ExtractSolrInterface(MockSolrInterface):
+            def add(self, docs, extract=False, **kwargs):
+                if extract and docs.id == 'broken.pdf':
+                    raise SolrError({'status': '500'}, 'Tika failed')
+                MockSolrInterface.add(self, docs, extract, **kwargs)
+        backend = Backend(self.endpoint, self.log, ExtractSolrInterface,
+                          queue_size=10, extract_workers=3)
+        for name in ('a.pdf', 'broken.pdf', 'b.pdf', 'c.pdf'):
+            so = self._fts_obj('ftsproj', 'attachment', name)
+            so.extract = True
+            backend.create(so)
+        backend.create(self._fts_obj('ftsproj', 'wiki', 'TestPage'))
+        self.assertFalse(backend.flush())
+        self.assertEquals(0, backend.qsize())
+        backend.commit()
+        si = backend.si_class(backend.solr_endpoint)
+        self.assertEquals(['a.pdf', 'b.pdf', 'c.pdf'],
+                          sorted(doc.id for doc
+                                 in si.query('realm:attachment')))
+        self.assertEquals(1, len(si.query('realm:wiki')))
+
+    def test_unreadable_extract(self):
+        rejected = []
+        class ExtractSolrInterface(MockSolrInterface):
+            def add(self, docs, extract=False, **kwargs):
+                if extract and docs.id == 'deleted.pdf':
+                    raise IOError(errno.ENOENT, 'No such file or directory')
+                MockSolrInterface.add(self, docs, extract, **kwargs)
+        breaker = CircuitBreaker(threshold=1)
+        backend = Backend(self.endpoint, self.log, ExtractSolrInterface,
+                          queue_size=10, extract_workers=2, breaker=breaker,
+                          on_error=rejected.extend)
+        for name in ('a.pdf', 'deleted.pdf'):
+            so = self._fts_obj('ftsproj', 'attachment', name)
+            so.extract = True
+            backend.create(so)
+        self.assertFalse(backend.flush())
+        # Not retried, and not taken for Solr being down
+        self.assertEquals(0, backend.qsize())
+        self.assertFalse(breaker.is_open)
+        self.assertEquals([('CREATE',
+                            Resource('attachment', 'deleted.pdf'),
+                            u'[Errno 2] No such file or directory')],
+                          rejected)
+        backend.commit()
+        si = backend.si_class(backend.solr_endpoint)
+        self.assertEquals(['a.pdf'], [doc.id for doc
+                                      in si.query('realm:attachment')])
+
+    def test_local_extraction(self):
+        extracted = []
+        class ExtractSolrInterface(MockSolrInterface):
+            def add(self, docs, extract=False, **kwargs):
+                if extract:
+                    extracted.append(docs.id)
+                MockSolrInterface.add(self, docs, extract, **kwargs)
+        class Extractor(object):
+            def extract(self, docs):
+                return [(doc, doc.id.endswith('.txt') and u'Lorem' or None)
+                        for doc in docs]
+        backend = Backend(self.endpoint, self.log, ExtractSolrInterface,
+                          queue_size=10, extractor=Extractor())
+        for name in ('a.txt', 'b.pdf'):
+            so = self._fts_obj('ftsproj', 'attachment', name)
+            so.extract = True
+            so.body = 'data'
+            backend.create(so)
+        backend.commit()
+        self.assertEquals(['b.pdf'], extracted)
+        si = backend.si_class(backend.solr_endpoint)
+        doc, = si.query('id:a.txt')
+        self.assertEquals(u'Lorem', doc.body)
+        self.assertFalse(doc.extract)
+        # Only the plain add is timed for the throttle, not the upload
+        # Solr extracts, nor the commit
+        self.assertEquals(1, len(backend.latencies))
+
+    def test_extract_cache(self):
+        extracted = []
+        class ExtractSolrInterface(MockSolrInterface):
+            def extract_text(self, doc, filename=None):
+                extracted.append(filename)
+                return u'Lorem', {'dc_title': [u'Ipsum']}
+        cache_dir = tempfile.mkdtemp(prefix='fts-cache')
+        try:
+            for i in range(2):
+                backend = Backend(self.endpoint, self.log,
+                                  ExtractSolrInterface, queue_size=10,
+                                  extract_cache=ExtractionCache(cache_dir))
+                so = self._fts_obj('ftsproj', 'attachment', 'a.pdf')
+                so.extract = True
+                backend.create(so)
+                backend.commit()
+                si = backend.si_class(backend.solr_endpoint)
+                doc, = si.query('id:a.pdf')
+                self.assertEquals(u'Lorem', doc.body)
+                self.assertEquals([u'Ipsum'], doc.dc_title)
+                self.assertFalse(doc.extract)
+            # The second time the text was cached
+            self.assertEquals(['a.pdf'], extracted)
+            # Keyed by the type of the file as well as its body
+            for name in ('b.pdf', 'b.doc', 'c.pdf'):
+                so = self._fts_obj('ftsproj', 'attachment', name)
+                so.body = 'Dolor'
+                so.extract = True
+                backend.create(so)
+                backend.commit()
+            self.assertEquals(['a.pdf', 'b.pdf', 'b.doc'], extracted)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_circuit_breaker(self):
+        calls = []
+        class FailingSolrInterface(MockSolrInterface):
+            failing = True
+            def add(self, docs, extract=False, **kwargs):
+                calls.append(docs)
+                if self.failing:
+                    raise socket.error(errno.ECONNREFUSED,
+                                       'Connection refused')
+                MockSolrInterface.add(self, docs, extract, **kwargs)
+        breaker = CircuitBreaker(threshold=2, cooldown=0.01)
+        backend = Backend(self.endpoint, self.log, FailingSolrInterface,
+                          queue_size=1, breaker=breaker)
+        backend.put(('CREATE', self._fts_obj('ftsproj', 'wiki', 'TestPage')))
+        self.assertFalse(backend.commit(quiet=True))
+        self.assertFalse(backend.commit(quiet=True))
+        self.assertTrue(breaker.is_open)
+        del calls[:]
+        # Solr isn't contacted, items are kept for later
+        backend.create(self._fts_obj('ftsproj', 'wiki', 'OtherPage'))
+        self.assertFalse(backend.commit(quiet=True))
+        self.assertRaises(SolrUnavailable, backend.commit)
+        self.assertEquals([], calls)
+        self.assertEquals(2, backend.qsize())
+        time.sleep(0.01)
+        FailingSolrInterface.failing = False
+        self.assertTrue(backend.commit())
+        self.assertFalse(breaker.is_open)
+        self.assertEquals(0, backend.qsize())
+
+    def test_rejected(self):
+        rejected = []
+        class RejectingSolrInterface(MockSolrInterface):
+            def add(self, docs, extract=False, **kwargs):
+                if any(doc.id == 'BadPage' for doc in docs):
+                    raise SolrError({'status': '400'},
+                                    '<html><body>Bad page</body></html>')
+                MockSolrInterface.add(self, docs, extract, **kwargs)
+        backend = Backend(self.endpoint, self.log, RejectingSolrInterface,
+                          queue_size=10, on_error=rejected.extend)
+        for name in ('PageOne', 'BadPage', 'PageTwo'):
+            backend.create(self._fts_obj('ftsproj', 'wiki', name))
+        self.assertFalse(backend.flush())
+        self.assertEquals(0, backend.qsize())
+        self.assertEquals([('CREATE', Resource('wiki', 'BadPage'),
+                            u'400 Bad page')], rejected)
+        backend.commit()
+        si = backend.si_class(backend.solr_endpoint)
+        self.assertEquals(['PageOne', 'PageTwo'],
+                          sorted(doc.id for doc in si.query('realm:wiki')))
+
+    def test_rejected_delete(self):
+        rejected = []
+        class RejectingSolrInterface(MockSolrInterface):
+            failing = False
+            def delete(self, docs=None, queries=None, **kwargs):
+                if self.failing:
+                    raise socket.error(errno.ECONNREFUSED,
+                                       'Connection refused')
+                if any(doc.id == 'BadPage' for doc in docs or []):
+                    raise SolrError({'status': '400'},
+                                    '<html><body>Bad delete</body></html>')
+                MockSolrInterface.delete(self, docs, queries, **kwargs)
+        backend = Backend(self.endpoint, self.log, RejectingSolrInterface,
+                          queue_size=10, on_error=rejected.extend)
+        for name in ('PageOne', 'BadPage', 'PageTwo'):
+            backend.create(self._fts_obj('ftsproj', 'wiki', name))
+        backend.commit()
+        backend.create(self._fts_obj('ftsproj', 'wiki', 'PageThree'))
+        for name in ('PageOne', 'BadPage'):
+            backend.delete(self._fts_obj('ftsproj', 'wiki', name))
+        self.assertFalse(backend.flush())
+        # The add and the other delete were sent, and aren't sent again
+        self.assertEquals(0, backend.qsize())
+        self.assertEquals([('DELETE', Resource('wiki', 'BadPage'),
+                            u'400 Bad delete')], rejected)
+        backend.commit()
+        si = backend.si_class(backend.solr_endpoint)
+        self.assertEquals(['BadPage', 'PageThree', 'PageTwo'],
+                          sorted(doc.id for doc in si.query('realm:wiki')))
+        # Only the deletes are kept when Solr can't be reached
+        RejectingSolrInterface.failing = True
+        backend.create(self._fts_obj('ftsproj', 'wiki', 'PageFour'))
+        backend.delete(self._fts_obj('ftsproj', 'wiki', 'PageTwo'))
+        self.assertRaises(socket.error, backend.flush)
+        self.assertEquals(1, backend.qsize())
+
+    def test_queue_bytes(self):
+        backend = Backend(self.endpoint, self.log, MockSolrInterface,
+                          queue_size=10, queue_bytes=1000)
+        backend.create(self._fts_obj('ftsproj', 'wiki', 'SmallPage'))
+        self.assertEquals(1, backend.qsize())
+        so = self._fts_obj('ftsproj', 'wiki', 'LargePage')
+        so.body = 'x' * 1000
+        backend.create(so)
+        self.assertEquals(0, backend.qsize())
+
+    def test_batches(self):
+        calls = []
+        class RecordingSolrInterface(MockSolrInterface):
+            def add(self, docs, extract=False, **kwargs):
+                calls.append([doc.id for doc in docs])
+                MockSolrInterface.add(self, docs, extract, **kwargs)
+        backend = Backend(self.endpoint, self.log, RecordingSolrInterface,
+                          queue_size=10, batch_size=4, max_request_bytes=1000)
+        for i in range(6):
+            so = self._fts_obj('ftsproj', 'wiki', 'Page%d' % i)
+            so.body = 'x' * (i == 1 and 2000 or 300)
+            backend.create(so)
+        self.assertTrue(backend.flush())
+        self.assertEquals([['Page0'], ['Page1'], ['Page2', 'Page3'],
+                           ['Page4', 'Page5']], calls)
+        self.assertEquals(0, backend.qsize())
+        # Measured in bytes, as sent
+        del calls[:]
+        for i in range(2):
+            so = self._fts_obj('ftsproj', 'wiki', 'Page%d' % i)
+            so.body = u'\xe9' * 300
+            backend.create(so)
+        self.assertTrue(backend.flush())
+        self.assertEquals([['Page0'], ['Page1']], calls)
+
+    def test_loader(self):
+        loaded = []
+        def loader(action, resource):
+            loaded.append((action, resource))
+            return [self._fts_obj('ftsproj', resource.realm, resource.id)]
+        backend = Backend(self.endpoint, self.log, MockSolrInterface,
+                          queue_size=10, loader=loader)
+        backend.create(Resource('wiki', 'TestPage'))
+        self.assertEquals([], loaded)
+        backend.commit()
+        self.assertEquals([('CREATE', Resource('wiki', 'TestPage'))], loaded)
+        si = backend.si_class(backend.solr_endpoint)
+        self.assertEquals(1, len(si.query('realm:wiki')))
+
+    def test_unloaded(self):
+        rejected = []
+        def loader(action, resource):
+            if resource.id == 'LockedPage':
+                raise IOError('database is locked')
+            return [self._fts_obj('ftsproj', resource.realm, resource.id)]
+        backend = Backend(self.endpoint, self.log, MockSolrInterface,
+                          queue_size=10, loader=loader,
+                          on_error=rejected.extend)
+        for name in ('TestPage', 'LockedPage'):
+            backend.create(Resource('wiki', name))
+        self.assertFalse(backend.flush())
+        backend.commit()
+        # Recorded to be retried, rather than dropped with the spool entry
+        self.assertEquals(0, backend.qsize())
+        self.assertEquals([('CREATE', Resource('wiki', 'LockedPage'),
+                            u'database is locked')], rejected)
+        si = backend.si_class(backend.solr_endpoint)
+        self.assertEquals(['TestPage'],
+                          [doc.id for doc in si.query('realm:wiki')])
+
+    def test_coalesce(self):
+        loaded = []
+        def loader(action, resource):
+            loaded.append((action, resource))
+            return [self._fts_obj('ftsproj', resource.realm, resource.id)]
+        backend = Backend(self.endpoint, self.log, MockSolrInterface,
+                          queue_size=10, loader=loader)
+        backend.delete(self._fts_obj('ftsproj', 'wiki', 'TestPage'))
+        backend.create(Resource('wiki', 'TestPage'))
+        backend.modify(Resource('wiki', 'TestPage'))
+        backend.create(self._fts_obj('ftsproj', 'wiki', 'OtherPage'))
+        backend.delete(self._fts_obj('ftsproj', 'wiki', 'OtherPage'))
+        backend.commit()
+        self.assertEquals([('MODIFY', Resource('wiki', 'TestPage'))], loaded)
+        si = backend.si_class(backend.solr_endpoint)
+        self.assertEquals([('add', 'ftsproj:wiki:TestPage'),
+                           ('delete', 'ftsproj:wiki:OtherPage')],
+                          [(op, doc_id) for op, doc_id, doc in si.hist])
+
+    def test_commit_policy_grouped(self):
+        policy = CommitPolicy('grouped', interval=5, batch=10)
+        self.assertEquals(5, policy.delay(1, 100, 100))
+        self.assertEquals(2, policy.delay(1, 100, 103))
+        self.assertEquals(0, policy.delay(1, 100, 106))
+        self.assertEquals(0, policy.delay(10, 100, 100))
+        self.assertEquals({}, policy.commit_args(100))
+        self.assertEquals(0, CommitPolicy('immediate').delay(1, 100, 100))
+
+    def test_commit_policy_soft(self):
+        policy = CommitPolicy('soft', hard_interval=600)
+        policy.last_hard_commit = 1000
+        self.assertEquals({'softCommit': True}, policy.commit_args(1001))
+        self.assertEquals({}, policy.commit_args(1001, hard=True))
+        self.assertEquals({}, policy.commit_args(1600))
+
+    def test_commit_within(self):
+        committed = []
+        backend = Backend(self.endpoint, self.log, MockSolrInterface,
+                          queue_size=10, on_commit=committed.extend,
+                          commit_policy=CommitPolicy('within'))
+        backend.create(self._fts_obj('ftsproj', 'wiki', 'TestPage'))
+        self.assertTrue(backend.commit())
+        si = backend.si_class(backend.solr_endpoint)
+        # No explicit commit, Solr commits the document itself
+        self.assertEquals(0, len(si.query('realm:wiki')))
+        self.assertEquals(['ftsproj:wiki:TestPage'],
+                          [doc_id for op, doc_id, doc in si.pending])
+        self.assertEquals(1, len(committed))
+
+    def test_unknown_commit_policy(self):
+        self.assertRaises(ValueError, CommitPolicy, 'sometimes')
+
+    def test_background(self):
+        committed = []
+        backend = Backend(self.endpoint, self.log, MockSolrInterface,
+                          background=True, on_commit=committed.extend)
+        backend.create(self._fts_obj('ftsproj', 'wiki', 'TestPage'))
+        self.assertTrue(backend.request_commit())
+        backend.stop()
+        si = backend.si_class(backend.solr_endpoint)
+        self.assertEquals(1, len(si.query('realm:wiki')))
+        self.assertEquals(0, backend.qsize())
+        self.assertEquals([('CREATE', Resource('wiki', 'TestPage'),
+                            datetime(2010, 1, 1, tzinfo=utc), None)],
+                          committed)
+
+    def test_background_full_queue(self):
+        backend = Backend(self.endpoint, self.log, MockSolrInterface,
+                          queue_size=2, background=True,
+                          commit_policy=CommitPolicy('grouped', interval=60))
+        backend.start()
+        try:
+            for i in range(5):
+                backend.create(self._fts_obj('ftsproj', 'wiki', 'Page%d' % i))
+                # Sent by whoever queued them, not left to the thread
+                self.assertTrue(backend.qsize() < 2)
+        finally:
+            backend.stop()
+        si = backend.si_class(backend.solr_endpoint)
+        self.assertEquals(5, len(si.query('realm:wiki')))
+
+    def test_fingerprints(self):
+        fingerprints = {}
+        def committed(items):
+            for action, resource, changed, fingerprint in items:
+                fingerprints[resource.id] = fingerprint
+        def get_fingerprints(resources):
+            return dict(('wiki:%s' % r.id, fingerprints[r.id])
+                        for r in resources if r.id in fingerprints)
+        backend = Backend(self.endpoint, self.log, MockSolrInterface,
+                          queue_size=10, on_commit=committed,
+                          fingerprints=get_fingerprints)
+        si = backend.si_class(backend.solr_endpoint)
+        for name in ('TestPage', 'OtherPage'):
+            backend.create(self._fts_obj('ftsproj', 'wiki', name))
+        backend.commit()
+        self.assertEquals(2, len(si.hist))
+        self.assertEquals(self._fts_obj('ftsproj', 'wiki', 'TestPage')
+                                .fingerprint(),
+                          fingerprints['TestPage'])
+        # Unchanged documents aren't sent again
+        for name in ('TestPage', 'OtherPage'):
+            backend.create(self._fts_obj('ftsproj', 'wiki', name))
+        changed = self._fts_obj('ftsproj', 'wiki', 'OtherPage')
+        changed.body = StringIO('Lorem ipsum')
+        backend.create(changed)
+        backend.commit()
+        self.assertEquals(0, backend.qsize())
+        self.assertEquals(['ftsproj:wiki:OtherPage'],
+                          [doc_id for op, doc_id, doc in si.hist[2:]])
+        self.assertEquals(changed.fingerprint(), fingerprints['OtherPage'])
+
 
 class FullTextSearchObjectTestCase(unittest.TestCase):
     def setUp(self):
@@ -233,6 +643,34 @@ class FullTextSearchObjectTestCase(unittest.TestCase):
         self.assertEquals('project1:attachment:wiki:WikiStart:foo.txt',
                           so.doc_id)
 
+    def test_fingerprint(self):
+        so = FullTextSearchObject(self.project, 'wiki', 'WikiStart',
+                                  title=u'Caf\xe9', body=u'Lorem ipsum')
+        fingerprint = so.fingerprint()
+        self.assertEquals(fingerprint, FullTextSearchObject(self.project,
+            'wiki', 'WikiStart', title=u'Caf\xe9',
+            body=StringIO('Lorem ipsum')).fingerprint())
+        so.title = u'Cafe'
+        self.assertNotEquals(fingerprint, so.fingerprint())
+        self.assertNotEquals(fingerprint, FullTextSearchObject(self.project,
+            'wiki', 'SandBox', title=u'Caf\xe9',
+            body=u'Lorem ipsum').fingerprint())
+
+    def test_pickle(self):
+        so = FullTextSearchObject(self.project,
+                                  Resource('attachment', 'foo.txt',
+                                        parent=Resource('wiki', 'WikiStart')),
+                                  title='title',
+                                  changed=datetime(2010, 1, 1, tzinfo=utc),
+                                  action='CREATE')
+        so = cPickle.loads(cPickle.dumps(so, cPickle.HIGHEST_PROTOCOL))
+        self.assertEquals('project1:attachment:wiki:WikiStart:foo.txt',
+                          so.doc_id)
+        self.assertEquals('title', so.title)
+        self.assertEquals(datetime(2010, 1, 1, tzinfo=utc), so.changed)
+        self.assertEquals(None, so.created)
+        self.assertEquals('CREATE', so.action)
+
     def test_create_resource_ignores_parent_realm_and_id(self):
         so = FullTextSearchObject(self.project,
                                   Resource('attachment', 'foo.txt'),
@@ -251,8 +689,9 @@ class FullTextSearchTestCase(unittest.TestCase):
         self.basename = os.path.basename(self.env.path)
         #self.env.config.set('search', 'solr_endpoint', 'http://localhost:8983/solr/')
         self.fts = FullTextSearch(self.env)
+        self.fts.environment_created()
         self.fts.backend = Backend(self.fts.solr_endpoint, self.env.log,
-                                   MockSolrInterface)
+                                   MockSolrInterface, loader=self.fts._load)
 
     def tearDown(self):
         MockSolrInterface._reset()
@@ -261,8 +700,8 @@ class FullTextSearchTestCase(unittest.TestCase):
 
     def test_properties(self):
         self.assertEquals(self.basename, self.fts.project)
-        self.assertEquals(['attachment', 'changeset', 'milestone', 'ticket',
-                           'wiki'],
+        self.assertEquals(['attachment', 'changeset', 'milestone', 'source',
+                           'ticket', 'wiki'],
                           sorted(self.fts.index_realms))
         self.assertEquals(['attachment', 'changeset', 'milestone', 'source',
                            'ticket','wiki'],
@@ -333,6 +772,68 @@ class FullTextSearchTestCase(unittest.TestCase):
         self.assertTrue('Could eat no fat' in so.comments)
         
 
+    def test_build_tickets(self):
+        self.env.config.set('ticket-custom', 'foo', 'text')
+        for i in range(2):
+            ticket = Ticket(self.env)
+            ticket.populate({'reporter': 'santa', 'summary': 'Summary %d' % i,
+                             'description': 'Lorem ipsum', 'foo': 'Custom',
+                             'cc': 'a@b.com, c@example.com'})
+            ticket.insert()
+        ticket['description'] = 'No latin filler here'
+        ticket.save_changes('Jack Sprat', 'Could eat no fat')
+        attachment = Attachment(self.env, 'ticket', ticket.id)
+        attachment.description = 'Attached'
+        attachment.insert('foo.txt', StringIO('Lorem ipsum'), 0)
+        docs = self.fts._build_tickets([2, 1, 3])
+        self.assertEquals([2, 1], [so.id for so in docs])
+        for so in docs:
+            expected = self.fts._build_ticket(Ticket(self.env, so.id))
+            for attr in ('title', 'author', 'changed', 'created', 'tags',
+                         'involved', 'oneline', 'body', 'comments'):
+                self.assertEquals(getattr(expected, attr), getattr(so, attr))
+            self.assertEquals(expected.fingerprint(), so.fingerprint())
+        self.assertTrue('Could eat no fat' in docs[0].comments)
+        self.assertTrue('foo.txt' in docs[0].comments)
+        self.assertEquals([], self.fts._build_tickets([]))
+
+    def test_build_tickets_fingerprint(self):
+        ticket = Ticket(self.env)
+        ticket.populate({'reporter': 'santa', 'summary': 'Summary',
+                         'description': 'Lorem ipsum'})
+        ticket.insert()
+        when = datetime(2010, 1, 1, tzinfo=utc)
+        ticket['summary'] = 'Changed'
+        ticket['description'] = 'Dolor sit amet'
+        ticket['keywords'] = 'foo'
+        ticket.save_changes('santa', 'Comment', when=when)
+        # Changes at the same time, by several authors, read in whichever
+        # order the database returns them
+        @self.env.with_transaction()
+        def do_insert(db):
+            db.cursor().executemany("INSERT INTO ticket_change "
+                "(ticket, time, author, field, oldvalue, newvalue) "
+                "VALUES (%s, %s, %s, %s, %s, %s)",
+                [(ticket.id, to_utimestamp(when), author, field, None, value)
+                 for author, field, value in [('zorro', 'version', '2.0'),
+                                              ('alice', 'cc', 'a@b.com'),
+                                              ('alice', 'milestone', None)]])
+        for filename in ('b.txt', 'a.txt'):
+            attachment = Attachment(self.env, 'ticket', ticket.id)
+            attachment.description = 'Attached'
+            attachment.insert(filename, StringIO('Lorem ipsum'), 0, t=when)
+        so, = self.fts._build_tickets([ticket.id])
+        ticket = Ticket(self.env, ticket.id)
+        expected = self.fts._build_ticket(ticket)
+        self.assertEquals(expected.comments, so.comments)
+        self.assertEquals(expected.fingerprint(), so.fingerprint())
+        # Other databases may return the changes at the same time, by the
+        # same author, in another order
+        changelog = list(reversed(ticket.get_changelog()))
+        ticket.get_changelog = lambda: changelog
+        self.assertEquals(expected.fingerprint(),
+                          self.fts._build_ticket(ticket).fingerprint())
+
     def test_wiki_page(self):
         page = WikiPage(self.env, 'NewPage')
         page.text = 'Lorem ipsum dolor sit amet'
@@ -364,6 +865,113 @@ class FullTextSearchTestCase(unittest.TestCase):
         self.assertTrue('No latin filler here' in so.body)
         self.assertTrue('Could eat no fat' in so.comments)
     
+    def test_build_wiki_pages(self):
+        @self.env.with_transaction()
+        def do_create(db):
+            cursor = db.cursor()
+            cursor.execute("CREATE TABLE tags (tagspace text, name text, "
+                           "                   tag text)")
+            cursor.executemany("INSERT INTO tags VALUES ('wiki', %s, %s)",
+                               [('PageB', 'bravo'), ('PageB', 'alpha')])
+        for name in ('PageA', 'PageB'):
+            page = WikiPage(self.env, name)
+            page.text = 'Lorem ipsum'
+            page.save('santa', 'Page created', None)
+        page.text = 'No latin filler here'
+        page.save('Jack Sprat', 'Could eat no fat', None)
+        docs = self.fts._build_wiki_pages('wiki', ['PageB', 'Missing', 'PageA'])
+        self.assertEquals(['PageB', 'PageA'], [so.id for so in docs])
+        for so in docs:
+            expected = self.fts._build_wiki_page(WikiPage(self.env, so.id))
+            for attr in ('title', 'author', 'changed', 'created', 'tags',
+                         'involved', 'oneline', 'body', 'comments'):
+                self.assertEquals(getattr(expected, attr), getattr(so, attr))
+            self.assertEquals(expected.fingerprint(), so.fingerprint())
+        self.assertEquals(['alpha', 'bravo'], docs[0].tags)
+        self.assertEquals('No latin filler here', docs[0].body)
+        self.assertEquals([], docs[1].tags)
+    
+    def test_select_changesets(self):
+        self.env.config.set('search', 'fulltext_index_svn_nodes', 'true')
+        repos = Mock(id=1, resource=Resource('repository', 'repo'),
+                     rev_db=lambda rev: rev and int(rev))
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.executemany("INSERT INTO revision "
+                               "(repos, rev, time, author, message) "
+                               "VALUES (1, %s, %s, 'santa', %s)",
+                               [('1', 1000000, 'Initial import'),
+                                ('2', 2000000, 'Lorem ipsum')])
+            cursor.executemany("INSERT INTO node_change (repos, rev, path, "
+                               "  node_type, change_type, base_path, "
+                               "  base_rev) "
+                               "VALUES (1, %s, %s, 'F', %s, %s, %s)",
+                               [('2', 'trunk/foo.txt', 'E', 'trunk/foo.txt',
+                                 '1'),
+                                ('2', 'trunk/bar.txt', 'A', None, None)])
+        changesets = self.fts._select_changesets(repos, ['2', '3', '1'])
+        self.assertEquals([2, 1], [cs.rev for cs in changesets])
+        self.assertEquals('Lorem ipsum', changesets[0].message)
+        self.assertEquals('santa', changesets[0].author)
+        self.assertEquals(from_utimestamp(2000000), changesets[0].date)
+        self.assertEquals([('trunk/bar.txt', 'file', 'add', None, None),
+                           ('trunk/foo.txt', 'file', 'edit', 'trunk/foo.txt',
+                            1)],
+                          list(changesets[0].get_changes()))
+        self.assertEquals([], list(changesets[1].get_changes()))
+        self.assertEquals(Resource('repository', 'repo'),
+                          changesets[0].resource.parent)
+
+    def test_snapshot(self):
+        self.env.config.set('search', 'source_workers', '2')
+        changed = datetime(2001, 1, 1, tzinfo=utc)
+        def node(path, kind='file', entries=()):
+            return Mock(path=path, isdir=kind == 'dir', rev=len(path),
+                        resource=Resource('source', path),
+                        get_entries=lambda: iter(entries),
+                        get_last_modified=lambda: changed)
+        nodes = dict((n.path, n) for n in [
+                node('trunk/foo.txt'), node('trunk/bar.txt'),
+                node('branches', 'dir')])
+        nodes['trunk'] = node('trunk', 'dir', [nodes['trunk/foo.txt'],
+                                               nodes['trunk/bar.txt']])
+        nodes[''] = node('', 'dir', [nodes['trunk'], nodes['branches']])
+        repos = Mock(reponame='repo', youngest_rev=5,
+                     get_node=lambda path, rev: nodes[path],
+                     get_changeset=lambda rev: rev)
+        manager = RepositoryManager(self.env)
+        manager.get_repository = lambda reponame: repos
+        manager.shutdown = lambda tid: None
+        self.fts._build_node = lambda node, changeset: (node.path, changeset)
+        self.assertEquals([('branches', 8), ('trunk', 5),
+                           ('trunk/bar.txt', 13), ('trunk/foo.txt', 13)],
+                          sorted(self.fts._snapshot(repos, {})))
+        # Unchanged since indexed, or in another part
+        statuses = {self.fts._status_id(nodes['trunk']):
+                    IndexStatus(changed, None)}
+        self.assertEquals(['branches', 'trunk/bar.txt', 'trunk/foo.txt'],
+                          sorted(p for p, cs in
+                                 self.fts._snapshot(repos, statuses)))
+        self.assertEquals([('trunk/foo.txt', 13)],
+                          list(self.fts._snapshot(repos, {}, (1, 3))))
+        self.assertEquals([('trunk/bar.txt', 13)],
+                          list(self.fts._snapshot(repos, {}, (2, 3))))
+
+    def test_reindex_source_statuses(self):
+        self.env.config.set('search', 'fulltext_index_svn_nodes', 'true')
+        calls = []
+        get_statuses = self.fts._get_statuses
+        def count_statuses(realm, since=None):
+            calls.append(realm)
+            return get_statuses(realm, since)
+        self.fts._get_statuses = count_statuses
+        nothing = lambda realm, so: None
+        self.assertEquals(0, self.fts._reindex_source('source', nothing,
+                                                      nothing))
+        # Shared by _snapshot() and _index()
+        self.assertEquals(['source'], calls)
+
     def test_wiki_page_unicode_error(self):
         import pkg_resources
         import define
@@ -374,6 +982,203 @@ class FullTextSearchTestCase(unittest.TestCase):
         so = self._get_so()
         self.assertEquals('%s:wiki:TicketTutorial' % self.basename, so.doc_id)
         
+    def test_ticket_deleted_before_flush(self):
+        self.fts.backend.queue_size = 10
+        ticket = Ticket(self.env)
+        ticket.populate({'reporter': 'santa', 'summary': 'Summary line'})
+        ticket.insert()
+        ticket.delete()
+        self.fts.backend.commit()
+        si = self.fts.backend.si_class(self.fts.backend.solr_endpoint)
+        self.assertEquals(0, len(si.query('realm:ticket')))
+        self.assertEquals(0, self.fts.backend.qsize())
+
+    def test_index_unchanged(self):
+        self.fts.backend = Backend(self.fts.solr_endpoint, self.env.log,
+                                   MockSolrInterface, loader=self.fts._load,
+                                   on_commit=self.fts._committed,
+                                   fingerprints=self.fts._get_fingerprints)
+        for name in ('milestone1', 'milestone2'):
+            milestone = Milestone(self.env)
+            milestone.name = name
+            milestone.insert()
+        page = WikiPage(self.env, 'TestPage')
+        page.text = 'Lorem ipsum'
+        page.save('santa', 'Page created', None)
+        si = self.fts.backend.si_class(self.fts.backend.solr_endpoint)
+        del si.hist[:]
+        self.assertEquals({'milestone': 0, 'wiki': 0},
+                          self.fts.index(['milestone', 'wiki']))
+        self.assertEquals(0, len(si.hist))
+        # Changed behind the back of the change listeners
+        @self.env.with_transaction()
+        def do_update(db):
+            db.cursor().execute("UPDATE milestone SET description=%s "
+                                "WHERE name=%s", ('Lorem ipsum', 'milestone2'))
+        self.fts.index(['milestone', 'wiki'])
+        self.assertEquals(['%s:milestone:milestone2' % self.basename],
+                          [doc_id for op, doc_id, doc in si.hist])
+
+    def test_index_commits_inline(self):
+        self.env.config.set('search', 'commit_interval', '0')
+        for name in ('milestone1', 'milestone2'):
+            milestone = Milestone(self.env)
+            milestone.name = name
+            milestone.insert()
+        self.fts.backend.background = True
+        self.assertEquals({'milestone': 2}, self.fts.index(['milestone']))
+        # No background thread letting the index run ahead of Solr
+        self.assertEquals(None, self.fts.backend._worker)
+
+    def test_high_water_mark(self):
+        self.fts.backend = Backend(self.fts.solr_endpoint, self.env.log,
+                                   MockSolrInterface, loader=self.fts._load,
+                                   on_commit=self.fts._committed)
+        for i in range(3):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'Ticket %d' % i
+            ticket.insert(when=datetime(2010, 1, i + 1, tzinfo=utc))
+        # Only recorded by a complete index run
+        self.assertEquals(None, self.fts._high_water_mark('ticket'))
+        self.assertEquals({'ticket': 0}, self.fts.index(['ticket']))
+        self.assertEquals(datetime(2010, 1, 3, tzinfo=utc),
+                          self.fts._high_water_mark('ticket'))
+        self.assertEquals(None, self.fts._high_water_mark('wiki'))
+        @self.env.with_transaction()
+        def do_update(db):
+            cursor = db.cursor()
+            cursor.execute("UPDATE ticket SET changetime=%s WHERE id=2",
+                           (to_utimestamp(datetime(2010, 2, 1, tzinfo=utc)),))
+            # Not selected, as it changed before the high water mark
+            cursor.execute("DELETE FROM fulltextsearch_status "
+                           "WHERE doc_id='ticket:1'")
+        self.assertEquals({'ticket': 1}, self.fts.index(['ticket']))
+        self.assertEquals(datetime(2010, 2, 1, tzinfo=utc),
+                          self.fts._high_water_mark('ticket'))
+
+    def test_high_water_mark_listener(self):
+        self.fts.backend = Backend(self.fts.solr_endpoint, self.env.log,
+                                   MockSolrInterface, loader=self.fts._load,
+                                   on_commit=self.fts._committed)
+        for i in range(3):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'Ticket %d' % i
+            ticket.insert(when=datetime(2010, 1, i + 1, tzinfo=utc))
+        self.fts.backend.commit()
+        @self.env.with_transaction()
+        def do_forget(db):
+            # Created before the plugin was installed
+            db.cursor().execute("DELETE FROM fulltextsearch_status "
+                                "WHERE doc_id IN ('ticket:1', 'ticket:2')")
+        # An edit seen by the change listeners before the first index run
+        ticket = Ticket(self.env, 3)
+        ticket['summary'] = 'Changed'
+        ticket.save_changes('santa', 'Lorem ipsum')
+        self.fts.backend.commit()
+        self.assertEquals(None, self.fts._high_water_mark('ticket'))
+        self.assertEquals({'ticket': 2}, self.fts.index(['ticket']))
+        self.assertEquals(ticket['changetime'],
+                          self.fts._high_water_mark('ticket'))
+
+    def test_index_part(self):
+        for i in range(5):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'Ticket %d' % i
+            ticket.insert()
+        parts = []
+        for i in range(2):
+            indexed = []
+            feedback = lambda realm, so: indexed.append(so.id)
+            self.assertEquals(3 - i, self.fts._reindex_ticket(
+                'ticket', feedback, lambda realm, so: None, part=(i, 2)))
+            parts.append(indexed)
+        self.assertEquals([[1, 3, 5], [2, 4]], parts)
+        # Each part only sees some of the changes
+        self.assertEquals(None, self.fts._high_water_mark('ticket'))
+
+    def test_throttle(self):
+        self.assertEquals('none', self.fts._throttle().mode)
+        self.env.config.set('search', 'reindex_throttle', 'adaptive')
+        self.env.config.set('search', 'reindex_docs_per_second', '20')
+        throttle = self.fts._throttle()
+        self.assertEquals('adaptive', throttle.mode)
+        self.assertEquals([20], [b.rate for b, amount in throttle.buckets])
+        self.assertTrue(throttle.latencies is self.fts.backend.latencies)
+        # fulltext slowreindex
+        self.fts.indexing_delay = 2
+        throttle = self.fts._throttle()
+        self.assertEquals('bucket', throttle.mode)
+        self.assertEquals([0.5], [b.rate for b, amount in throttle.buckets])
+
+    def test_get_statuses(self):
+        changed = datetime(2010, 1, 1, tzinfo=utc)
+        self.fts._set_status(Resource('wiki', 'WikiStart'), changed, 'abc')
+        self.fts._set_status(Resource('wiki', 'SandBox'), changed)
+        self.fts._set_status(Resource('ticket', 1), changed)
+        self.assertEquals({'wiki:WikiStart': (changed, 'abc'),
+                           'wiki:SandBox': (changed, None)},
+                          self.fts._get_statuses('wiki'))
+        # Used by index() instead of a query per resource
+        def get_status(resource):
+            self.fail("Status of %s read on its own" % resource)
+        self.fts._get_status = get_status
+        self.fts.index(['wiki'])
+        # Including those of milestones, which don't record when they changed
+        milestone = Milestone(self.env)
+        milestone.name = 'milestone1'
+        milestone.insert()
+        self.fts.index(['milestone'])
+
+    def test_committed(self):
+        changed = datetime(2010, 1, 1, tzinfo=utc)
+        later = datetime(2010, 1, 2, tzinfo=utc)
+        self.fts._set_status(Resource('wiki', 'SandBox'), changed)
+        self.fts._committed([
+            ('CREATE', Resource('wiki', 'WikiStart'), changed, 'abc'),
+            ('MODIFY', Resource('wiki', 'WikiStart'), later, 'def'),
+            ('DELETE', Resource('wiki', 'SandBox'), None, None),
+            ('CREATE', Resource('wiki', 'TracGuide'), later, None),
+            ])
+        self.assertEquals({'wiki:WikiStart': (later, 'def'),
+                           'wiki:TracGuide': (later, None)},
+                          self.fts._get_statuses('wiki'))
+
+    def test_upgrade_statuses(self):
+        changed = datetime(2010, 1, 1, tzinfo=utc)
+        @self.env.with_transaction()
+        def do_downgrade(db):
+            cursor = db.cursor()
+            cursor.execute("DROP TABLE fulltextsearch_status")
+            cursor.execute("DROP TABLE fulltextsearch_mark")
+            cursor.execute("UPDATE system SET value='1' "
+                           "WHERE name='fulltextsearch_version'")
+            cursor.executemany("INSERT INTO system (name, value) "
+                               "VALUES (%s, %s)",
+                [('fulltextsearch_wiki:WikiStart',
+                  '%d abc' % to_utimestamp(changed)),
+                 ('fulltextsearch_attachment:ticket:42:foo.txt',
+                  str(to_utimestamp(changed)))])
+        self.assertTrue(self.fts.environment_needs_upgrade(
+                                                    self.env.get_read_db()))
+        @self.env.with_transaction()
+        def do_upgrade(db):
+            self.fts.upgrade_environment(db)
+        self.assertFalse(self.fts.environment_needs_upgrade(
+                                                    self.env.get_read_db()))
+        self.assertEquals({'wiki:WikiStart': (changed, 'abc')},
+                          self.fts._get_statuses('wiki'))
+        attachment = Resource('attachment', 'foo.txt',
+                              parent=Resource('ticket', 42))
+        self.assertEquals((changed, None), self.fts._get_status(attachment))
+        cursor = self.env.get_read_db().cursor()
+        cursor.execute("SELECT realm, id, parent_realm, parent_id, state "
+                       "FROM fulltextsearch_status WHERE realm='attachment'")
+        self.assertEquals([('attachment', 'foo.txt', 'ticket', '42',
+                            'indexed')], cursor.fetchall())
+        cursor.execute("SELECT COUNT(*) FROM system "
+                       "WHERE name LIKE 'fulltextsearch_%'")
+        self.assertEquals([(1,)], cursor.fetchall())
+
     def test_milestone(self):
         milestone = Milestone(self.env)
         milestone.name = 'New target date'
@@ -407,7 +1212,7 @@ class TicketsTestCase(unittest.TestCase):
         RemoteTicketSystem(self.env).environment_created()
         self.fts = FullTextSearch(self.env)
         self.fts.backend = Backend(self.fts.solr_endpoint, self.env.log,
-                                   MockSolrInterface)
+                                   MockSolrInterface, loader=self.fts._load)
         self.ticket_system = TicketSystem(self.env)
         self.req = Mock()
 
@@ -466,7 +1271,7 @@ class ChangesetsSvnTestCase(unittest.TestCase):
         self.repos.sync()
         self.fts = FullTextSearch(self.env)
         self.fts.backend = Backend(self.fts.solr_endpoint, self.env.log,
-                                   MockSolrInterface)
+                                   MockSolrInterface, loader=self.fts._load)
         
     def tearDown(self):
         self.env.reset_db()
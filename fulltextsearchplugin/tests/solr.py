@@ -0,0 +1,428 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime
+import errno
+from StringIO import StringIO
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import httplib2
+from lxml import etree
+from sunburnt import SolrError
+
+from trac.util.datefmt import utc
+
+from fulltextsearchplugin.fulltextsearch import FullTextSearchObject
+from fulltextsearchplugin.solr import (CircuitBreaker, JsonSolrInterface,
+                                       SolrInterface, SolrInterfacePool,
+                                       UploadPool, is_connection_error,
+                                       is_schema_error)
+
+SCHEMA = """<schema name="test" version="1.4">
+  <types>
+    <fieldType name="string" class="solr.StrField"/>
+    <fieldType name="text" class="solr.TextField"/>
+    <fieldType name="int" class="solr.TrieIntField"/>
+    <fieldType name="date" class="solr.TrieDateField"/>
+  </types>
+  <fields>
+    <field name="doc_id" type="string" required="true"/>
+    <field name="project" type="string" required="true"/>
+    <field name="realm" type="string" required="true"/>
+    <field name="id" type="string" required="true"/>
+    <field name="title" type="text" multiValued="true"/>
+    <field name="changed" type="date"/>
+    <field name="popularity" type="int"/>
+    <field name="body" type="text"/>
+  </fields>
+  <uniqueKey>doc_id</uniqueKey>
+</schema>
+"""
+
+class MockSolrInterface(object):
+    remote_schema_file = 'admin/file/?file=schema.xml'
+    instances = []
+
+    def __init__(self, url, schemadoc=None, http_connection=None,
+                 retry_timeout=None):
+        self.url = url
+        self.schema = schemadoc and schemadoc.read()
+        self.instances.append(self)
+
+
+class SolrInterfacePoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='fts-solr')
+        self.cache_path = os.path.join(self.dir, 'cache', 'schema.xml')
+        self.fetched = []
+        del MockSolrInterface.instances[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _pool(self, **kwargs):
+        pool = SolrInterfacePool('http://localhost/solr', MockSolrInterface,
+                                 **kwargs)
+        def fetch_schema():
+            self.fetched.append(True)
+            return '<schema version="%d"/>' % len(self.fetched)
+        pool._fetch_schema = fetch_schema
+        return pool
+
+    def test_reuse(self):
+        pool = self._pool()
+        si = pool.get()
+        self.assertTrue(si is pool.get())
+        self.assertEqual('<schema version="1"/>', si.schema)
+        self.assertEqual(1, len(self.fetched))
+
+    def test_per_thread(self):
+        pool = self._pool()
+        interfaces = [pool.get()]
+        thread = threading.Thread(target=lambda: interfaces.append(pool.get()))
+        thread.start()
+        thread.join()
+        self.assertEqual(2, len(interfaces))
+        self.assertFalse(interfaces[0] is interfaces[1])
+        self.assertEqual(1, len(self.fetched))
+
+    def test_ttl(self):
+        pool = self._pool(ttl=0)
+        si = pool.get()
+        self.assertFalse(si is pool.get())
+        self.assertEqual(2, len(self.fetched))
+
+    def test_invalidate(self):
+        pool = self._pool()
+        si = pool.get()
+        pool.invalidate()
+        si2 = pool.get()
+        self.assertFalse(si is si2)
+        self.assertEqual('<schema version="2"/>', si2.schema)
+
+    def test_cache_path(self):
+        pool = self._pool(cache_path=self.cache_path)
+        pool.get()
+        self.assertTrue(os.path.exists(self.cache_path))
+        # Another process, with an empty memory cache
+        pool = self._pool(cache_path=self.cache_path)
+        self.assertEqual('<schema version="1"/>', pool.get().schema)
+        self.assertEqual(1, len(self.fetched))
+        pool.invalidate()
+        self.assertFalse(os.path.exists(self.cache_path))
+
+    def test_shared_schema(self):
+        parsed = []
+        class SharingSolrInterface(MockSolrInterface):
+            def __init__(self, url, schema=None, **kwargs):
+                MockSolrInterface.__init__(self, url, **kwargs)
+                self.schema = schema
+            @staticmethod
+            def parse_schema(schemadoc):
+                parsed.append(schemadoc.read())
+                return object()
+        pool = self._pool()
+        pool.si_class = SharingSolrInterface
+        interfaces = [pool.get()]
+        thread = threading.Thread(target=lambda: interfaces.append(pool.get()))
+        thread.start()
+        thread.join()
+        self.assertEqual(['<schema version="1"/>'], parsed)
+        self.assertFalse(interfaces[0] is interfaces[1])
+        self.assertTrue(interfaces[0].schema is interfaces[1].schema)
+
+    def test_parse_schema(self):
+        schema = SolrInterface.parse_schema(StringIO(SCHEMA))
+        si = SolrInterface('http://localhost/solr/', schema=schema,
+                           http_connection=MockHttp())
+        self.assertTrue(si.schema is schema)
+
+    def test_without_schema(self):
+        class SchemalessSolrInterface(object):
+            def __init__(self, url, schemadoc=None, http_connection=None,
+                         retry_timeout=None):
+                self.schemadoc = schemadoc
+        pool = SolrInterfacePool('http://localhost/solr',
+                                 SchemalessSolrInterface)
+        self.assertEqual(None, pool.get().schemadoc)
+
+
+class ExtractHandler(BaseHTTPRequestHandler):
+    requests = []
+    # Basic credentials required, if any
+    authorization = None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append((self.path, self.headers, body))
+        if self.authorization and \
+                self.headers.get('Authorization') != self.authorization:
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', 'Basic realm="solr"')
+            self.end_headers()
+            return
+        self.send_response(self.path.split('?')[0] == '/solr/update/extract'
+                           and 200 or 404)
+        self.end_headers()
+        if 'extractOnly=true' in self.path:
+            self.wfile.write(json.dumps({
+                'responseHeader': {'status': 0},
+                'foo.txt': u'Caf\xe9 ipsum\n',
+                'foo.txt_metadata': {'dc:title': ['Lorem'],
+                                     'Author': ['Santa'],
+                                     'Content-Type': ['text/plain']}}))
+
+    def log_message(self, *args):
+        pass
+
+
+class SolrInterfaceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), ExtractHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.start()
+        del ExtractHandler.requests[:]
+        ExtractHandler.authorization = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_extract(self):
+        si = SolrInterface('http://127.0.0.1:%d/solr/' % self.server.server_port,
+                           schemadoc=StringIO(SCHEMA))
+        so = FullTextSearchObject('ftsproj', 'attachment', 'foo.txt',
+                                  title=[u'foo.txt', u'Caf\xe9'],
+                                  body=StringIO('Lorem ipsum ' * 10000))
+        si.add(so, extract=True, filename='foo.txt', commitWithin=5000)
+        (path, headers, body), = ExtractHandler.requests
+        self.assertEqual('/solr/update/extract?commitWithin=5000', path)
+        self.assertEqual(len(body), int(headers['Content-Length']))
+        self.assertTrue(body.endswith('--\r\n'))
+        self.assertTrue('name="literal.doc_id"\r\n' in body)
+        self.assertTrue('ftsproj:attachment:foo.txt' in body)
+        self.assertTrue('Caf\xc3\xa9' in body)
+        self.assertTrue('filename="foo.txt"' in body)
+        self.assertTrue('Lorem ipsum ' * 10000 in body)
+
+    def test_extract_text(self):
+        si = SolrInterface('http://127.0.0.1:%d/solr/' % self.server.server_port,
+                           schemadoc=StringIO(SCHEMA))
+        so = FullTextSearchObject('ftsproj', 'attachment', 'foo.txt',
+                                  body=StringIO('Caf\xc3\xa9 ipsum'))
+        text, metadata = si.extract_text(so)
+        self.assertEqual(u'Caf\xe9 ipsum\n', text)
+        self.assertEqual({'dc_title': ['Lorem']}, metadata)
+        (path, headers, body), = ExtractHandler.requests
+        self.assertTrue(path.startswith('/solr/update/extract?extractOnly=true'))
+        self.assertFalse('literal.' in body)
+
+    def test_credentials(self):
+        ExtractHandler.authorization = 'Basic c2FudGE6eG1hcw=='
+        http = httplib2.Http(timeout=10)
+        http.add_credentials('santa', 'xmas')
+        si = SolrInterface('http://127.0.0.1:%d/solr/' % self.server.server_port,
+                           schemadoc=StringIO(SCHEMA), http_connection=http)
+        so = FullTextSearchObject('ftsproj', 'attachment', 'foo.txt',
+                                  body=u'Caf\xe9 ipsum')
+        si.add(so, extract=True)
+        # Sent again, in full, with the credentials
+        first, second = ExtractHandler.requests
+        self.assertEqual(first[2], second[2])
+        self.assertTrue('Caf\xc3\xa9 ipsum\r\n--' in second[2])
+        self.assertEqual(ExtractHandler.authorization,
+                         second[1]['Authorization'])
+
+
+class MockHttp(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, url, method='GET', body=None, headers=None):
+        self.requests.append((url, body, headers))
+        return type('Response', (dict,), {'status': 200})(), ''
+
+
+class JsonSolrInterfaceTestCase(unittest.TestCase):
+    def test_matches_xml(self):
+        http = MockHttp()
+        si = JsonSolrInterface('http://localhost/solr/',
+                               schemadoc=StringIO(SCHEMA),
+                               http_connection=http)
+        docs = [FullTextSearchObject('ftsproj', 'wiki', name,
+                        title=[u'Caf\xe9', 'Lorem'], body=u'Caf\xe9 ipsum',
+                        changed=datetime(2010, 1, 1, 12, 30, tzinfo=utc),
+                        popularity=3)
+                for name in ('WikiStart', 'SandBox')]
+        si.add(docs, commitWithin=5000)
+        (url, body, headers), = http.requests
+        self.assertEqual('http://localhost/solr/update/json'
+                         '?commitWithin=5000', url)
+        self.assertEqual('application/json', headers['Content-Type'])
+
+        xml = etree.fromstring(str(si.schema.make_update(docs)))
+        expected = []
+        for doc in xml.findall('doc'):
+            fields = {}
+            for field in doc.findall('field'):
+                fields.setdefault(field.get('name'), []).append(field.text)
+            expected.append(fields)
+        actual = [dict((name, value if isinstance(value, list) else [value])
+                       for name, value in doc.iteritems())
+                  for doc in json.loads(body)]
+        self.assertEqual(expected, actual)
+        self.assertEqual([u'Caf\xe9', u'Lorem'], actual[0]['title'])
+
+    def test_commit_within(self):
+        http = MockHttp()
+        si = SolrInterface('http://localhost/solr/',
+                           schemadoc=StringIO(SCHEMA), http_connection=http)
+        si.add(FullTextSearchObject('ftsproj', 'wiki', 'WikiStart'),
+               commitWithin=5000)
+        si.commit(softCommit=True)
+        self.assertEqual(['http://localhost/solr/update/?commitWithin=5000',
+                          'http://localhost/solr/update/?commit=true'
+                          '&softCommit=true'],
+                         [url for url, body, headers in http.requests])
+        self.assertRaises(ValueError, si.conn.url_for_update,
+                          commitWithin=-1)
+
+    def test_missing_fields(self):
+        si = JsonSolrInterface('http://localhost/solr/',
+                               schemadoc=StringIO(SCHEMA),
+                               http_connection=MockHttp())
+        self.assertRaises(SolrError, si.add, object())
+
+
+class UploadPoolTestCase(unittest.TestCase):
+    def _upload(self, item):
+        with self.lock:
+            self.in_flight += len(item)
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= len(item)
+        if item == 'broken':
+            raise ValueError(item)
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.in_flight = self.max_in_flight = 0
+
+    def test_results(self):
+        items = ['foo', 'broken', 'bar', 'baz']
+        results = UploadPool(workers=3).map(self._upload, items)
+        self.assertEqual(items, [item for item, e in results])
+        self.assertEqual([None, ValueError, None, None],
+                         [e and e.__class__ for item, e in results])
+        self.assertTrue(self.max_in_flight > len('foo'))
+
+    def test_max_bytes(self):
+        items = ['a' * 10] * 6 + ['b' * 50]
+        UploadPool(workers=4, max_bytes=25).map(self._upload, items)
+        # A single item larger than max_bytes is uploaded on its own
+        self.assertEqual(50, self.max_in_flight)
+        self.max_in_flight = 0
+        UploadPool(workers=4, max_bytes=25).map(self._upload, items[:-1])
+        self.assertEqual(20, self.max_in_flight)
+
+    def test_persistent_threads(self):
+        threads = set()
+        def upload(item):
+            threads.add(threading.current_thread())
+            self._upload(item)
+        uploads = UploadPool(workers=2)
+        for i in range(3):
+            uploads.map(upload, ['foo', 'bar', 'baz'])
+        self.assertEqual(2, len(threads))
+        uploads.close()
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        # Started again if needed
+        self.assertEqual([('foo', None), ('bar', None)],
+                         uploads.map(self._upload, ['foo', 'bar']))
+        uploads.close()
+
+    def test_serial(self):
+        items = ['foo', 'bar', 'baz']
+        results = UploadPool(workers=1).map(self._upload, items)
+        self.assertEqual([(item, None) for item in items], results)
+        self.assertEqual(3, self.max_in_flight)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def test_threshold(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=10)
+        self.assertTrue(breaker.allow(0))
+        breaker.failure(0)
+        self.assertFalse(breaker.is_open)
+        breaker.success()
+        breaker.failure(0)
+        self.assertFalse(breaker.is_open)
+        breaker.failure(1)
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow(5))
+        self.assertEqual(6, breaker.retry_delay(5))
+
+    def test_probe(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=10, max_cooldown=30)
+        breaker.failure(0)
+        # A single caller probes once the cooldown has passed
+        self.assertTrue(breaker.allow(10))
+        self.assertFalse(breaker.allow(10))
+        breaker.failure(10)
+        self.assertFalse(breaker.allow(29))
+        self.assertTrue(breaker.allow(30))
+        breaker.failure(30)
+        self.assertFalse(breaker.allow(59))
+        self.assertTrue(breaker.allow(60))
+        breaker.failure(60)
+        # Limited to max_cooldown
+        self.assertTrue(breaker.allow(90))
+        breaker.success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow(90))
+        self.assertTrue(breaker.allow(90))
+
+
+class SchemaErrorTestCase(unittest.TestCase):
+    def test_is_schema_error(self):
+        self.assertTrue(is_schema_error(SolrError({'status': '400'},
+            "ERROR: [doc=ftsproj.wiki.Foo] unknown field 'foo'")))
+        self.assertTrue(is_schema_error(SolrError({'status': '400'},
+            "undefined field foo")))
+        self.assertFalse(is_schema_error(SolrError({'status': '500'},
+            "Internal Server Error")))
+        self.assertFalse(is_schema_error(IOError('Connection refused')))
+
+    def test_is_connection_error(self):
+        self.assertTrue(is_connection_error(
+            socket.error(errno.ECONNREFUSED, 'Connection refused')))
+        self.assertTrue(is_connection_error(socket.timeout('timed out')))
+        self.assertTrue(is_connection_error(
+            httplib2.ServerNotFoundError('localhost')))
+        self.assertFalse(is_connection_error(SolrError({'status': '500'},
+            "Internal Server Error")))
+        self.assertFalse(is_connection_error(
+            IOError(errno.ENOENT, 'No such file or directory')))
+        self.assertFalse(is_connection_error(ValueError('No JSON')))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SolrInterfacePoolTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SolrInterfaceTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(JsonSolrInterfaceTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(UploadPoolTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CircuitBreakerTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SchemaErrorTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
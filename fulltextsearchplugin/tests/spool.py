@@ -0,0 +1,126 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from fulltextsearchplugin.spool import MemorySpool, SqliteSpool
+
+class MemorySpoolTestCase(unittest.TestCase):
+    def _spool(self):
+        return MemorySpool()
+
+    def test_empty(self):
+        spool = self._spool()
+        self.assertEqual(0, len(spool))
+        self.assertEqual([], spool.peek())
+
+    def test_put_peek(self):
+        spool = self._spool()
+        spool.put('foo')
+        spool.put('bar')
+        self.assertEqual(2, len(spool))
+        self.assertEqual(['foo', 'bar'], [item for key, item in spool.peek()])
+        self.assertEqual(['foo'], [item for key, item in spool.peek(1)])
+        # Peeking doesn't remove items
+        self.assertEqual(2, len(spool))
+
+    def test_remove(self):
+        spool = self._spool()
+        spool.put('foo')
+        spool.put('bar')
+        (key, item), = spool.peek(1)
+        spool.remove([key])
+        self.assertEqual(['bar'], [item for key, item in spool.peek()])
+
+    def test_claim(self):
+        spool = self._spool()
+        spool.put('foo')
+        spool.put('bar')
+        claimed = spool.claim(1)
+        self.assertEqual(['foo'], [item for key, item in claimed])
+        # Sending them failed
+        spool.release([key for key, item in claimed])
+        self.assertEqual(['foo', 'bar'],
+                         [item for key, item in spool.claim()])
+
+
+class SqliteSpoolTestCase(MemorySpoolTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='fts-spool')
+        self.path = os.path.join(self.dir, 'spool', 'spool.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _spool(self):
+        return SqliteSpool(self.path)
+
+    def test_persistent(self):
+        spool = self._spool()
+        spool.put({'foo': [1, 2, 3]})
+        spool.close()
+        spool = self._spool()
+        self.assertEqual([{'foo': [1, 2, 3]}],
+                         [item for key, item in spool.peek()])
+
+    def test_claim_shared(self):
+        spool = self._spool()
+        other = self._spool()
+        for item in ('foo', 'bar', 'baz'):
+            spool.put(item)
+        claimed = spool.claim(2)
+        self.assertEqual(['foo', 'bar'], [item for key, item in claimed])
+        # Not sent by another process as well, nor any later items ahead
+        # of them
+        self.assertEqual([], other.claim())
+        self.assertEqual(['baz'], [item for key, item in spool.claim()])
+        spool.remove([key for key, item in claimed])
+        spool.release([key for key, item in spool.peek()])
+        self.assertEqual(['baz'], [item for key, item in other.claim()])
+        self.assertEqual([], spool.claim())
+
+    def test_claim_expired(self):
+        spool = SqliteSpool(self.path, lease=0.01)
+        spool.put('foo')
+        spool.claim()
+        time.sleep(0.02)
+        # Claimed by a process which died
+        self.assertEqual(['foo'], [item for key, item
+                                   in SqliteSpool(self.path).claim()])
+
+    def test_claim_bytes(self):
+        spool = self._spool()
+        for item in ('a' * 1000, 'b' * 1000, 'c' * 3000):
+            spool.put(item)
+        # Bodies spooled by a reindex aren't all loaded at once
+        self.assertEqual(['a' * 1000], [item for key, item
+                                        in spool.claim(10, 1500)])
+        self.assertEqual(['b' * 1000], [item for key, item
+                                        in spool.claim(10, 2500)])
+        # An item larger than max_bytes is still sent
+        self.assertEqual(['c' * 3000], [item for key, item
+                                        in spool.claim(10, 1500)])
+
+    def test_upgrade(self):
+        os.makedirs(os.path.dirname(self.path))
+        cnx = sqlite3.connect(self.path)
+        cnx.execute("CREATE TABLE spool ("
+                    "key INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "item BLOB NOT NULL)")
+        cnx.commit()
+        cnx.close()
+        spool = self._spool()
+        spool.put('foo')
+        self.assertEqual(['foo'], [item for key, item in spool.claim()])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MemorySpoolTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SqliteSpoolTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
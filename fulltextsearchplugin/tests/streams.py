@@ -0,0 +1,76 @@
+from StringIO import StringIO
+import cPickle
+import os
+import shutil
+import tempfile
+import unittest
+
+from fulltextsearchplugin.streams import LazyFile, SpooledStream, stream_size
+
+class StreamSizeTestCase(unittest.TestCase):
+    def test_strings(self):
+        self.assertEqual(0, stream_size(None))
+        self.assertEqual(5, stream_size('Lorem'))
+        # Encoded as UTF-8
+        self.assertEqual(6, stream_size(u'Caf\xe9 '))
+        self.assertEqual(9, stream_size(u'\u4e2d\u6587\u5b57'))
+
+
+class LazyFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='fts-streams')
+        self.path = os.path.join(self.dir, 'foo.txt')
+        f = open(self.path, 'wb')
+        f.write('Lorem ipsum dolor sit amet')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lazy(self):
+        body = LazyFile(self.path)
+        self.assertEqual(None, body._f)
+        self.assertEqual(26, stream_size(body))
+        self.assertEqual('Lorem', body.read(5))
+        self.assertNotEqual(None, body._f)
+        self.assertEqual(' ipsum dolor sit amet', body.read())
+        # Closed once read to the end
+        self.assertEqual(None, body._f)
+        body.seek(0)
+        self.assertEqual('Lorem ipsum dolor sit amet', body.read())
+
+    def test_pickle(self):
+        body = LazyFile(self.path)
+        body.read(5)
+        body = cPickle.loads(cPickle.dumps(body, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(None, body._f)
+        self.assertEqual('Lorem ipsum dolor sit amet', body.read())
+
+
+class SpooledStreamTestCase(unittest.TestCase):
+    def test_spooled(self):
+        data = 'Lorem ipsum dolor sit amet ' * 1000
+        body = SpooledStream(StringIO(data), max_memory=100)
+        self.assertEqual(len(data), stream_size(body))
+        # Written to a temporary file, beyond max_memory
+        self.assertTrue(body._f._rolled)
+        self.assertEqual(data, body.read())
+        body.seek(0)
+        self.assertEqual(data[:5], body.read(5))
+
+    def test_pickle(self):
+        body = SpooledStream(StringIO('Lorem ipsum'))
+        body = cPickle.loads(cPickle.dumps(body, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(11, stream_size(body))
+        self.assertEqual('Lorem ipsum', body.read())
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(StreamSizeTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(LazyFileTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SpooledStreamTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
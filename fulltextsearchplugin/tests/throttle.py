@@ -0,0 +1,93 @@
+import unittest
+
+from fulltextsearchplugin.throttle import LatencyWindow, Throttle, TokenBucket
+
+class LatencyWindowTestCase(unittest.TestCase):
+    def test_percentile(self):
+        latencies = LatencyWindow(size=20)
+        self.assertEqual(None, latencies.percentile(95))
+        for i in range(30):
+            latencies.record(i / 10.0)
+        self.assertEqual(20, len(latencies))
+        self.assertEqual(2.8, latencies.percentile(95))
+        self.assertEqual(1.9, latencies.percentile(50))
+        self.assertEqual(1.0, latencies.percentile(0))
+
+    def test_timing(self):
+        latencies = LatencyWindow()
+        with latencies.timing():
+            pass
+        self.assertEqual(1, len(latencies))
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_take(self):
+        bucket = TokenBucket(2, now=0)
+        self.assertEqual(0, bucket.take(1, now=0))
+        self.assertEqual(0, bucket.take(1, now=0))
+        self.assertEqual(0.5, bucket.take(1, now=0))
+        # Refilled, but only up to the burst
+        self.assertEqual(0, bucket.take(2, now=10))
+        self.assertEqual(0.5, bucket.take(1, now=10))
+
+    def test_borrow(self):
+        bucket = TokenBucket(100, now=0)
+        self.assertEqual(9, bucket.take(1000, now=0))
+
+
+class ThrottleTestCase(unittest.TestCase):
+    def test_none(self):
+        throttle = Throttle('none', docs_per_second=1, now=0)
+        self.assertEqual(0, throttle.delay(100, now=0))
+        self.assertEqual(0, throttle.delay(100, now=0))
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, Throttle, 'fast')
+
+    def test_bucket(self):
+        throttle = Throttle('bucket', docs_per_second=10,
+                            bytes_per_second=1000, now=0)
+        self.assertEqual(0, throttle.delay(100, now=0))
+        # Limited by bytes
+        self.assertEqual(1, throttle.delay(1900, now=0))
+        # Limited by documents
+        throttle = Throttle('bucket', docs_per_second=1, now=0)
+        self.assertEqual(0, throttle.delay(100, now=0))
+        self.assertEqual(1, throttle.delay(100, now=0))
+
+    def test_adaptive(self):
+        latencies = LatencyWindow()
+        throttle = Throttle('adaptive', latencies=latencies,
+                            target_latency=0.5, interval=1, now=0)
+        latencies.record(0.1)
+        self.assertEqual(0, throttle.delay(now=1))
+        for i in range(10):
+            latencies.record(2)
+        # Only adjusted once an interval
+        self.assertEqual(0, throttle.delay(now=1.5))
+        self.assertEqual(0.01, throttle.delay(now=2))
+        self.assertEqual(0.02, throttle.delay(now=3))
+        for i in range(100):
+            latencies.record(0.1)
+        self.assertEqual(0.01, throttle.delay(now=4))
+        self.assertEqual(0, throttle.delay(now=5))
+
+    def test_adaptive_max_delay(self):
+        latencies = LatencyWindow()
+        latencies.record(2)
+        throttle = Throttle('adaptive', latencies=latencies, max_delay=1,
+                            now=0)
+        for i in range(10):
+            delay = throttle.delay(now=i + 1)
+        self.assertEqual(1, delay)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(LatencyWindowTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(TokenBucketTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ThrottleTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
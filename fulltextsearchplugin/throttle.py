@@ -0,0 +1,145 @@
+"""Pacing of `fulltext index` and `reindex`, so they leave Solr enough
+capacity to answer searches.
+
+`Throttle` limits the documents, and bytes, indexed per second with token
+buckets. In adaptive mode it also backs off while the latency of Solr's
+responses, as recorded in a `LatencyWindow` by the Backend, is too high.
+"""
+from collections import deque
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+__all__ = ['LatencyWindow', 'Throttle', 'TokenBucket']
+
+
+class LatencyWindow(object):
+    """The durations of the latest `size` requests to Solr, in seconds."""
+
+    def __init__(self, size=100):
+        self._durations = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._durations)
+
+    def record(self, seconds):
+        with self._lock:
+            self._durations.append(seconds)
+
+    @contextmanager
+    def timing(self):
+        """Record how long the body of the with statement takes."""
+        start = time.time()
+        yield
+        self.record(time.time() - start)
+
+    def percentile(self, p):
+        """Return the `p`th percentile of the durations, None if there are
+        none.
+        """
+        with self._lock:
+            durations = sorted(self._durations)
+        if not durations:
+            return None
+        index = int(math.ceil(p / 100.0 * len(durations))) - 1
+        return durations[max(index, 0)]
+
+
+class TokenBucket(object):
+    """Allows `rate` units a second on average, in bursts of up to `burst`
+    units, one second's worth by default.
+
+    Units taken beyond the tokens available are borrowed, so a single large
+    document waits in proportion to its size.
+    """
+
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = float(rate)
+        self.burst = max(burst or self.rate, 1)
+        self.tokens = self.burst
+        self._last = now if now is not None else time.time()
+
+    def take(self, amount, now=None):
+        """Take `amount` tokens, return the seconds to wait until they have
+        been refilled.
+        """
+        now = now if now is not None else time.time()
+        elapsed = max(now - self._last, 0)
+        self._last = now
+        self.tokens = min(self.tokens + elapsed * self.rate, self.burst)
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class Throttle(object):
+    """Decides how long to wait after indexing each document.
+
+    mode -- One of
+        'none': don't wait
+        'bucket': index at most `docs_per_second` documents and
+            `bytes_per_second` bytes a second, either unlimited if 0
+        'adaptive': as 'bucket', and wait longer whilst the 95th percentile
+            of the latencies in `latencies` exceeds `target_latency`
+            seconds. The delay doubles every `interval` seconds until the
+            latency is below target, up to `max_delay` seconds, then halves
+            again.
+    """
+
+    MODES = ('none', 'bucket', 'adaptive')
+
+    def __init__(self, mode='none', docs_per_second=0, bytes_per_second=0,
+                 latencies=None, target_latency=0.5, interval=1.0,
+                 max_delay=10.0, now=None):
+        if mode not in self.MODES:
+            raise ValueError("Unknown throttle mode %r" % (mode,))
+        self.mode = mode
+        self.buckets = []
+        if mode != 'none':
+            if docs_per_second > 0:
+                self.buckets.append((TokenBucket(docs_per_second, now=now),
+                                     lambda nbytes: 1))
+            if bytes_per_second > 0:
+                self.buckets.append((TokenBucket(bytes_per_second, now=now),
+                                     lambda nbytes: nbytes))
+        self.latencies = latencies
+        self.target_latency = target_latency
+        self.interval = interval
+        self.max_delay = max_delay
+        self.backoff = 0
+        self._adjusted = now if now is not None else time.time()
+
+    def delay(self, nbytes=0, now=None):
+        """Return the seconds to wait after indexing a document of `nbytes`
+        bytes.
+        """
+        if self.mode == 'none':
+            return 0
+        now = now if now is not None else time.time()
+        delay = 0
+        for bucket, amount in self.buckets:
+            delay = max(delay, bucket.take(amount(nbytes), now))
+        if self.mode == 'adaptive' and self.latencies is not None:
+            self._adjust(now)
+            delay = max(delay, self.backoff)
+        return delay
+
+    def wait(self, nbytes=0):
+        delay = self.delay(nbytes)
+        if delay:
+            time.sleep(delay)
+
+    def _adjust(self, now):
+        if now - self._adjusted < self.interval:
+            return
+        self._adjusted = now
+        p95 = self.latencies.percentile(95)
+        if p95 is not None and p95 > self.target_latency:
+            self.backoff = min(max(self.backoff * 2, 0.01), self.max_delay)
+        elif self.backoff:
+            self.backoff /= 2
+            if self.backoff < 0.01:
+                self.backoff = 0
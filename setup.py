@@ -52,6 +52,7 @@ setup(
         'trac.plugins': [
             'fulltextsearchplugin.fulltextsearch = fulltextsearchplugin.fulltextsearch',
             'fulltextsearchplugin.admin = fulltextsearchplugin.admin',
+            'fulltextsearchplugin.extract = fulltextsearchplugin.extract',
         ]    
     },
     test_suite = 'fulltextsearchplugin.tests.suite',